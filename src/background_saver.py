@@ -0,0 +1,59 @@
+from threading import Thread, Event, Lock
+from time import sleep
+
+import logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.WARNING)
+
+
+class BackgroundSaver:
+    """Runs a save function in a background thread and coalesces requests.
+
+    The first request starts a delay. All requests made during the delay are covered by the
+    single save that runs when the delay is over, so a burst of changes costs one write.
+    Call flush before the program exits so the changes of the last delay are not lost.
+    """
+
+    def __init__(self, save_function, delay=10.0):
+        """Constructor:
+
+        Args:
+            save_function (function()): function that does the saving
+            delay (float, optional): Seconds to wait for more changes before saving. Defaults to 10.0.
+        """
+        self._save_function = save_function
+        self.delay = delay
+        self._requested = Event()
+        # held while saving so a flush and the save thread never save at the same time
+        self._save_lock = Lock()
+        self.saves = 0
+        Thread(target=self._save_thread, daemon=True).start()
+
+    def request(self):
+        """Ask for a save. Returns immediately."""
+        self._requested.set()
+
+    def flush(self):
+        """Run the requested save now instead of after the delay. Returns when it is done."""
+        self._save()
+
+    def _save(self):
+        """Save if a save was requested"""
+        with self._save_lock:
+            if not self._requested.is_set():
+                # saved by a flush during the delay
+                return
+            # clear before saving so changes made while saving cause another save
+            self._requested.clear()
+            try:
+                self._save_function()
+                self.saves += 1
+            except Exception:
+                logger.exception('background save failed')
+
+    def _save_thread(self):
+        """Thread function that waits for requests and saves"""
+        while True:
+            self._requested.wait()
+            sleep(self.delay)
+            self._save()
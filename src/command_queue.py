@@ -0,0 +1,191 @@
+from collections import OrderedDict
+from threading import Thread, Event, Lock
+from time import sleep
+import asyncio
+
+import logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.WARNING)
+
+
+class CommandQueue:
+    """Runs commands one at a time in a worker thread, coalescing redundant commands and dropping
+    commands when too many are waiting.
+
+    Every command has a key. A command submitted while another command with the same key is still
+    waiting replaces it, so a burst of writes to the same tag costs a single command. The worker
+    waits a short window after it wakes up so the commands of a burst can coalesce. Commands
+    with the key None are never coalesced.
+
+    A command can have an on_discard callback that is called when it will never run, because it
+    was dropped or replaced by a command with another function, like a pulse tag that must be reset.
+    """
+
+    # the counters reported by stats()
+    COUNTERS = ('submitted', 'coalesced', 'dropped', 'executed', 'failed')
+
+    def __init__(self, max_pending=100, window=0.02, on_drained=None):
+        """Constructor:
+
+        Args:
+            max_pending (int, optional): Max number of waiting commands. More are dropped. Defaults to 100.
+            window (float, optional): Seconds to collect a burst of commands before running them. Defaults to 0.02.
+            on_drained (function(dict), optional): Called with stats() from the worker when all waiting commands have run.
+                Defaults to None.
+        """
+        self.max_pending = max_pending
+        self.window = window
+        self._on_drained = on_drained
+        self._lock = Lock()
+        # key -> (function, args, on_discard) in the order the keys were first submitted
+        self._pending = OrderedDict()
+        self.submitted = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.executed = 0
+        self.failed = 0
+        self._start()
+
+    def submit(self, key, function, *args, on_discard=None):
+        """Queue a command without blocking
+
+        Args:
+            key (hashable): commands with the same key coalesce. None means never coalesce.
+            function (function(*args)): the command
+            args: arguments of the command
+            on_discard (function(), optional): Called if the command is dropped or replaced by a command with
+                another function. Defaults to None.
+
+        Returns:
+            bool: False if the command was dropped because too many commands are waiting
+        """
+        discarded = None
+        queued = True
+        with self._lock:
+            self.submitted += 1
+            if key is not None and key in self._pending:
+                # the waiting command keeps its place in the queue but runs with the newest arguments
+                old_function, old_args, old_on_discard = self._pending[key]
+                if old_function != function:
+                    discarded = old_on_discard
+                self._pending[key] = (function, args, on_discard)
+                self.coalesced += 1
+                added = False
+            elif len(self._pending) >= self.max_pending:
+                self.dropped += 1
+                logger.warning('command queue is full. Dropped {}{}'.format(getattr(function, '__name__', function), args))
+                discarded = on_discard
+                queued = added = False
+            else:
+                self._pending[key if key is not None else object()] = (function, args, on_discard)
+                added = True
+        if discarded is not None:
+            self._discard(discarded)
+        if added:
+            self._wake()
+        return queued
+
+    def _discard(self, on_discard):
+        """Call the on_discard callback of a command that will never run"""
+        try:
+            on_discard()
+        except Exception:
+            logger.exception('on_discard callback failed')
+
+    def depth(self):
+        """Returns:
+            int: number of waiting commands
+        """
+        return len(self._pending)
+
+    def stats(self):
+        """Returns:
+            dict: {'depth': int} and the counters {'submitted': int, 'coalesced': int, 'dropped': int, 'executed': int, 'failed': int}
+        """
+        stats = {'depth': self.depth()}
+        stats.update((name, getattr(self, name)) for name in self.COUNTERS)
+        return stats
+
+    def _next(self):
+        """Take the oldest waiting command
+
+        Returns:
+            tuple: (function, args) or None if there are none
+        """
+        with self._lock:
+            if not self._pending:
+                return None
+            function, args, on_discard = self._pending.popitem(last=False)[1]
+            return function, args
+
+    def _start(self):
+        self._wakeup = Event()
+        Thread(target=self._worker_thread, daemon=True).start()
+
+    def _wake(self):
+        self._wakeup.set()
+
+    def _worker_thread(self):
+        """Thread function that runs the commands"""
+        while True:
+            self._wakeup.wait()
+            sleep(self.window)
+            # clear before running so commands submitted while running wake the worker again
+            self._wakeup.clear()
+            command = self._next()
+            while command is not None:
+                function, args = command
+                try:
+                    function(*args)
+                    self.executed += 1
+                except Exception:
+                    self.failed += 1
+                    logger.exception('command {}{} failed'.format(getattr(function, '__name__', function), args))
+                command = self._next()
+            if self._on_drained is not None:
+                try:
+                    self._on_drained(self.stats())
+                except Exception:
+                    logger.exception('on_drained callback failed')
+
+
+class AsyncCommandQueue(CommandQueue):
+    """CommandQueue for coroutine commands. The worker is a task on the running event loop, so it must be
+    made and used from the loop. on_drained and on_discard are coroutine functions too.
+    """
+
+    def _discard(self, on_discard):
+        """Run the on_discard coroutine of a command that will never run as a task"""
+        task = asyncio.get_running_loop().create_task(on_discard())
+        task.add_done_callback(self._discard_done)
+
+    @staticmethod
+    def _discard_done(task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error('on_discard callback failed. Error = {!r}'.format(task.exception()))
+
+    def _start(self):
+        self._wakeup = asyncio.Event()
+        self._worker = asyncio.get_running_loop().create_task(self._worker_task())
+
+    async def _worker_task(self):
+        """Task that runs the commands. See CommandQueue._worker_thread"""
+        while True:
+            await self._wakeup.wait()
+            await asyncio.sleep(self.window)
+            self._wakeup.clear()
+            command = self._next()
+            while command is not None:
+                function, args = command
+                try:
+                    await function(*args)
+                    self.executed += 1
+                except Exception:
+                    self.failed += 1
+                    logger.exception('command {}{} failed'.format(getattr(function, '__name__', function), args))
+                command = self._next()
+            if self._on_drained is not None:
+                try:
+                    await self._on_drained(self.stats())
+                except Exception:
+                    logger.exception('on_drained callback failed')
@@ -0,0 +1,134 @@
+from threading import Thread
+from time import sleep
+import hashlib
+import os
+import yaml
+
+# inotify is optional. Without it the content map is polled.
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+import logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.WARNING)
+
+
+class ContentMapWatcher:
+    """Watches the content map file of a pick by light and applies changes to it while running.
+
+    The file is only read when its mtime or size changed and only parsed when its hash changed.
+    The parsed map is handed to PickByLight.update_content_map which applies and publishes just the
+    changed fields per port, so the content index, UA tags and gui follow without a restart.
+    The watcher follows the pick by light if another content map file is loaded.
+
+    inotify is used when the inotify_simple package is installed, else the file is polled.
+    """
+
+    def __init__(self, pick_by_light, interval=1.0):
+        """Constructor:
+
+        Args:
+            pick_by_light (PickByLight): the pick by light whose content map to watch
+            interval (float, optional): Seconds between polls without inotify. Defaults to 1.0.
+        """
+        self._pbl = pick_by_light
+        self.interval = interval
+        self._path = None
+        self._stat = None
+        self._hash = None
+        self._remember(self._pbl.get_content_map_path())
+        Thread(target=self._inotify_thread if INotify is not None else self._poll_thread, daemon=True).start()
+
+    def check(self):
+        """Check the content map file once and apply it if it changed
+
+        Returns:
+            dict: the applied changes as {port_number: {key: new value}} or None if nothing changed
+        """
+        path = self._pbl.get_content_map_path()
+        if path != self._path:
+            # another content map was loaded. It is already applied.
+            self._remember(path)
+            return None
+        if path is None:
+            return None
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            # the file is being replaced, try again later
+            return None
+        if (stat.st_mtime_ns, stat.st_size) == self._stat:
+            return None
+        self._stat = (stat.st_mtime_ns, stat.st_size)
+
+        with open(path, 'rb') as content_file:
+            data = content_file.read()
+        digest = hashlib.sha1(data).hexdigest()
+        if digest == self._hash:
+            return None
+
+        try:
+            content_map = yaml.safe_load(data)
+        except yaml.YAMLError as e:
+            logger.error('could not parse the changed content map {}. Keeping the current content. Error = {}'.format(path, e))
+            return None
+        self._hash = digest
+        diff = self._pbl.update_content_map(content_map)
+        logger.info('content map {} changed on ports {}'.format(path, list(diff)))
+        return diff
+
+    def _remember(self, path):
+        """Remember the current state of a content map file so it is not applied again"""
+        self._path = path
+        self._stat = None
+        self._hash = None
+        if path is None:
+            return
+        try:
+            stat = os.stat(path)
+            with open(path, 'rb') as content_file:
+                self._hash = hashlib.sha1(content_file.read()).hexdigest()
+            self._stat = (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            pass
+
+    def _check_safely(self):
+        try:
+            self.check()
+        except Exception:
+            logger.exception('failed to reload the content map')
+
+    def _poll_thread(self):
+        """Thread function that polls the content map file"""
+        while True:
+            sleep(self.interval)
+            self._check_safely()
+
+    def _inotify_thread(self):
+        """Thread function that waits for inotify events on the directory of the content map.
+        The directory is watched because editors often save by replacing the file."""
+        inotify = INotify()
+        watch = None
+        watched_dir = None
+        mask = flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE
+        while True:
+            path = self._pbl.get_content_map_path()
+            directory = os.path.dirname(path) if path else None
+            if directory != watched_dir:
+                if watch is not None:
+                    inotify.rm_watch(watch)
+                    watch = None
+                if directory is not None:
+                    watch = inotify.add_watch(directory, mask)
+                watched_dir = directory
+
+            # the timeout makes sure a newly loaded content map is noticed
+            events = inotify.read(timeout=int(self.interval * 1000 * 10))
+            if path and any(event.name == os.path.basename(path) for event in events):
+                # let the writer finish before reading
+                sleep(0.05)
+                self._check_safely()
+            elif not events:
+                self._check_safely()
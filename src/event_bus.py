@@ -0,0 +1,149 @@
+from collections import namedtuple
+from datetime import datetime
+from queue import Queue
+from threading import Thread, Lock
+
+import logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.WARNING)
+
+# Kinds of state change events published by the pick by light
+PORT_SELECTED = 'port_selected'         # data: {'amount': int, 'instructions': str}
+PORT_DESELECTED = 'port_deselected'     # data: {'work_finished': bool}
+WORK_FINISHED = 'work_finished'         # data: None
+ACTIVITY = 'activity'                   # data: {'selected': bool} the selection state when the activity happened
+CONTENT_CHANGED = 'content_changed'     # data: {key: new value} the changed content fields. None for removed fields
+LIGHT_CHANGED = 'light_changed'         # data: light level in percent
+STATE_CHANGED = 'state_changed'         # data: {key: value} raw change through set_port_state
+
+EVENT_KINDS = (PORT_SELECTED, PORT_DESELECTED, WORK_FINISHED, ACTIVITY, CONTENT_CHANGED, LIGHT_CHANGED, STATE_CHANGED)
+
+# Kinds the orders depend on. They are never dropped, even when the queue is full.
+LOSSLESS_KINDS = frozenset((PORT_SELECTED, PORT_DESELECTED, WORK_FINISHED))
+
+
+class StateEvent(namedtuple('StateEvent', ['kind', 'port_number', 'data', 'timestamp'])):
+    """A change in the state of the pick by light.
+
+    Attributes:
+        kind (str): one of EVENT_KINDS
+        port_number (int): the port that changed or None if the change is not about a single port
+        data (any): kind specific payload
+        timestamp (datetime): when the change happened
+    """
+    __slots__ = ()
+
+
+class EventBus:
+    """Delivers state change events to subscribers.
+
+    Publishing never blocks: events are put on a queue and a single dispatcher thread calls
+    the subscribers. Kinds nobody subscribed to are not queued. The light changes of a port are
+    coalesced, so only its latest level waits in the queue. Other events are dropped and counted when
+    maxsize of them are waiting, except the LOSSLESS_KINDS. Subscribers are called from the
+    dispatcher thread so they should return quickly.
+    """
+
+    def __init__(self, maxsize=1000):
+        """Constructor:
+
+        Args:
+            maxsize (int, optional): Max number of events waiting to be dispatched, not counting the LOSSLESS_KINDS. Defaults to 1000.
+        """
+        self.maxsize = maxsize
+        self._queue = Queue()
+        self._lock = Lock()
+        self._subscribers = []
+        # the kinds at least one subscriber receives
+        self._kinds = frozenset()
+        # number of waiting events that can be dropped
+        self._pending = 0
+        # port number -> (light level, timestamp) of the light change waiting in the queue
+        self._lights = {}
+        self.dropped = 0
+        Thread(target=self._dispatch_thread, daemon=True).start()
+
+    def subscribe(self, callback, kinds=None):
+        """Subscribe to state change events
+
+        Args:
+            callback (function(StateEvent)): Function called with every event.
+            kinds (iterable, optional): Only receive these kinds of events. Defaults to None meaning all kinds.
+
+        Raises:
+            TypeError: callback is not a callable function
+        """
+        if not callable(callback):
+            raise TypeError('callback must be callable. You gave it type: {}'.format(type(callback)))
+        kinds = frozenset(kinds) if kinds is not None else None
+        with self._lock:
+            # copy on write so the dispatcher can iterate without holding the lock
+            self._subscribers = self._subscribers + [(callback, kinds)]
+            self._update_kinds()
+
+    def unsubscribe(self, callback):
+        """Stop receiving events
+
+        Args:
+            callback (function(StateEvent)): A callback given to subscribe
+        """
+        with self._lock:
+            self._subscribers = [(c, k) for c, k in self._subscribers if c != callback]
+            self._update_kinds()
+
+    def _update_kinds(self):
+        """Find the kinds the subscribers receive. Must be called with the lock held."""
+        kinds = set()
+        for callback, subscribed in self._subscribers:
+            kinds.update(EVENT_KINDS if subscribed is None else subscribed)
+        self._kinds = frozenset(kinds)
+
+    def publish(self, kind, port_number=None, data=None):
+        """Publish an event without blocking
+
+        Args:
+            kind (str): one of EVENT_KINDS
+            port_number (int, optional): the port the event is about. Defaults to None.
+            data (any, optional): kind specific payload. Defaults to None.
+
+        Returns:
+            bool: False if the event was dropped because the queue is full
+        """
+        if kind not in self._kinds:
+            return True
+        timestamp = datetime.now()
+        if kind in LOSSLESS_KINDS:
+            self._queue.put(StateEvent(kind, port_number, data, timestamp))
+            return True
+        with self._lock:
+            if kind == LIGHT_CHANGED and port_number in self._lights:
+                # the waiting light change of the port is given the new level
+                self._lights[port_number] = (data, timestamp)
+                return True
+            if self._pending >= self.maxsize:
+                self.dropped += 1
+                logger.warning('event queue is full. Dropped {} event on port {}'.format(kind, port_number))
+                return False
+            self._pending += 1
+            if kind == LIGHT_CHANGED:
+                self._lights[port_number] = (data, timestamp)
+        self._queue.put(StateEvent(kind, port_number, data, timestamp))
+        return True
+
+    def _dispatch_thread(self):
+        """Thread function that calls the subscribers with the queued events"""
+        while True:
+            event = self._queue.get()
+            if event.kind not in LOSSLESS_KINDS:
+                with self._lock:
+                    self._pending -= 1
+                    if event.kind == LIGHT_CHANGED:
+                        data, timestamp = self._lights.pop(event.port_number)
+                        event = StateEvent(event.kind, event.port_number, data, timestamp)
+            for callback, kinds in self._subscribers:
+                if kinds is not None and event.kind not in kinds:
+                    continue
+                try:
+                    callback(event)
+                except Exception:
+                    logger.exception('subscriber {} failed on event {}'.format(callback, event))
@@ -0,0 +1,255 @@
+from bisect import bisect_right
+from datetime import datetime
+from queue import Queue, Empty, Full
+from threading import Thread
+from time import monotonic
+import json
+import os
+
+import event_bus
+
+import logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.WARNING)
+
+# Light changes happen every animation tick and are not worth keeping
+JOURNAL_KINDS = [kind for kind in event_bus.EVENT_KINDS if kind != event_bus.LIGHT_CHANGED]
+
+# Queue items that make the writer write its batch, and stop
+_FLUSH = object()
+_CLOSE = object()
+
+FILE_PREFIX = 'journal-'
+FILE_SUFFIX = '.jsonl'
+INDEX_SUFFIX = '.idx'
+
+# Seconds records can be out of time order in the journal. Events are timestamped when they are
+# published, so events of different threads can be queued in a slightly different order.
+ORDER_TOLERANCE = 1.0
+
+
+class EventJournal:
+    """Append-only journal of pick by light state change events.
+
+    Events are handed to a background writer that collects them and writes a whole batch with a
+    single write when the batch is full or the flush interval has passed. This keeps SD card wear
+    and fsync stalls away from the gpio and UA threads.
+
+    The journal is a directory of json lines files named after the time of their first event.
+    A new file is started when the current one gets too big and the oldest files are deleted.
+    Next to each file an index holds the time and file offset of every batch so reads by time
+    range only have to scan the batches in the range.
+
+    Usage:
+        journal = EventJournal('journal')
+        pick_by_light.subscribe(journal.record, kinds=JOURNAL_KINDS)
+    """
+
+    def __init__(self, directory, max_batch=200, flush_interval=5.0, max_file_size=4*1024*1024, max_files=50, fsync=True):
+        """Constructor:
+
+        Args:
+            directory (str): directory to keep the journal files in. Created if missing.
+            max_batch (int, optional): Write when this many events are waiting. Defaults to 200.
+            flush_interval (float, optional): Write waiting events at least this often in seconds. Defaults to 5.0.
+            max_file_size (int, optional): Start a new file when the current one is bigger in bytes. Defaults to 4 MiB.
+            max_files (int, optional): Number of files to keep. Defaults to 50.
+            fsync (bool, optional): fsync after every batch. Defaults to True.
+        """
+        self.directory = directory
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.max_file_size = max_file_size
+        self.max_files = max_files
+        self.fsync = fsync
+        self.dropped = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self._queue = Queue(maxsize=max_batch * 50)
+        self._file_path = None
+        self._writer = Thread(target=self._writer_thread, daemon=True)
+        self._writer.start()
+
+    def record(self, event):
+        """Add an event to the journal without blocking. Can be given directly to PickByLight.subscribe.
+
+        Args:
+            event (StateEvent): the event to record
+        """
+        record = {'t': event.timestamp.timestamp(),
+                  'kind': event.kind,
+                  'port': event.port_number,
+                  'data': event.data}
+        try:
+            self._queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+            logger.warning('journal queue is full. Dropped {} event on port {}'.format(event.kind, event.port_number))
+
+    def flush(self):
+        """Ask the writer to write all waiting events now"""
+        try:
+            self._queue.put_nowait(_FLUSH)
+        except Full:
+            # the writer is busy writing full batches anyway
+            pass
+
+    def close(self, timeout=5.0):
+        """Write all waiting events and stop the writer
+
+        Args:
+            timeout (float, optional): Max time to wait for the writer in seconds. Defaults to 5.0.
+        """
+        try:
+            self._queue.put(_CLOSE, timeout=timeout)
+        except Full:
+            logger.warning('journal writer did not keep up. Waiting events are lost')
+            return
+        self._writer.join(timeout)
+
+    def read(self, start=None, end=None, port_number=None, kinds=None):
+        """Read events from the journal, oldest first. Events still waiting to be written are not included.
+
+        Args:
+            start (datetime, optional): Only events at or after this time. Defaults to None.
+            end (datetime, optional): Only events before this time. Defaults to None.
+            port_number (int, optional): Only events about this port. Defaults to None.
+            kinds (iterable, optional): Only these kinds of events. Defaults to None.
+
+        Yields:
+            dict: {'t': datetime, 'kind': str, 'port': port number, 'data': any}
+        """
+        start_t = start.timestamp() if start is not None else None
+        end_t = end.timestamp() if end is not None else None
+        kinds = set(kinds) if kinds is not None else None
+
+        files = self._files()
+        file_starts = [self._file_start(name) for name in files]
+        first = 0
+        if start_t is not None:
+            # the last file starting before the range may still hold events in the range
+            first = max(bisect_right(file_starts, start_t - ORDER_TOLERANCE) - 1, 0)
+
+        for i in range(first, len(files)):
+            if end_t is not None and file_starts[i] >= end_t + ORDER_TOLERANCE:
+                break
+            path = os.path.join(self.directory, files[i])
+            for record in self._read_file(path, start_t, end_t):
+                if port_number is not None and record['port'] != port_number:
+                    continue
+                if kinds is not None and record['kind'] not in kinds:
+                    continue
+                record['t'] = datetime.fromtimestamp(record['t'])
+                yield record
+
+    def _read_file(self, path, start_t, end_t):
+        """Read the records of a single journal file in a time range, using its index to skip ahead"""
+        offset = 0
+        if start_t is not None:
+            batches = self._read_index(path + INDEX_SUFFIX)
+            # skip the batches that ended before the range starts
+            i = bisect_right([t for t, _ in batches], start_t - ORDER_TOLERANCE) - 1
+            if i > 0:
+                offset = batches[i][1]
+        try:
+            with open(path, 'r') as journal_file:
+                journal_file.seek(offset)
+                for line in journal_file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # a partly written line after a power cut
+                        continue
+                    if start_t is not None and record['t'] < start_t:
+                        continue
+                    if end_t is not None and record['t'] >= end_t:
+                        # the next records can still be in the range if they are a little out of order
+                        if record['t'] >= end_t + ORDER_TOLERANCE:
+                            return
+                        continue
+                    yield record
+        except FileNotFoundError:
+            # deleted by rotation while reading
+            return
+
+    def _read_index(self, index_path):
+        batches = []
+        try:
+            with open(index_path, 'r') as index_file:
+                for line in index_file:
+                    try:
+                        t, offset = line.split()
+                        batches.append((float(t), int(offset)))
+                    except ValueError:
+                        continue
+        except FileNotFoundError:
+            pass
+        return batches
+
+    def _files(self):
+        """Journal file names, oldest first"""
+        return sorted(name for name in os.listdir(self.directory) if name.startswith(FILE_PREFIX) and name.endswith(FILE_SUFFIX))
+
+    def _file_start(self, name):
+        """Time of the first event in a journal file from its name"""
+        stamp = name[len(FILE_PREFIX):-len(FILE_SUFFIX)]
+        return datetime.strptime(stamp, '%Y%m%d-%H%M%S-%f').timestamp()
+
+    def _writer_thread(self):
+        """Thread function that collects events and writes them in batches"""
+        batch = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(deadline - monotonic(), 0)
+            try:
+                item = self._queue.get(timeout=timeout)
+            except Empty:
+                # the flush interval has passed
+                item = _FLUSH
+
+            if item is _FLUSH or item is _CLOSE:
+                flush = True
+            else:
+                batch.append(item)
+                if deadline is None:
+                    deadline = monotonic() + self.flush_interval
+                flush = len(batch) >= self.max_batch
+
+            if flush and batch:
+                try:
+                    self._write_batch(batch)
+                except OSError:
+                    logger.exception('could not write {} events to the journal'.format(len(batch)))
+                batch = []
+                deadline = None
+
+            if item is _CLOSE:
+                return
+
+    def _write_batch(self, batch):
+        """Write a batch of records with a single write and note it in the index"""
+        if self._file_path is None or os.path.getsize(self._file_path) >= self.max_file_size:
+            self._rotate(batch[0]['t'])
+
+        data = ''.join(json.dumps(record, default=str) + '\n' for record in batch)
+        with open(self._file_path, 'a') as journal_file:
+            offset = journal_file.tell()
+            journal_file.write(data)
+            journal_file.flush()
+            if self.fsync:
+                os.fsync(journal_file.fileno())
+        with open(self._file_path + INDEX_SUFFIX, 'a') as index_file:
+            index_file.write('{} {}\n'.format(batch[0]['t'], offset))
+
+    def _rotate(self, first_t):
+        """Start a new journal file and delete the oldest files"""
+        stamp = datetime.fromtimestamp(first_t).strftime('%Y%m%d-%H%M%S-%f')
+        self._file_path = os.path.join(self.directory, FILE_PREFIX + stamp + FILE_SUFFIX)
+        logger.info('writing journal to {}'.format(self._file_path))
+        files = self._files()
+        for name in files[:max(len(files) + 1 - self.max_files, 0)]:
+            for path in [os.path.join(self.directory, name), os.path.join(self.directory, name + INDEX_SUFFIX)]:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
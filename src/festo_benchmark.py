@@ -0,0 +1,196 @@
+#!/usr/bin/python3
+"""Benchmark of the festo order cycle against the PLC simulator.
+
+Runs the festo simulator, a FestoServer and a pick by light with dummy ports in this process. A simulated
+worker picks every port the orders select after a fixed pick time and finishes the work. With several
+stoppers their orders are placed at the same time and compete for the ports. The orders per
+minute and the latency of every phase of the order cycle are written as JSON so runs can be compared:
+
+    ack         the PLC raised the flag until the station took the order
+    select      the PLC raised the flag until the port was selected
+    pick        the port was selected until the work was finished, mostly the simulated pick time
+    hand_back   the work was finished until the PLC got the flag back
+    cycle       the PLC raised the flag until it got the flag back
+
+Example:
+    python3 festo_benchmark.py --count 100 --pick_time 0.2 -o results.json
+"""
+
+import argparse
+import json
+import logging
+import random
+import sys
+from threading import Timer, Lock
+from time import monotonic
+
+import event_bus
+import pick_by_light
+import racks
+from dummy_port import DummyPort
+from festo_simulator import FestoSimulator, load_orders, numbered_stoppers
+from station_festo_connect import FestoServer
+from ua_load_test import summary, version
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+PHASES = ('ack', 'select', 'pick', 'hand_back', 'cycle')
+
+
+class SimulatedWorker:
+    """Picks every selected port of a pick by light like a worker, then finishes the work"""
+
+    def __init__(self, pick_by_light, pick_time=0.5, jitter=0.0, seed=None):
+        """Constructor:
+
+        Args:
+            pick_by_light (PickByLight): the pick by light to work on
+            pick_time (float, optional): Seconds from a port being selected until it is picked. Defaults to 0.5.
+            jitter (float, optional): Max seconds added at random to the pick time. Defaults to 0.0.
+            seed (int, optional): seed of the random jitter. Defaults to None.
+        """
+        self._pbl = pick_by_light
+        self.pick_time = pick_time
+        self.jitter = jitter
+        self._random = random.Random(seed)
+        self._lock = Lock()
+        # [(port number, monotonic time selected, monotonic time finished or None)]
+        self.picks = []
+        self._pbl.subscribe(self._selected_callback, kinds=[event_bus.PORT_SELECTED])
+
+    def _selected_callback(self, event):
+        """Pick by light event callback. Runs in the event bus thread so the pick is made by a timer."""
+        with self._lock:
+            index = len(self.picks)
+            self.picks.append((event.port_number, monotonic(), None))
+        Timer(self.pick_time + self._random.uniform(0, self.jitter), self._pick, args=(index,)).start()
+
+    def _pick(self, index):
+        port_number, selected, finished = self.picks[index]
+        self._pbl.get_port(port_number).make_activity()
+        self._pbl.work_finished(port_number)
+        with self._lock:
+            self.picks[index] = (port_number, selected, monotonic())
+
+
+def phase_latencies(records, picks):
+    """Split the order cycles into phases
+
+    Args:
+        records (list): FestoSimulator.records
+        picks (list): SimulatedWorker.picks
+
+    Returns:
+        dict: {phase: [seconds]} of the orders that were selected and handed back, and the number of orders
+            that were handed back without selecting a port as 'not_selected'
+    """
+    latencies = {phase: [] for phase in PHASES}
+    not_selected = 0
+    unmatched = [pick for pick in picks if pick[2] is not None]
+    for record in sorted((record for record in records if 'timeout' not in record), key=lambda record: record['done']):
+        latencies['ack'].append(record['taken'] - record['raised'])
+        latencies['cycle'].append(record['done'] - record['raised'])
+        # the work of an order is finished right before it is handed back, also when several stoppers have orders
+        candidates = [pick for pick in unmatched if record['raised'] <= pick[1] and pick[2] <= record['done']]
+        if not candidates:
+            not_selected += 1
+            continue
+        pick = max(candidates, key=lambda pick: pick[2])
+        unmatched.remove(pick)
+        port_number, selected, finished = pick
+        latencies['select'].append(selected - record['raised'])
+        latencies['pick'].append(finished - selected)
+        latencies['hand_back'].append(record['done'] - finished)
+    return latencies, not_selected
+
+
+def run(options):
+    """Run a benchmark
+
+    Args:
+        options (dict): the command line options
+
+    Returns:
+        dict: the results
+    """
+    content_map = racks.load_yaml(options['content_map'])
+    ports = [DummyPort(port_number) for port_number in content_map]
+    # the contents are set without the file so no stock counts are saved next to it
+    pbl = pick_by_light.PickByLight(ports)
+    for port_number, content in content_map.items():
+        pbl.set_content(port_number, content)
+    worker = SimulatedWorker(pbl, options['pick_time'], options['jitter'], options['seed'])
+
+    orders = load_orders(options['orders']) if options['orders'] else None
+    stoppers = numbered_stoppers(options['stoppers'])
+    # an order can wait for the port of every other order before it is handed back
+    order_timeout = options['count'] * (options['pick_time'] + options['jitter']) + 30
+    simulator = FestoSimulator(options['plc_port'], orders, options['rate'], order_timeout=order_timeout,
+                               count=options['count'], seed=options['seed'], stoppers=stoppers)
+    festo = FestoServer(pbl, '127.0.0.1', options['plc_port'], publishing_interval=options['publishing_interval'],
+                        operations=options['operations'], stoppers=stoppers)
+    try:
+        # the first order waits until the station is connected
+        start = monotonic()
+        while not festo.connected:
+            if monotonic() - start > 30:
+                raise ConnectionError('the festo server did not connect to the simulator')
+            simulator.finished.wait(0.01)
+        logger.info('running {} orders on {} stoppers with a pick time of {}s'.format(options['count'], options['stoppers'], options['pick_time']))
+        start = monotonic()
+        simulator.start()
+        simulator.finished.wait()
+        duration = monotonic() - start
+        status = festo.status()
+    finally:
+        festo.stop()
+        simulator.stop()
+
+    records = simulator.records
+    latencies, not_selected = phase_latencies(records, worker.picks)
+    completed = len(latencies['cycle'])
+    timeouts = {}
+    for record in records:
+        if 'timeout' in record:
+            timeouts[record['timeout']] = timeouts.get(record['timeout'], 0) + 1
+    return {'version': version(),
+            'options': options,
+            'duration': round(duration, 3),
+            'orders': {'placed': len(records), 'completed': completed, 'not_selected': not_selected,
+                       'timeouts': timeouts, 'unknown_operations': status['unknown_operations']},
+            'orders_per_minute': round(completed / duration * 60, 2) if duration else None,
+            'phases': {phase: summary(latencies[phase], 0, duration) for phase in PHASES},
+            'reconnects': status['reconnects']}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark of the festo order cycle against the PLC simulator with dummy ports')
+    parser.add_argument("-n", "--count", help="number of orders. Default 50", type=int, default=50)
+    parser.add_argument("-S", "--stoppers", help="number of stoppers placing orders at the same time. Default 1", type=int, default=1)
+    parser.add_argument("-r", "--rate", help="orders per minute of every stopper. 0 is the next order as soon as the last is done. Default 0", type=float, default=0)
+    parser.add_argument("-t", "--pick_time", help="seconds the simulated worker takes to pick. Default 0.5", type=float, default=0.5)
+    parser.add_argument("-j", "--jitter", help="max seconds added at random to the pick time. Default 0", type=float, default=0)
+    parser.add_argument("-O", "--orders", help="yaml file with the order mix. Default one of each known operation", type=str)
+    parser.add_argument("-R", "--operations", help="the festo operation rules. Default festo_operations.yaml", type=str, default='festo_operations.yaml')
+    parser.add_argument("-C", "--content_map", help="content map of the dummy ports. Default content_map.yaml", type=str, default='content_map.yaml')
+    parser.add_argument("-i", "--publishing_interval", help="publishing interval of the flag subscription in ms. Default 20", type=float, default=20)
+    parser.add_argument("-p", "--plc_port", help="tcp port of the simulator. Default 4850", type=int, default=4850)
+    parser.add_argument("-s", "--seed", help="seed of the random order choices and jitter. Default 0", type=int, default=0)
+    parser.add_argument("-o", "--output", help="write the results to this file instead of stdout", type=str)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    # the pick by light and the simulator log every order, that would be measured as station load
+    pick_by_light.logger.setLevel(logging.WARNING)
+    logging.getLogger('festo_simulator').setLevel(logging.WARNING)
+
+    results = run(vars(args))
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(text + '\n')
+    else:
+        print(text)
+    orders = results['orders']
+    sys.exit(1 if orders['timeouts'] or orders['completed'] < orders['placed'] else 0)
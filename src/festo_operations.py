@@ -0,0 +1,186 @@
+from collections import Counter
+from threading import Thread
+from time import sleep
+import hashlib
+import os
+import re
+import yaml
+
+import logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.WARNING)
+
+
+class _Operation:
+    """The compiled rules of one operation number"""
+
+    def __init__(self):
+        # operation parameter -> (name, instructions)
+        self.parameters = {}
+        # [(operation parameter or None for any, compiled url matcher, (name, instructions))] in file order
+        self.patterns = []
+        # (name, instructions) when nothing else matches, or None
+        self.default = None
+
+
+def _url_matcher(url):
+    """Compile the url of a rule into a single matcher
+
+    Args:
+        url (str or list): a regular expression or a list of them that must all be found in the order description
+
+    Returns:
+        Pattern: matches an order description with Pattern.match
+    """
+    patterns = url if isinstance(url, list) else [url]
+    # a lookahead per pattern finds them in any order in one pass of the regex engine
+    return re.compile(''.join('(?=.*?{})'.format(pattern) for pattern in patterns), re.DOTALL)
+
+
+def compile_rules(rules):
+    """Compile the operation rules of a rules file. Bad rules are logged and left out.
+
+    Args:
+        rules (dict): {operation number: [{'parameter': int, 'url': str or list, 'name': str, 'instructions': str}]}
+
+    Returns:
+        dict: {operation number: _Operation}
+    """
+    operations = {}
+    for op_number, op_rules in (rules or {}).items():
+        try:
+            op_number = int(op_number)
+        except (TypeError, ValueError):
+            logger.error('operation number {} in the operation rules is not a number'.format(op_number))
+            continue
+        operation = operations.setdefault(op_number, _Operation())
+        for rule in op_rules or []:
+            if not isinstance(rule, dict) or not rule.get('name'):
+                logger.error('rule {} of operation {} has no name'.format(rule, op_number))
+                continue
+            result = (str(rule['name']), str(rule.get('instructions', '')))
+            parameter = rule.get('parameter')
+            if 'url' in rule:
+                try:
+                    operation.patterns.append((parameter, _url_matcher(rule['url']), result))
+                except re.error as e:
+                    logger.error('bad url {} in a rule of operation {}. Error = {}'.format(rule['url'], op_number, e))
+            elif parameter is not None:
+                operation.parameters.setdefault(parameter, result)
+            elif operation.default is None:
+                operation.default = result
+    return operations
+
+
+class OperationTable:
+    """Translates the operations the festo PLC orders into the content to select, by the rules in a yaml file.
+
+    The rules are compiled when the file is loaded into a dict of operation numbers with the rules keyed by
+    the operation parameter and the urls compiled to regular expressions, so a translation is a dict lookup.
+    The file is polled and reloaded when its hash changed. A file that can't be parsed keeps the current rules.
+
+    Operations that no rule matches are counted.
+    """
+
+    def __init__(self, path='festo_operations.yaml', interval=1.0):
+        """Constructor:
+
+        Args:
+            path (str, optional): the rules file. Relative paths are tried from the working directory and then from this directory.
+                Defaults to 'festo_operations.yaml'.
+            interval (float, optional): Seconds between checks of the rules file. None means never reload. Defaults to 1.0.
+        """
+        if not os.path.isfile(path):
+            path = os.path.join(os.path.abspath(os.path.dirname(__file__)), path)
+        self.path = path
+        self.interval = interval
+        self._stat = None
+        self._hash = None
+        self._operations = {}
+        self.unknown = 0
+        # operation number -> number of times no rule matched
+        self.unknown_operations = Counter()
+        if self.check() is None:
+            logger.error('could not load the festo operation rules from {}. No operations will be translated'.format(path))
+        if interval is not None:
+            Thread(target=self._poll_thread, daemon=True).start()
+
+    def translate(self, op_number, order_url, operation_par=None):
+        """Translate an operation
+
+        Args:
+            op_number (int): operation number
+            order_url (str): order description
+            operation_par (int, optional): operation parameter. Defaults to None.
+
+        Returns:
+            tuple: (name, instructions) of the content or None if no rule matches
+        """
+        op_number = int(op_number)
+        operation = self._operations.get(op_number)
+        result = None
+        if operation is not None:
+            try:
+                result = operation.parameters.get(operation_par)
+            except TypeError:
+                # an unhashable parameter, like an array, matches no parameter rule
+                pass
+            if result is None:
+                for parameter, matcher, pattern_result in operation.patterns:
+                    if (parameter is None or parameter == operation_par) and matcher.match(order_url or ''):
+                        result = pattern_result
+                        break
+                else:
+                    result = operation.default
+        if result is None:
+            self.unknown += 1
+            self.unknown_operations[op_number] += 1
+        return result
+
+    def uses_parameter(self, op_number):
+        """Returns:
+            bool: True if a rule of the operation matches on the operation parameter
+        """
+        operation = self._operations.get(int(op_number))
+        return operation is not None and (bool(operation.parameters) or any(p is not None for p, m, r in operation.patterns))
+
+    def check(self):
+        """Check the rules file once and load it if it changed
+
+        Returns:
+            dict: the compiled rules as {operation number: _Operation} or None if nothing changed
+        """
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            # the file is being replaced, try again later
+            return None
+        if (stat.st_mtime_ns, stat.st_size) == self._stat:
+            return None
+        self._stat = (stat.st_mtime_ns, stat.st_size)
+
+        with open(self.path, 'rb') as rules_file:
+            data = rules_file.read()
+        digest = hashlib.sha1(data).hexdigest()
+        if digest == self._hash:
+            return None
+
+        try:
+            rules = yaml.safe_load(data)
+        except yaml.YAMLError as e:
+            logger.error('could not parse the festo operation rules {}. Keeping the current rules. Error = {}'.format(self.path, e))
+            return None
+        self._hash = digest
+        # replaced in one assignment so a translation never sees half the rules
+        self._operations = compile_rules(rules)
+        logger.info('loaded the festo operation rules {} for operations {}'.format(self.path, sorted(self._operations)))
+        return self._operations
+
+    def _poll_thread(self):
+        """Thread function that polls the rules file"""
+        while True:
+            sleep(self.interval)
+            try:
+                self.check()
+            except Exception:
+                logger.exception('failed to reload the festo operation rules')
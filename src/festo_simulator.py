@@ -0,0 +1,282 @@
+#!/usr/bin/python3
+"""Simulator of the festo PLC for testing the festo connection without the production line.
+
+Serves the flag, operation number, order description and operation parameter nodes of the stoppers of the
+CECC-LK controller on a local UA server and places orders with the same handshake as the PLC: the order
+parameters are written and the flag is raised to 1, the station takes the order by writing 2 and hands
+it back by writing 3, then the flag is lowered to 0 until the next order. Every stopper places its orders
+independently of the others.
+
+Example:
+    python3 festo_simulator.py --port 4850 --rate 6 --orders orders.yaml
+    python3 main.py -d -f -i 127.0.0.1 -P 4850
+"""
+
+import argparse
+import random
+from threading import Thread, Event, Lock
+from time import monotonic
+
+from opcua import Server, ua
+
+import racks
+from station_festo_connect import DEFAULT_STOPPER, STOPPER_NODES, FLAG_ORDER, FLAG_WORKING, FLAG_DONE
+
+import logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# flag value while no order is waiting
+FLAG_IDLE = 0
+
+# The orders of the production line, one of each operation in festo_operations.yaml.
+#   op: operation number, url: order description, parameter: operation parameter, weight: how often relative to the others
+DEFAULT_ORDERS = [{'op': 801, 'parameter': 0}, {'op': 801, 'parameter': 1}, {'op': 801, 'parameter': 2},
+                  {'op': 802}, {'op': 803}, {'op': 804},
+                  {'op': 510, 'url': 'Repair/FuseLeft'}, {'op': 510, 'url': 'Repair/FuseRight'},
+                  {'op': 510, 'url': 'Repair/BothFuses'}, {'op': 510, 'url': 'Repair/NoFuse'},
+                  {'op': 510, 'url': 'Assemble/BlueTopCover'}, {'op': 510, 'url': 'Assemble/WhiteTopCover'}]
+
+# variant type of every stopper node
+NODE_TYPES = {'flag': (FLAG_IDLE, ua.VariantType.Int16), 'operation_number': (0, ua.VariantType.UInt16),
+              'order_description': ('', ua.VariantType.String), 'operation_parameter': (0, ua.VariantType.UInt16)}
+
+
+def numbered_stoppers(count):
+    """Make the node ids of a number of stoppers for the simulator. The first is DEFAULT_STOPPER,
+    the others are numbered like it. They are made up, the PLC of the line may name them differently.
+
+    Args:
+        count (int): number of stoppers
+
+    Returns:
+        list: stoppers as dicts with a name and the node ids in STOPPER_NODES
+    """
+    stoppers = [DEFAULT_STOPPER]
+    for number in range(2, count + 1):
+        stopper = {'name': 'stpStopper{}'.format(number)}
+        for key in STOPPER_NODES:
+            nodeid = DEFAULT_STOPPER[key]
+            if 'stpStopper1' in nodeid:
+                stopper[key] = nodeid.replace('stpStopper1', stopper['name'])
+            else:
+                stopper[key] = '{}_{}'.format(nodeid, number)
+        stoppers.append(stopper)
+    return stoppers
+
+
+class FestoSimulator:
+    """Local UA server that acts like the festo PLC and places orders at a fixed rate on every stopper.
+
+    Every order is recorded with the stopper and the monotonic times of its handshake so the latency of the station
+    can be measured: 'raised' when the flag went to 1, 'taken' when the station wrote 2 and 'done' when it wrote 3.
+    An order the station does not take or hand back in time is recorded with 'timeout' set and the flag is lowered.
+    """
+
+    def __init__(self, port=4850, orders=None, rate=0, ack_timeout=5.0, order_timeout=60.0, count=None, seed=None, stoppers=None):
+        """Constructor: Starts the UA server. Call start to place orders.
+
+        Args:
+            port (int, optional): tcp port of the UA server. Defaults to 4850.
+            orders (list, optional): the orders to choose from as dicts with op, url, parameter and weight. Defaults to DEFAULT_ORDERS.
+            rate (float, optional): orders per minute of every stopper. 0 places the next order as soon as the last is done. Defaults to 0.
+            ack_timeout (float, optional): Seconds the station has to take an order. Defaults to 5.0.
+            order_timeout (float, optional): Seconds the station has to hand back an order it took. Defaults to 60.0.
+            count (int, optional): Number of orders to place on all stoppers together. Defaults to None meaning until stopped.
+            seed (int, optional): seed of the random order choices so runs are repeatable. Defaults to None.
+            stoppers (list, optional): the stoppers as dicts with a name and the node ids in STOPPER_NODES. Defaults to [DEFAULT_STOPPER].
+        """
+        self.orders = [dict({'url': '', 'parameter': 0, 'weight': 1}, **order) for order in (orders or DEFAULT_ORDERS)]
+        self.rate = rate
+        self.ack_timeout = ack_timeout
+        self.order_timeout = order_timeout
+        self.count = count
+        self._random = random.Random(seed)
+        # the placed orders as dicts: the order, stopper, sequence number and the handshake times
+        self.records = []
+        self.finished = Event()
+        self._stop = Event()
+        self._lock = Lock()
+        self._sequence = 0
+        self._running = 0
+
+        self.server = Server()
+        self.server.set_endpoint('opc.tcp://0.0.0.0:{}'.format(port))
+        self.server.set_server_name('Festo PLC simulator')
+        self.server.register_namespace('CECC-LK')
+        plc = self.server.get_objects_node().add_object('ns=2;s=|var|CECC-LK.Application', 'Application')
+        self.stoppers = [SimulatedStopper(self, plc, stopper) for stopper in stoppers or [DEFAULT_STOPPER]]
+        self.server.start()
+        for stopper in self.stoppers:
+            # called by the address space on every write of the flag, also the writes of the station
+            self.server.iserver.aspace.add_datachange_callback(stopper.nodes['flag'].nodeid, ua.AttributeIds.Value, stopper.flag_callback)
+
+    def start(self):
+        """Start placing orders"""
+        self._running = len(self.stoppers)
+        for stopper in self.stoppers:
+            Thread(target=stopper.order_thread, daemon=True).start()
+
+    def stop(self):
+        """Stop placing orders and stop the UA server"""
+        self._stop.set()
+        for stopper in self.stoppers:
+            stopper.flag_changed.set()
+        self.server.stop()
+
+    def next_order(self):
+        """Choose the next order to place
+
+        Returns:
+            dict: the record of the order or None if all orders are placed
+        """
+        with self._lock:
+            if self._stop.is_set() or (self.count is not None and self._sequence >= self.count):
+                return None
+            order = self._random.choices(self.orders, [order['weight'] for order in self.orders])[0]
+            record = {'sequence': self._sequence, 'op': order['op'], 'url': order['url'], 'parameter': order['parameter']}
+            self._sequence += 1
+            return record
+
+    def stopper_finished(self):
+        """Called by a stopper that placed its last order"""
+        with self._lock:
+            self._running -= 1
+            if self._running == 0:
+                self.finished.set()
+
+
+class SimulatedStopper:
+    """The order nodes and the order handshake of one stopper of the simulator"""
+
+    def __init__(self, simulator, parent, stopper):
+        """Constructor:
+
+        Args:
+            simulator (FestoSimulator): the simulator
+            parent (Node): the node to add the order nodes to
+            stopper (dict): name of the stopper and the node ids in STOPPER_NODES
+        """
+        self._simulator = simulator
+        self.name = stopper['name']
+        self.nodes = {}
+        for key in STOPPER_NODES:
+            value, varianttype = NODE_TYPES[key]
+            node = parent.add_variable(stopper[key], stopper[key].rsplit('.', 1)[-1], ua.Variant(value, varianttype))
+            node.set_writable()
+            self.nodes[key] = node
+        self.flag_changed = Event()
+        self._lock = Lock()
+        # flag value -> monotonic time it was first written during the current order
+        self._flag_times = {}
+
+    def flag_callback(self, handle, datavalue):
+        with self._lock:
+            self._flag_times.setdefault(datavalue.Value.Value, monotonic())
+        self.flag_changed.set()
+
+    def _wait_flag(self, value, timeout):
+        """Wait until the flag got a value during the current order
+
+        Returns:
+            float: monotonic time the flag got the value or None on timeout or stop
+        """
+        end = monotonic() + timeout
+        while not self._simulator._stop.is_set():
+            with self._lock:
+                if value in self._flag_times:
+                    return self._flag_times[value]
+                self.flag_changed.clear()
+            if not self.flag_changed.wait(max(end - monotonic(), 0)):
+                return None
+        return None
+
+    def _set(self, key, value):
+        self.nodes[key].set_value(ua.Variant(value, NODE_TYPES[key][1]))
+
+    def order_thread(self):
+        """Thread function that places the orders of the stopper one after another"""
+        simulator = self._simulator
+        next_at = monotonic()
+        while True:
+            if simulator.rate:
+                if simulator._stop.wait(max(next_at - monotonic(), 0)):
+                    break
+                next_at += 60 / simulator.rate
+            record = simulator.next_order()
+            if record is None:
+                break
+            record['stopper'] = self.name
+            try:
+                self._place_order(record)
+            except Exception:
+                if simulator._stop.is_set():
+                    break
+                logger.exception('failed to place order {}'.format(record))
+                record['timeout'] = 'error'
+            simulator.records.append(record)
+        simulator.stopper_finished()
+
+    def _place_order(self, record):
+        """Place one order and wait until the station hands it back"""
+        simulator = self._simulator
+        self._set('operation_number', record['op'])
+        self._set('order_description', record['url'])
+        self._set('operation_parameter', record['parameter'])
+        with self._lock:
+            self._flag_times = {}
+        record['raised'] = monotonic()
+        self._set('flag', FLAG_ORDER)
+
+        record['taken'] = self._wait_flag(FLAG_WORKING, simulator.ack_timeout)
+        if record['taken'] is None:
+            record['timeout'] = 'taken'
+            logger.warning('order {} on {} was not taken by the station'.format(record['sequence'], self.name))
+        else:
+            record['done'] = self._wait_flag(FLAG_DONE, simulator.order_timeout)
+            if record['done'] is None:
+                record['timeout'] = 'done'
+                logger.warning('order {} on {} was not handed back by the station'.format(record['sequence'], self.name))
+            else:
+                logger.info('order {} {} {} {} on {} done in {:.3f}s'.format(record['sequence'], record['op'], record['parameter'],
+                                                                            record['url'], self.name, record['done'] - record['raised']))
+        if not simulator._stop.is_set():
+            # a timed out order is taken back by lowering the flag, like the PLC does
+            self._set('flag', FLAG_IDLE)
+
+
+def load_orders(path):
+    """Load an order mix from a yaml file with a list of orders like DEFAULT_ORDERS
+
+    Args:
+        path (str): path to the yaml file
+
+    Returns:
+        list: the orders
+    """
+    orders = racks.load_yaml(path)
+    if not isinstance(orders, list) or not all(isinstance(order, dict) and 'op' in order for order in orders):
+        raise ValueError('{} must be a list of orders with at least an op'.format(path))
+    return orders
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Simulator of the festo PLC that places orders on a local UA server')
+    parser.add_argument("-p", "--port", help="tcp port of the UA server. Default 4850", type=int, default=4850)
+    parser.add_argument("-o", "--orders", help="yaml file with the order mix. Default one of each known operation", type=str)
+    parser.add_argument("-r", "--rate", help="orders per minute of every stopper. 0 is as fast as the station takes them. Default 6", type=float, default=6)
+    parser.add_argument("-n", "--count", help="number of orders to place. Default until interrupted", type=int)
+    parser.add_argument("-S", "--stoppers", help="number of stoppers placing orders. Default 1", type=int, default=1)
+    parser.add_argument("-s", "--seed", help="seed of the random order choices", type=int)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    simulator = FestoSimulator(args.port, load_orders(args.orders) if args.orders else None, args.rate, count=args.count, seed=args.seed,
+                               stoppers=numbered_stoppers(args.stoppers))
+    simulator.start()
+    try:
+        simulator.finished.wait()
+    except KeyboardInterrupt:
+        print('interrupted!')
+    finally:
+        simulator.stop()
@@ -1,8 +1,8 @@
 import PySimpleGUI as sg
-import re
 import os
 from PIL import Image, ImageTk
 import io
+import event_bus
 """
     Gui for pick by light 
 """
@@ -42,6 +42,9 @@ def from_rgb(rgb):
     return '#' + ''.join('%02x'%i for i in rgb) 
 
 
+# Event key used to hand pick by light state changes over to the gui thread
+PBL_EVENT = '-PBLEVENT-'
+
 default_image = 'img/default-placeholder.png'
 def check_image(path):
     """checks if the giver path points to a file and if not 
@@ -84,30 +87,47 @@ class Gui:
         self.window_virtual = None
 
         self.screen_bump = False
+        self._state_version = None
 
         sg.theme('Dark Blue 3')  # please make your windows colorful
+        self._pbl.subscribe(self._pbl_event_callback)
+
+    def _pbl_event_callback(self, pbl_event):
+        """Pick by light event callback. Runs in the event dispatcher thread so it only 
+        passes the event on to the gui event loop. Light changes are only needed while 
+        the virtual window is open."""
+        if pbl_event.kind == event_bus.LIGHT_CHANGED and self.window_virtual is None:
+            return
+        self.window_main.write_event_value(PBL_EVENT, pbl_event)
 
     def _make_win_virtual(self):
         layout = [[sg.Text('Select, Port, Activity, Light')],
                   [sg.Text('Select with the chek boxes and make\nactivity by pressing the blue dots.')]
                  ]
+        rows = []
         for port_number, port in self._pbl.get_ports():
             row = [sg.Check(text = None, key='_C{}_'.format(port_number), enable_events=True, size=(2,1), auto_size_text=True,),
                    sg.Text('Port {}'.format(port_number), size=(10,1), font=('Helvetica', 14),justification='left'), 
                    LEDIndicator('_A{}_'.format(port_number),radius=10), 
                    LEDIndicator('_LED{}_'.format(port_number),radius=10),
                 ]
-            layout.append(row)
+            rows.append(row)
+
+        # Scroll when there are more ports than fit on the screen
+        if len(rows) > 8:
+            layout.append([sg.Column(rows, scrollable=True, vertical_scroll_only=True, size=(None, 300))])
+        else:
+            layout.extend(rows)
       
         layout.append([sg.Button('Close',key='EXITVIRTUAL')])
 
         return sg.Window('Virtual', layout, finalize=True, keep_on_top=True)
 
     def _make_win_main(self):
-        content_strings = [' {}: {}'.format(port, value) for port, value in self._pbl.get_all_contents_display_name().items()]
+        content_strings = self._content_strings()
         
         content = [[sg.Text('Content', font=('Helvetica', 14))],
-                   [sg.Listbox(values=content_strings, size=(30,8), no_scrollbar=True, key='CONTENTMAPLISTBOX', enable_events=True,font=('Helvetica', 14))],
+                   [sg.Listbox(values=content_strings, size=(30,8), no_scrollbar=len(content_strings) <= 8, key='CONTENTMAPLISTBOX', enable_events=True,font=('Helvetica', 14))],
                    [sg.Button('Change/Update item', key='CHANGECONTENTITEM',size=(30,1), font=('Helvetica', 14))],
                    [sg.Button('Load content map', key='LOADCONTENTMAP',size=(30,1), font=('Helvetica', 14))],
                    [sg.Button('Save content map', key='SAVECONTENTMAP',size=(30,1), font=('Helvetica', 14))]]
@@ -127,8 +147,8 @@ class Gui:
                  ]
         return sg.Window('AAU SMART MANUAL STATION', layout, finalize=True ,size=(800,480), keep_on_top=False)
 
-    def _make_win_work(self, port_number, instructions):
-        text_instructions = 'Instructions: {}'.format(instructions)
+    def _make_win_work(self, port_number, instructions, amount=1):
+        text_instructions = 'Amount: {}\nInstructions: {}'.format(amount, instructions)
         content = self._pbl.get_content(port_number)
         image_path = check_image(content.get('image_path',''))
         content_image = get_img_data(image_path, maxsize= (250,250))
@@ -167,9 +187,13 @@ class Gui:
         check = window[key]
         check.Update(value=value)
 
+    def _content_strings(self):
+        """Makes the lines of the content list. One line per port, also for ports without content"""
+        return [' {}: {}'.format(port_number, self._pbl.get_content(port_number).get('display_name','?')) for port_number, port in self._pbl.get_ports()]
+
     def _update_content_listbox(self):
         """Updates the content list on the main window"""
-        content_strings = [' {}: {}'.format(port, value) for port, value in self._pbl.get_all_contents_display_name().items()]
+        content_strings = self._content_strings()
         listbox = self.window_main.find_element('CONTENTMAPLISTBOX')
         listbox.Update(values=content_strings)
 
@@ -177,9 +201,11 @@ class Gui:
         """Blocking call that runs the GUI until it exits. 
         """
         while True:             # Event Loop
-            window, event, values = sg.read_all_windows(timeout=100)
+            # State changes from the pick by light arrive as PBL_EVENT. The timeout is only 
+            # needed to notice when the activity cooldown of a port runs out.
+            window, event, values = sg.read_all_windows(timeout=1000)
 
-            if event != '__TIMEOUT__':
+            if event not in ['__TIMEOUT__', PBL_EVENT]:
                 logger.debug(window, event, values)
 
             if event == sg.WIN_CLOSED or event in ['EXIT', 'EXITVIRTUAL']:
@@ -213,7 +239,7 @@ class Gui:
 
             elif event == 'CHANGECONTENTITEM':
                 try:    
-                    port_number = int(re.search('[0-9]+', values['CONTENTMAPLISTBOX'][0]).group())
+                    port_number = self._pbl.find_port_number(values['CONTENTMAPLISTBOX'][0].split(':', 1)[0])
                     window = self._make_win_change_content(port_number)
                     event, values = window.read()
                     window.close()
@@ -237,23 +263,35 @@ class Gui:
                 sg.popup(description, keep_on_top=True)
                 
 
-            elif '_A' in event and self.window_virtual is not None:
-                result = re.findall(r'\d+',event)
-                port_number = int(result[0])
+            elif event.startswith('_A') and self.window_virtual is not None:
+                # key is '_A{port_number}_'
+                port_number = self._pbl.find_port_number(event[2:-1])
                 tmp_port = self._pbl.get_port(port_number)
                 if tmp_port is not None:
                     tmp_port.make_activity()
             
-            elif '_C' in event and self.window_virtual is not None:
-                result = re.findall(r'\d+',event)
-                port_number = int(result[0])
+            elif event.startswith('_C') and self.window_virtual is not None:
+                # key is '_C{port_number}_'
+                port_number = self._pbl.find_port_number(event[2:-1])
                 if values[event]:
                     self._pbl.select_port(port_number)
                 else:
                     self._pbl.deselect_port(port_number) 
                     self.windows_work[port_number] = None
             
+            if event not in [PBL_EVENT, '__TIMEOUT__', 'OPENVIRTUAL']:
+                continue
+            pbl_event = values[PBL_EVENT] if event == PBL_EVENT else None
+
             ###### update the virtual pick by light window if it is open
+            if self.window_virtual is not None and pbl_event is not None and pbl_event.kind == event_bus.LIGHT_CHANGED:
+                light = [int(i * pbl_event.data / 100) for i in [255,255,255]]
+                self._set_virtual_led(self.window_virtual, '_LED{}_'.format(pbl_event.port_number), light)
+                continue
+
+            if pbl_event is not None and pbl_event.kind == event_bus.CONTENT_CHANGED and 'display_name' in pbl_event.data:
+                self._update_content_listbox()
+
             if self.window_virtual is not None: # update the values 
                 for port_number, port in self._pbl.get_ports():
                     self._set_virtual_led(self.window_virtual, '_A{}_'.format(port_number), 'green' if port.activity else 'cyan')
@@ -261,15 +299,17 @@ class Gui:
                     self._set_virtual_led(self.window_virtual, '_LED{}_'.format(port_number), light )
                     self._set_checkbox(self.window_virtual, '_C{}_'.format(port_number), self._pbl.get_port_state(port_number).selected)
         
-            ###### Check if something is selected, open the work window
-            ports_state = self._pbl.get_ports_state()
-            for port_number, state in ports_state.items():
-                if state.selected and self.windows_work[port_number] is None:
-                    self.windows_work[port_number] = self._make_win_work(port_number,state.select_instructions)
-                    self.windows_work[port_number]
+            ###### Check if something is selected, open the work window. Skipped if no port state changed.
+            state_version, ports_state = self._pbl.get_versioned_ports_state()
+            if state_version != self._state_version:
+                self._state_version = state_version
+                for port_number, state in ports_state.items():
+                    if state.selected and self.windows_work[port_number] is None:
+                        self.windows_work[port_number] = self._make_win_work(port_number,state.select_instructions,state.amount_to_pick)
 
 
             ##### make sure the screen is turned on when there is activity
             for port_number, port in self._pbl.get_ports():
                 if port.activity or port.get_light():
                     os.system("sudo xset s reset")
+                    break
@@ -0,0 +1,256 @@
+from port_backend import Port
+from typing import Dict
+from time import sleep, monotonic
+from threading import Thread, Lock, Event
+
+import logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.WARNING)
+
+
+def ramp(start, stop, steps):
+    """Make a linear ramp of light levels.
+
+    Args:
+        start (int): first light level in percent
+        stop (int): last light level in percent
+        steps (int): number of ticks the ramp lasts
+
+    Returns:
+        list: light levels, one per tick
+    """
+    if steps <= 1:
+        return [int(stop)]
+    return [int(round(start + (stop - start) * i / (steps - 1))) for i in range(steps)]
+
+
+def hold(level, steps):
+    """Make a constant light level lasting a number of ticks.
+
+    Args:
+        level (int): light level in percent
+        steps (int): number of ticks
+
+    Returns:
+        list: light levels, one per tick
+    """
+    return [int(level)] * max(int(steps), 0)
+
+
+def breathe_waveform(tick):
+    """Calm breathing used to show the worker that a port is selected.
+    Fade up in 0.5 s, stay lit for 3 s, fade down in 0.5 s and stay off for 0.2 s.
+
+    Args:
+        tick (float): tick length in seconds
+
+    Returns:
+        tuple: light levels, one per tick
+    """
+    n = lambda seconds: max(int(round(seconds / tick)), 1)
+    return tuple(ramp(0, 100, n(0.5)) + hold(100, n(3.0)) + ramp(100, 0, n(0.5)) + hold(0, n(0.2)))
+
+
+def blink_waveform(tick, blinks=5):
+    """Sharp blinking used to warn the worker about activity on a port that was not selected.
+    On for 0.1 s and off for 0.25 s, repeated a number of times.
+
+    Args:
+        tick (float): tick length in seconds
+        blinks (int, optional): number of blinks. Defaults to 5.
+
+    Returns:
+        tuple: light levels, one per tick
+    """
+    n = lambda seconds: max(int(round(seconds / tick)), 1)
+    return tuple((hold(100, n(0.1)) + hold(0, n(0.25))) * blinks)
+
+
+class LightAnimator:
+    """Drives the lights of all the ports from a single thread.
+
+    Every port can play one pattern at a time. A pattern is a precomputed table of light levels
+    with one entry per tick. The animator steps all playing patterns once per tick and only writes
+    the light of a port when its light level actually changes. The changed lights are written with
+    one set_lights call per port backend and tick. When nothing is playing the thread sleeps until
+    a pattern is started.
+    """
+
+    def __init__(self, ports: Dict[int, Port], tick=0.02, on_change=None):
+        """Constructor:
+
+        Args:
+            ports (Dict[int, Port]): Port objects indexed by port number
+            tick (float, optional): Tick length in seconds. Defaults to 0.02.
+            on_change (function(int, int), optional): Called with port number and light level 
+                every time a light level is written. Defaults to None.
+        """
+        self.tick = tick
+        self._on_change = on_change
+        self._ports = ports
+        self._lock = Lock()
+        self._wake = Event()
+        self._tick_count = 0
+
+        # pattern name -> (table, loop)
+        self._patterns = {}
+        # port number -> (pattern name, tick the pattern started on)
+        self._playing = {}
+        # ports that must be turned off on the next tick
+        self._stopping = set()
+        # last light level written to each port
+        self._levels = {port_number: port.get_light() for port_number, port in ports.items()}
+
+        self.register_pattern('breathe', breathe_waveform(tick), loop=True)
+        self.register_pattern('warning', blink_waveform(tick), loop=False)
+
+        Thread(target=self._run, daemon=True).start()
+
+    def register_pattern(self, name, table, loop=True):
+        """Register a pattern that can be played on the ports.
+
+        Args:
+            name (str): name of the pattern
+            table (sequence): light levels in percent, one per tick
+            loop (bool, optional): Repeat the pattern until stopped. Defaults to True.
+
+        Raises:
+            ValueError: if the table is empty
+        """
+        if len(table) == 0:
+            raise ValueError('pattern {} must have at least one light level'.format(name))
+        with self._lock:
+            self._patterns[name] = (tuple(table), loop)
+
+    def play(self, port_number, pattern):
+        """Start playing a pattern on a port. Replaces any pattern already playing on the port.
+
+        Args:
+            port_number (int): port number to play the pattern on
+            pattern (str): name of a registered pattern
+
+        Returns:
+            bool: success
+        """
+        return self.play_many((port_number,), pattern)
+
+    def play_many(self, port_numbers, pattern):
+        """Start playing a pattern on several ports in step with each other.
+
+        Args:
+            port_numbers (iterable): port numbers to play the pattern on
+            pattern (str): name of a registered pattern
+
+        Returns:
+            bool: success. Nothing is played if a port or the pattern does not exist.
+        """
+        port_numbers = list(port_numbers)
+        for port_number in port_numbers:
+            if port_number not in self._ports:
+                logger.error('port number {} does not exist'.format(port_number))
+                return False
+        with self._lock:
+            if pattern not in self._patterns:
+                logger.error('light pattern {} does not exist'.format(pattern))
+                return False
+            for port_number in port_numbers:
+                self._stopping.discard(port_number)
+                self._playing[port_number] = (pattern, self._tick_count)
+        self._wake.set()
+        return True
+
+    def stop(self, port_number):
+        """Stop the pattern playing on a port and turn off its light.
+
+        Args:
+            port_number (int): port number to stop
+        """
+        with self._lock:
+            self._playing.pop(port_number, None)
+            self._stopping.add(port_number)
+        self._wake.set()
+
+    def get_pattern(self, port_number):
+        """Get the name of the pattern playing on a port
+
+        Args:
+            port_number (int): port number
+
+        Returns:
+            str: name of the pattern or None if nothing is playing
+        """
+        with self._lock:
+            playing = self._playing.get(port_number)
+        return playing[0] if playing else None
+
+    def _step(self):
+        """Compute the light level of all animated ports for the current tick.
+
+        Returns:
+            dict: light level indexed by port number
+        """
+        levels = {}
+        with self._lock:
+            for port_number in self._stopping:
+                levels[port_number] = 0
+            self._stopping.clear()
+
+            for port_number, (pattern, start) in list(self._playing.items()):
+                table, loop = self._patterns[pattern]
+                i = self._tick_count - start
+                if loop:
+                    levels[port_number] = table[i % len(table)]
+                elif i < len(table):
+                    levels[port_number] = table[i]
+                else:
+                    # one shot pattern is done, leave the light off.
+                    del self._playing[port_number]
+                    levels[port_number] = 0
+            self._tick_count += 1
+        return levels
+
+    def _idle(self):
+        with self._lock:
+            return not self._playing and not self._stopping
+
+    def _write(self, levels):
+        """Write light levels to the ports, in one call per backend
+
+        Args:
+            levels (dict): light level indexed by port number
+        """
+        batches = {}
+        for port_number, level in levels.items():
+            port = self._ports[port_number]
+            backend = getattr(port, 'backend', None)
+            if backend is None:
+                port.set_light(level)
+            else:
+                batches.setdefault(backend, {})[port] = level
+        for backend, batch in batches.items():
+            backend.set_lights(batch)
+
+    def _run(self):
+        """Thread function that steps the animations at a fixed tick."""
+        next_tick = monotonic()
+        while True:
+            self._wake.clear()
+            if self._idle():
+                self._wake.wait()
+                next_tick = monotonic()
+
+            changed = {port_number: level for port_number, level in self._step().items() if self._levels.get(port_number) != level}
+            if changed:
+                self._write(changed)
+                for port_number, level in changed.items():
+                    self._levels[port_number] = level
+                    if self._on_change is not None:
+                        self._on_change(port_number, level)
+
+            next_tick += self.tick
+            delay = next_tick - monotonic()
+            if delay > 0:
+                sleep(delay)
+            else:
+                # we are behind. Skip the missed ticks instead of rushing to catch up.
+                next_tick = monotonic()
@@ -5,6 +5,10 @@ import pick_by_light
 import gui
 import station_ua_server as suas
 import station_festo_connect as festo_connect
+import racks
+import port_backend
+import event_journal
+from content_watcher import ContentMapWatcher
 import coloredlogs, logging  
 import os
 
@@ -18,8 +22,16 @@ parser = argparse.ArgumentParser(
 parser.add_argument("-v", "--verbose", help="increase output verbosity", action="store_true")
 parser.add_argument("-d", "--dummy", help="run in dummy mode without the actual hardware", action="store_true")
 parser.add_argument("-C", "--content_map", help="path to the content map", type=str)
+parser.add_argument("-j", "--journal", help="directory to keep a journal of all pick events in", type=str)
+parser.add_argument("-r", "--rack_config", help="path to a rack configuration for stations with several racks", type=str)
+parser.add_argument("-a", "--async_ua", help="run the ua server on asyncio (needs the asyncua package)", action="store_true")
+parser.add_argument("-H", "--history", help="keep a history of status tags for ua history reads. Defaults to Selected, WorkFinished and Activity", nargs='*', metavar='TAG')
+parser.add_argument("-T", "--selection_timeout", help="seconds a port can stay selected before a ua selection timeout event is raised", type=float)
 parser.add_argument("-f", "--festo_connect", help="enable festo connect", action="store_true")
 parser.add_argument("-i", "--festo_connect_ip", help="ip address for festo connect", type=str)
+parser.add_argument("-P", "--festo_connect_port", help="ua port of the festo PLC. Defaults to 4840", type=str, default='4840')
+parser.add_argument("-S", "--festo_stoppers", help="path to the stoppers to take festo orders from. Defaults to stopper 1", type=str)
+parser.add_argument("-O", "--festo_operations", help="path to the rules that translate festo operations into content", type=str, default='festo_operations.yaml')
 
 # If verbose flag set the debugger level accordingly on all improted files 
 # TODO Setting the debug level seems to not work correctly.
@@ -30,38 +42,63 @@ if args.verbose:
     suas.logger.setLevel(logging.WARNING)
     gui.logger.setLevel(logging.DEBUG)
 
-# Load either the dummy ports or the pi ports depending on passed argument
-if args.dummy:
-    from dummy_port import DummyPort as Port
-    logger.warning("Running in dummy mode")
-else:
-    from pi_port import PiPort as Port
-    # load the default ports
-    Port.load_pinout_from_file(pin_conf_name = 'default_pin_config.yaml')
-
 # If a path string for a content map has been passed, save it, else set default.
 if args.content_map:
     content_map = args.content_map
 else:
     content_map = 'content_map.yaml'
 
+# Load either the dummy ports or the pi ports depending on passed argument
+if args.dummy:
+    logger.warning("Running in dummy mode")
+
+# the content map is read here only to find out which ports exist
+try:
+    content_map_ports = racks.load_yaml(content_map)
+except FileNotFoundError:
+    content_map_ports = {}
+
 
 if __name__ == "__main__":
-    # generate 6 ports 
-    ports = [Port(i) for i in range(1,7)]
+    if args.rack_config:
+        # generate the ports of all racks in the rack configuration
+        ports = racks.load_racks(args.rack_config, dummy=args.dummy, content_map=content_map_ports)
+    else:
+        # generate the ports found in the default pin configuration and the content map
+        backend = port_backend.get_backend('dummy' if args.dummy else 'pi')({'pin_config': 'default_pin_config.yaml'})
+        ports = backend.make_ports(backend.port_numbers(content_map_ports))
 
     # Create our pick by light object
     PBL = pick_by_light.PickByLight(ports, default_content_map_path=content_map)
 
+    # Apply changes to the content map file while running
+    WATCHER = ContentMapWatcher(PBL)
+
+    if args.journal:
+        # Record the pick by light events
+        JOURNAL = event_journal.EventJournal(args.journal)
+        PBL.subscribe(JOURNAL.record, kinds=event_journal.JOURNAL_KINDS)
+
+    # Status tags to keep a history of, if any, and when to raise selection timeout events
+    ua_options = {'selection_timeout': args.selection_timeout}
+    if args.history is not None:
+        ua_options['history_tags'] = args.history or suas.StationUABase.HISTORY_TAGS
+
     # Create our station ua serer, passing in our pick by light instance.
-    SUAS = suas.StationUAServer(PBL)
+    if args.async_ua:
+        from station_ua_server_async import AsyncStationUAServer
+        SUAS = AsyncStationUAServer(PBL, **ua_options)
+    else:
+        SUAS = suas.StationUAServer(PBL, **ua_options)
 
     # Create our gui interface, passing in our pick by light instance.
     GUI = gui.Gui(PBL)
 
     if args.festo_connect:
-        # Create festo connect object
-        FC = festo_connect.FestoServer(PBL,args.festo_connect_ip)
+        # Create festo connect object. It shows its connection status on the ua server.
+        stoppers = racks.load_yaml(args.festo_stoppers) if args.festo_stoppers else None
+        FC = festo_connect.FestoServer(PBL, args.festo_connect_ip, args.festo_connect_port, on_status=SUAS.publish_festo_status,
+                                       operations=args.festo_operations, stoppers=stoppers)
 
     try:
         # GUI.run blocks untill it exits
@@ -69,6 +106,12 @@ if __name__ == "__main__":
     except KeyboardInterrupt:
         print('interrupted!')
     finally:
-        # Finally stop the ua server
-        SUAS.ua_server.stop()
+        # Finally stop the festo connection and the ua server
+        if args.festo_connect:
+            FC.stop()
+        SUAS.stop()
+        # save the stock counts of the last picks
+        PBL.flush_stock()
+        if args.journal:
+            JOURNAL.close()
 
@@ -0,0 +1,191 @@
+from threading import Lock
+from time import sleep
+
+from port_backend import Port, PortBackend
+import racks
+
+import logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.WARNING)
+
+# PCA9685 registers
+MODE1 = 0x00
+MODE2 = 0x01
+LED0_ON_L = 0x06    # ON_L, ON_H, OFF_L and OFF_H of every channel follow from here
+PRESCALE = 0xFE
+# MODE1 bits
+RESTART = 0x80
+AUTO_INCREMENT = 0x20
+SLEEP = 0x10
+# MODE2 bits
+OUTDRV = 0x04       # totem pole outputs that drive the leds directly
+# bit 4 of ON_H or OFF_H turns a channel fully on or off
+FULL = 0x10
+
+CHANNELS = 16
+OSCILLATOR = 25000000
+
+
+def channel_registers(duty_cycle):
+    """Get the ON_L, ON_H, OFF_L and OFF_H registers of a channel for a light level
+
+    Args:
+        duty_cycle (float): brightness in percent
+
+    Returns:
+        list: the 4 register values
+    """
+    if duty_cycle >= 100:
+        return [0, FULL, 0, 0]
+    if duty_cycle <= 0:
+        return [0, 0, 0, FULL]
+    off = int(round(duty_cycle * 4095 / 100))
+    return [0, 0, off & 0xFF, off >> 8]
+
+
+class SMBusI2C:
+    """I2C bus of the smbus2 package"""
+
+    def __init__(self, bus=1):
+        """Constructor:
+
+        Args:
+            bus (int, optional): number of the I2C bus. Defaults to 1, the bus on the pins of the raspberry pi.
+        """
+        from smbus2 import SMBus, i2c_msg
+        self._bus = SMBus(bus)
+        self._i2c_msg = i2c_msg
+
+    def write_block(self, address, register, data):
+        """Write registers from register and up in one transaction"""
+        # write_i2c_block_data is limited to 32 bytes, a raw message is not
+        self._bus.i2c_rdwr(self._i2c_msg.write(address, [register] + list(data)))
+
+
+class FakeI2CBus:
+    """I2C bus without hardware. Keeps the registers of the devices in memory and counts the transactions,
+    so the PCA9685 backend can be tried and measured without the chip."""
+
+    def __init__(self):
+        # address -> bytearray with the 256 registers of the device
+        self.registers = {}
+        self.transactions = 0
+        self.bytes_written = 0
+
+    def write_block(self, address, register, data):
+        memory = self.registers.setdefault(address, bytearray(256))
+        memory[register:register + len(data)] = bytes(data)
+        self.transactions += 1
+        # the register address is sent too
+        self.bytes_written += len(data) + 1
+
+
+class PCA9685Port(Port):
+    """Port whose led is a channel of a PCA9685 PWM driver. The sensor is a gpio pin of the raspberry pi, if it has one."""
+
+    def __init__(self, port_number, backend, channel, pir_pin=None):
+        """Constructor:
+
+        Args:
+            port_number (int): the port number
+            backend (PCA9685Backend): the driver of the led
+            channel (int): channel of the led on the driver
+            pir_pin (int, optional): physical pin of the sensor. Defaults to None meaning no sensor.
+        """
+        super().__init__(port_number, backend)
+        self.channel = channel
+        if pir_pin is not None:
+            import RPi.GPIO as GPIO
+            GPIO.setmode(GPIO.BOARD)
+            GPIO.setup(pir_pin, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
+            GPIO.add_event_detect(pir_pin, GPIO.RISING, callback=self._activity_detected)
+
+    def _write_light(self, duty_cycle):
+        self.backend.write_channels({self.channel: duty_cycle})
+        return True
+
+
+class PCA9685Backend(PortBackend):
+    """Backend of a rack whose leds are driven by a PCA9685 16 channel I2C PWM driver.
+
+    The driver makes the PWM in hardware so dimming costs no cpu and does not flicker when the pi is busy.
+    set_lights writes the changed channels in one I2C transaction, so an animation tick is a single
+    write no matter how many lights change.
+
+    Rack configuration:
+        bus: number of the I2C bus, or fake for a bus without hardware. Defaults to 1.
+        address: I2C address of the driver. Defaults to 0x40.
+        frequency: PWM frequency in Hz. Defaults to 1000.
+        pin_config: file with the led_channel and optionally the pir_pin of every port.
+        ports: number of ports without sensors when there is no pin_config. Port n uses channel n - 1.
+    """
+
+    def __init__(self, conf=None, bus=None):
+        """Constructor:
+
+        Args:
+            conf (dict, optional): the configuration of the rack. Defaults to None.
+            bus (object, optional): the I2C bus with write_block(address, register, data). Defaults to None meaning made from conf.
+
+        Raises:
+            KeyError: If the ports or their channels are not configured
+        """
+        super().__init__(conf)
+        self.address = self.conf.get('address', 0x40)
+        if bus is None:
+            bus = FakeI2CBus() if self.conf.get('bus') == 'fake' else SMBusI2C(self.conf.get('bus', 1))
+        self.bus = bus
+        self._lock = Lock()
+        # the registers of every channel as last written
+        self._channels = [channel_registers(0) for channel in range(CHANNELS)]
+
+        if self.conf.get('pin_config'):
+            self._pin_config = racks.load_yaml(self.conf['pin_config'])
+        elif self.conf.get('ports'):
+            self._pin_config = {port_number: {'led_channel': port_number - 1} for port_number in range(1, self.conf['ports'] + 1)}
+        else:
+            raise KeyError('a pca9685 rack needs a pin_config or a number of ports')
+        for port_number, pins in self._pin_config.items():
+            if not 0 <= pins.get('led_channel', -1) < CHANNELS:
+                raise KeyError('port {} needs a led_channel between 0 and {}'.format(port_number, CHANNELS - 1))
+
+        self._setup(self.conf.get('frequency', 1000))
+
+    def _setup(self, frequency):
+        """Set the PWM frequency and turn all channels off"""
+        prescale = min(max(int(round(OSCILLATOR / (4096 * frequency))) - 1, 3), 255)
+        # the prescaler can only be set while the oscillator sleeps
+        self.bus.write_block(self.address, MODE1, [SLEEP | AUTO_INCREMENT])
+        self.bus.write_block(self.address, PRESCALE, [prescale])
+        self.bus.write_block(self.address, MODE2, [OUTDRV])
+        self.bus.write_block(self.address, MODE1, [AUTO_INCREMENT])
+        # the oscillator needs 500 us to start
+        sleep(0.0005)
+        self.bus.write_block(self.address, MODE1, [RESTART | AUTO_INCREMENT])
+        self.write_channels({channel: 0 for channel in range(CHANNELS)})
+
+    def port_numbers(self, content_map=None):
+        return racks.discover_port_numbers(self._pin_config, content_map)
+
+    def make_port(self, port_number):
+        pins = self._pin_config[port_number]
+        return PCA9685Port(port_number, self, pins['led_channel'], pins.get('pir_pin'))
+
+    def set_lights(self, levels):
+        self.write_channels({port.channel: port.keep_light(duty_cycle) for port, duty_cycle in levels.items()})
+
+    def write_channels(self, levels):
+        """Write the light levels of channels in one transaction. The channels between the changed ones are written
+        again with their current levels, which is cheaper than a transaction per channel.
+
+        Args:
+            levels (dict): {channel: brightness in percent}
+        """
+        if not levels:
+            return
+        with self._lock:
+            for channel, duty_cycle in levels.items():
+                self._channels[channel] = channel_registers(duty_cycle)
+            first, last = min(levels), max(levels)
+            data = [register for registers in self._channels[first:last + 1] for register in registers]
+            self.bus.write_block(self.address, LED0_ON_L + 4 * first, data)
@@ -1,38 +1,38 @@
 import logging
 import yaml
 import os
-from datetime import datetime, timedelta
 import RPi.GPIO as GPIO
 
+from port_backend import Port, PortBackend
+import racks
+
 logger = logging.getLogger(__name__) # Gives the root logger.  Change this for better organization
 logger.setLevel(logging.WARNING)
 
 GPIO.setmode(GPIO.BOARD)
 
 
-class PiPort:
+class PiPort(Port):
     """Raspberry pi port for the pick by light. Each port has a number and a sensor to detect activity. 
-    The port can signal with an LED to attract attention to the port. 
+    The port can signal with an LED to attract attention to the port. The LED is dimmed with software PWM.
     """
     __ports_config = {}
 
-    def __init__(self,port_number):
-        self.port_number = port_number
-        self.activity_timestamp = datetime.now() - timedelta(minutes=10) # default is an arbitrary time in the past. 
-        self.cooldown_time = timedelta(seconds=5)
+    def __init__(self, port_number, backend=None):
+        super().__init__(port_number, backend)
 
         # GPIO setup
         GPIO.setup(self._pir_pin, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
-        GPIO.setup(self._led_pin, GPIO.OUT)
 
-        self.activity_callback = None
-        self.light_pwm = GPIO.PWM(self._led_pin, 1000)
-        self.light_pwm.start(0)
-        self._light_duty_cycle = 0
+        self.light_pwm = None
+        # Ports without an led pin can still sense activity, they just can't signal. 
+        if self._led_pin is not None:
+            GPIO.setup(self._led_pin, GPIO.OUT)
+            self.light_pwm = GPIO.PWM(self._led_pin, 1000)
+            self.light_pwm.start(0)
 
         # Add interupt and callback function when there's a change on the pir pin. 
-        GPIO.add_event_detect(self._pir_pin, GPIO.RISING, callback=self._pir_callback)
-        pass
+        GPIO.add_event_detect(self._pir_pin, GPIO.RISING, callback=self._activity_detected)
    
     @classmethod    
     def load_pinout_from_file (cls, pin_conf_name):
@@ -91,60 +91,15 @@ class PiPort:
         """
         return cls.__ports_config
 
-    @property
-    def activity(self) -> bool:
-        """Property: True if there is activity on the port
-
-        Returns:
-            bool: True if there is activity on the port
-        """
-        return datetime.now() <= self.activity_timestamp + self.cooldown_time
-
-    @property
-    def time_since_activity(self):
-        return datetime.now() - self.activity_timestamp
-    
-    def set_light(self, duty_cycle):
-        """Set the light level of the led on the port. The lightlevel is in percent and should
-        between 0 and 100. Values outside this range is capped to either 0 or 100. No warning 
-        is generated  if value is outside range.
-
-        Args:
-            duty_cycle (float): brightness in percent.
-
-        Returns:
-            bool: success
-        """
-        # limit between 0 and 100
-        self._light_duty_cycle = max(min(duty_cycle, 100), 0)
-        return self.light_pwm.ChangeDutyCycle(self._light_duty_cycle)
-    
-    def get_light(self) -> int:
-        """Get the current light level
-
-        Returns:
-            int: lightlevel in percent
-        """
-        return self._light_duty_cycle  
+    def _write_light(self, duty_cycle):
+        if self.light_pwm is None:
+            return False
+        return self.light_pwm.ChangeDutyCycle(duty_cycle)
 
     def make_activity(self):
         """Simulate activity on the sensor pin"""
         logger.info('Made activity at port: {}'.format(self.port_number))
-        self._pir_callback()
-
-    def set_activity_callback(self, activity_callback):
-        """Set a callback for when there is activity on the port
-
-        Args:
-            Activity_callback (function(int: port_number)): The function to call when there is activity on the port. 
-            The callback will receive the port number.
-
-        Raises:
-            TypeError: callback is not a callable function
-        """
-        if not callable(activity_callback):
-            raise TypeError('activity_callback must be callable. You gave it type: {}'.format(type(activity_callback)))
-        self.activity_callback = activity_callback
+        self._activity_detected()
 
     @property
     def _led_pin(self):
@@ -166,16 +121,22 @@ class PiPort:
         port_conf = PiPort.__ports_config[self.port_number]
         return port_conf.get('pir_pin')
 
-    def _pir_callback(self,pin=None):
-        """Private calback when the sensor pin is pulled high.
-        This callback acts like a filter to bouncy signals.
 
-        Args:
-            pin (int): NOT USED: Physical sensor pin that pulled the signal high
-        """
-        # if 5 sec passed since last activity
-        if datetime.now() > self.activity_timestamp + self.cooldown_time:
-            print('Pir detected high at port %s' % self.port_number)
-            if self.activity_callback is not None:
-                self.activity_callback(self.port_number)    
-            self.activity_timestamp = datetime.now()
+class PiBackend(PortBackend):
+    """Backend of a rack on the gpio pins of the raspberry pi. Only one rack can use it.
+
+    Rack configuration:
+        pin_config: pin configuration file with the led_pin and pir_pin of every port. Defaults to default_pin_config.yaml.
+    """
+
+    exclusive = True
+
+    def __init__(self, conf=None):
+        super().__init__(conf)
+        PiPort.load_pinout_from_file(pin_conf_name=self.conf.get('pin_config', 'default_pin_config.yaml'))
+
+    def port_numbers(self, content_map=None):
+        return racks.discover_port_numbers(PiPort.get_ports_pinout(), content_map)
+
+    def make_port(self, port_number):
+        return PiPort(port_number, self)
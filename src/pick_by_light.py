@@ -1,44 +1,94 @@
-from dummy_port import DummyPort as Port
+from port_backend import Port
 from typing import List
+from collections import namedtuple
+from itertools import count
+from threading import RLock
+from time import monotonic
+from types import MappingProxyType
 import logging
-from time import sleep, time
-from threading import Thread
 import os
 import yaml
+from light_animator import LightAnimator
+from pick_stats import PickStats
+from background_saver import BackgroundSaver
+import event_bus
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
-class PortState:
+class PortState(namedtuple('PortState', ['port_number', 'selected', 'work_finished', 'amount_to_pick', 'select_instructions'])):
     """Descriptor for the state of a port.
+    The state is immutable so it can be handed to other threads without copying. 
+    PickByLight replaces the whole state of a port when it changes.
     """
-    # TODO this should just be a dict like the port configs and many other things in this project. 
-    # This is the odd one out.
-    def __init__(self,port_number):
-        self.port_number = port_number
-        self.selected = False
-        self.work_finished = False
-        self.amount_to_pick = 0
-        self.select_instructions = ''
+    __slots__ = ()
+
+    def __new__(cls, port_number, selected=False, work_finished=False, amount_to_pick=0, select_instructions=''):
+        return super().__new__(cls, port_number, selected, work_finished, amount_to_pick, select_instructions)
+
+
+def stock_path(content_map_path):
+    """Get the path of the file the stock counts of a content map are saved to
+
+    Args:
+        content_map_path (str): path of the content map
+
+    Returns:
+        str: the path of the stock file next to the content map
+    """
+    return os.path.splitext(content_map_path)[0] + '.stock.yaml'
+
+
+def _write_yaml(path, data):
+    """Write a yaml file through a temporary file so readers never see it half written"""
+    with open(path + '.tmp', 'w') as outfile:
+        yaml.dump(data, outfile, default_flow_style=False)
+    os.replace(path + '.tmp', path)
 
 
 class PickByLight:
     """Controller for a bunch of ports on a pick by light setup."""
 
-    def __init__(self,ports: List[Port], default_content_map_path = None):
+    # Policies for choosing between several ports holding the same content.
+    FIRST_FREE = 'first_free'
+    LEAST_RECENTLY_PICKED = 'least_recently_picked'
+    ROUND_ROBIN = 'round_robin'
+    CONTENT_POLICIES = (FIRST_FREE, LEAST_RECENTLY_PICKED, ROUND_ROBIN)
+
+    def __init__(self,ports: List[Port], default_content_map_path = None, content_policy = FIRST_FREE, low_stock = 0, stock_save_delay = 10.0):
         """Constructor:
 
         Args:
             ports (List[Port]): Hardware of type Port
             default_content_map_path (str, optional): Path to a default content map. Defaults to None.
+            content_policy (str, optional): How to choose between ports with the same content. Defaults to FIRST_FREE.
+            low_stock (int, optional): Stock at or below this is low, unless the content has its own 'low_stock'. Defaults to 0.
+            stock_save_delay (float, optional): Seconds to collect stock changes before saving the stock counts. Defaults to 10.0.
         """
         # create dict of all the port objects for the rack.
         self._ports = {port.port_number : port for port in ports}
+        # The port states are immutable and only replaced while holding the lock. Every change 
+        # bumps the version so readers can tell if anything changed since their last read. 
+        self._lock = RLock()
         self._ports_state = {port_number : PortState(port_number) for port_number in self._ports.keys()}
+        self._state_version = 0
+        self._state_snapshot = None
+        self._events = event_bus.EventBus()
         self._set_callbacks()
-        self._warning_signalers = []
-        self._signalers = []
+        self._animator = LightAnimator(self._ports, on_change=self._light_changed)
+        self._pick_stats = PickStats()
         self._content_map = {}
+        self._content_map_path = None
+        self._low_stock = low_stock
+        # port number -> stock of the port in the content map file the count started from
+        self._stock_loaded = {}
+        self._stock_saver = BackgroundSaver(self._save_stock, delay=stock_save_delay)
+        # content name -> list of port numbers holding that content
+        self._content_index = {}
+        self._last_picked = {port_number : 0.0 for port_number in self._ports.keys()}
+        self._round_robin = {}
+        self._content_policy = self.FIRST_FREE
+        self.set_content_policy(content_policy)
 
         if default_content_map_path:
             self._content_map = self.load_content_map(default_content_map_path)
@@ -65,33 +115,137 @@ class PickByLight:
             logger.error('Cannot pick negative or zero amount')
             return False
         
-        self._ports_state[port_number].selected = True
-        self._ports_state[port_number].work_finished = False
-        self._ports_state[port_number].amount_to_pick = amount
-        self._ports_state[port_number].select_instructions = instructions
-        Thread(target=self._signal_thread, args=(port_number,), daemon=True).start()
+        with self._lock:
+            self._set_selected({port_number: (amount, instructions)})
+            self._animator.play(port_number, 'breathe')
         return True
+
+    def select_batch(self, lines):
+        """Select a whole pick list at once. Every line is validated before anything is selected, 
+        so either all lines are selected or none of them are. The lights of all selected ports 
+        start signalling together.
+
+        Each line is a tuple of (target, amount, instructions) where target is either a port number 
+        or a content name (str). amount and instructions can be left out and default to 1 and ''.
+        Content names are resolved by the content policy and two lines never get the same port. 
+
+        Args:
+            lines (list): list of (target, amount, instructions) tuples
+
+        Returns:
+            bool: success. True if all lines were selected
+            list: per line result as (bool: line valid, int: port number or -1)
+        """
+        with self._lock:
+            defaults = (None, 1, '')
+            claimed = []
+            selections = []
+            results = []
+            for line in lines:
+                line = tuple(line)
+                target, amount, instructions = line + defaults[len(line):]
+
+                if target in self._ports.keys():
+                    port_number = target if target not in claimed else None
+                    if port_number is None:
+                        logger.error('port number {} is used twice in the batch'.format(target))
+                elif isinstance(target, str):
+                    port_number = self._choose_content_port(target, exclude=claimed)
+                    if port_number is None:
+                        logger.error('no free port with the content {}'.format(target))
+                else:
+                    logger.error('port number {} does not exist'.format(target))
+                    port_number = None
+
+                if port_number is not None and amount <= 0:
+                    logger.error('Cannot pick negative or zero amount')
+                    port_number = None
+
+                if port_number is None:
+                    results.append((False, -1))
+                else:
+                    claimed.append(port_number)
+                    selections.append((port_number, amount, instructions))
+                    results.append((True, port_number))
+
+            if len(selections) != len(results):
+                return False, results
+
+            self._set_selected({port_number: (amount, instructions) for port_number, amount, instructions in selections})
+            self._animator.play_many(claimed, 'breathe')
+            return True, results
     
-    def select_content(self, name, amount = 1, instructions = ''):
+    def select_content(self, name, amount = 1, instructions = '', exclude = ()):
         """Select a port from the content within it. Instructions can be sent
         along with the selection to instruct the worker on what to do. 
-        The first port with a matching content name will be selected.  
+        If several ports hold the content the port is chosen by the content policy.
 
         Args:
             name (string): name of the content to be selected
             amount (int, optional): Amount to pick. Defaults to 1.
             instructions (str, optional): Instructions to be displayed for the worker. Defaults to ''.
+            exclude (collection, optional): port numbers that must not be chosen, like ports reserved by someone else. Defaults to ().
 
         Returns:
             bool: success
             int: port number selected. returns -1 if not successful
         """
-        for port_number, content in self._content_map.items():
-            if content.get('name', None) == name:
-                success = self.select_port(port_number, amount, instructions)
-                return success, port_number
-        else:
-            return False, -1
+        with self._lock:
+            port_number = self._choose_content_port(name, exclude)
+            if port_number is None:
+                return False, -1
+            success = self.select_port(port_number, amount, instructions)
+        return success, port_number
+
+    def set_content_policy(self, policy):
+        """Set how a port is chosen when several ports hold the same content.
+
+        Args:
+            policy (str): One of FIRST_FREE, LEAST_RECENTLY_PICKED or ROUND_ROBIN
+
+        Raises:
+            ValueError: if the policy is unknown
+        """
+        if policy not in self.CONTENT_POLICIES:
+            raise ValueError('content policy must be one of {}. Instead received: {}'.format(self.CONTENT_POLICIES, policy))
+        self._content_policy = policy
+
+    def get_content_ports(self, name):
+        """Get all the ports holding content with the given name
+
+        Args:
+            name (str): name of the content
+
+        Returns:
+            list: port numbers in content map order
+        """
+        return list(self._content_index.get(name, ()))
+
+    def _choose_content_port(self, name, exclude=()):
+        """Choose the port to select for a content name according to the content policy.
+
+        Args:
+            name (str): name of the content
+            exclude (collection, optional): port numbers that must not be chosen. Defaults to ().
+
+        Returns:
+            int: port number or None if no port holds the content
+        """
+        candidates = self._content_index.get(name)
+        if exclude:
+            candidates = [port_number for port_number in candidates or () if port_number not in exclude]
+        if not candidates:
+            return None
+        if len(candidates) == 1:
+            return candidates[0]
+
+        free = [port_number for port_number in candidates if not self._ports_state[port_number].selected] or candidates
+        if self._content_policy == self.LEAST_RECENTLY_PICKED:
+            return min(free, key=lambda port_number: self._last_picked[port_number])
+        if self._content_policy == self.ROUND_ROBIN:
+            turn = next(self._round_robin.setdefault(name, count()))
+            return free[turn % len(free)]
+        return free[0]
 
 
     def work_finished(self,port_number):
@@ -104,6 +258,8 @@ class PickByLight:
         Returns:
             bool: success
         """
+        if port_number in self._last_picked:
+            self._last_picked[port_number] = monotonic()
         return self.deselect_port(port_number, work_finished=True)
 
     def deselect_port(self, port_number, work_finished = False):
@@ -120,14 +276,18 @@ class PickByLight:
             logger.error('port number {} does not exist'.format(port_number))
             return False
 
-        self._ports_state[port_number].selected = False
-        self._ports_state[port_number].work_finished = work_finished
-        self._ports_state[port_number].amount_to_pick = 0
-        self._ports_state[port_number].select_instructions = ''
+        with self._lock:
+            self._write_states({port_number: dict(selected=False, work_finished=work_finished, amount_to_pick=0, select_instructions='')})
+            self._animator.stop(port_number)
+            self._pick_stats.deselected(port_number, work_finished)
+            self._events.publish(event_bus.PORT_DESELECTED, port_number, {'work_finished': work_finished})
+            if work_finished:
+                self._events.publish(event_bus.WORK_FINISHED, port_number)
         return True
     
     def deselect_content(self, name, work_finished=False):
         """Deselect a port with the giver content name. 
+        If several ports hold the content the first selected one is deselected.
 
         Args:
             name (str): The name of the content to be deselected
@@ -137,12 +297,13 @@ class PickByLight:
             bool: success
             int: port number deselected. returns -1 if not successful
         """
-        for port_number, content in self._content_map.items():
-            if content.get('name', None) == name:
-                success = self.deselect_port(port_number, work_finished)
-                return success, port_number
-        else:
+        candidates = self._content_index.get(name)
+        if not candidates:
             return False, -1
+        with self._lock:
+            port_number = next((p for p in candidates if self._ports_state[p].selected), candidates[0])
+            success = self.deselect_port(port_number, work_finished)
+        return success, port_number
     
     def deselect_all(self):
         """Deselect and marks all ports as finished
@@ -163,7 +324,7 @@ class PickByLight:
             port_number (int): port number you want to get the state of
 
         Returns:
-            PortState: PortState obj 
+            PortState: immutable PortState obj 
         """
         if port_number not in self._ports.keys():
             logger.error('port number {} does not exist'.format(port_number))
@@ -184,19 +345,81 @@ class PickByLight:
         if port_number not in self._ports.keys():
             logger.error('port number {} does not exist'.format(port_number))
             return False
-        if not hasattr(self._ports_state[port_number], key):
+        if key not in PortState._fields or key == 'port_number':
             logger.error('port state has no attribute called {}'.format(key))
             return False    
-        setattr(self._ports_state[port_number], key, value)
+        with self._lock:
+            self._write_states({port_number: {key: value}})
+            self._events.publish(event_bus.STATE_CHANGED, port_number, {key: value})
         return True
 
     def get_ports_state(self):
-        """Get a dict with the state of all the ports
+        """Get a consistent snapshot of the state of all the ports. 
+        The snapshot is read only and is shared between readers until the state changes.
 
         Returns:
-            dict: dict indexed by port number
+            Mapping: read only dict of PortState indexed by port number
+        """
+        return self.get_versioned_ports_state()[1]
+
+    def get_versioned_ports_state(self):
+        """Get a consistent snapshot of the state of all the ports together with its version.
+
+        Returns:
+            int: state version
+            Mapping: read only dict of PortState indexed by port number
+        """
+        with self._lock:
+            if self._state_snapshot is None:
+                self._state_snapshot = MappingProxyType(dict(self._ports_state))
+            return self._state_version, self._state_snapshot
+
+    def get_state_version(self):
+        """Get the version of the port states. The version goes up every time a port state changes, 
+        so a reader can skip its work if the version is the same as on its last read.
+
+        Returns:
+            int: state version
+        """
+        return self._state_version
+
+    def get_pick_stats(self):
+        """Get the pick latency statistics. Latencies are in seconds from the port was selected. 
+        time_to_pick is until the first activity on the port and cycle_time is until the work was finished.
+
+        Returns:
+            dict: {'ports': {port_number: {metric: latencies}}, 'contents': {content_name: {metric: latencies}}} 
+                where latencies is a dict with 'count', 'max', 'p50', 'p95' and 'p99'
+        """
+        return {'ports': self._pick_stats.get_port_stats(), 
+                'contents': self._pick_stats.get_content_stats()}
+
+    def get_recent_picks(self):
+        """Get the most recently completed pick cycles, oldest first
+
+        Returns:
+            list: list of dicts with port_number, content_name, wrong_activity, time_to_pick, time_to_wrong_pick and cycle_time
         """
-        return self._ports_state
+        return self._pick_stats.get_recent_cycles()
+
+    def subscribe(self, callback, kinds=None):
+        """Subscribe to state change events. The callback is called from a dispatcher thread 
+        with a StateEvent every time something changes, so consumers do not have to poll.
+
+        Args:
+            callback (function(StateEvent)): Function called with every event
+            kinds (iterable, optional): Only receive these kinds of events, see event_bus.EVENT_KINDS. 
+                Defaults to None meaning all kinds.
+        """
+        self._events.subscribe(callback, kinds)
+
+    def unsubscribe(self, callback):
+        """Stop receiving state change events
+
+        Args:
+            callback (function(StateEvent)): A callback given to subscribe
+        """
+        self._events.unsubscribe(callback)
 
     def get_ports(self):
         """Get all the port objects in this pick by light
@@ -206,6 +429,23 @@ class PickByLight:
         """
         return self._ports.items()
     
+    def find_port_number(self, text):
+        """Find the port number written as text, like in a UA NodeId or a gui key. 
+        Handles both plain port numbers and rack qualified port numbers.
+
+        Args:
+            text (str): port number as text
+
+        Returns:
+            int or str: the port number or None if there is no such port
+        """
+        if text in self._ports:
+            return text
+        text = str(text).strip()
+        if text.isdigit() and int(text) in self._ports:
+            return int(text)
+        return text if text in self._ports else None
+
     def get_port(self, port_number):
         """Get the port object by port number
 
@@ -278,10 +518,16 @@ class PickByLight:
             port_number (int): port number to change the content of
             content (dict): dict what contains name : value of the content
         """
-        if port_number in self._content_map:
+        if port_number in self._content_map or port_number in self._ports:
             if type(content) != dict:
                 raise TypeError('content must be of type: dict. Instead received: {}'.format(type(content)))
+            old = self._content_map.get(port_number) or {}
+            changed = self._content_diff(old, content)
             self._content_map[port_number] = content
+            if 'name' in changed:
+                self._reindex_content(port_number, old.get('name', None))
+            if changed:
+                self._events.publish(event_bus.CONTENT_CHANGED, port_number, changed)
 
     def set_content_key(self, port_number, key, value):
         """Set a specific attribute of the content of a port
@@ -291,8 +537,80 @@ class PickByLight:
             key (str): attribute to change
             value (any): value of the key
         """
-        if port_number in self._content_map:
-            self._content_map[port_number][key] = value
+        if port_number in self._content_map or port_number in self._ports:
+            content = self._content_map.get(port_number) or {}
+            if key in content and content[key] == value:
+                return
+            old_name = content.get('name', None)
+            content[key] = value
+            self._content_map[port_number] = content
+            if key == 'name':
+                self._reindex_content(port_number, old_name)
+            self._events.publish(event_bus.CONTENT_CHANGED, port_number, {key: value})
+
+    def update_content_map(self, content_map):
+        """Replace the whole content map but only apply what changed. The content index is updated 
+        for the ports whose content name changed and a content changed event with just the 
+        changed fields is published for each changed port.
+
+        The stock of a port keeps its count as long as the stock in the new map is the one the
+        count started from, so an edit of another field does not undo the picks. A new stock in
+        the map is a refill and replaces the count.
+
+        Args:
+            content_map (dict): the new content map indexed by port number
+
+        Returns:
+            dict: the changes as {port_number: {key: new value}}. Removed keys have the value None.
+        """
+        with self._lock:
+            counted = {port_number: (self._stock_loaded.get(port_number), (content or {}).get('stock', None))
+                       for port_number, content in self._content_map.items()}
+            return self._apply_content_map(content_map, counted)
+
+    def _apply_content_map(self, content_map, counted):
+        """Replace the whole content map, keeping the stock counts that started from the stock in the new map.
+
+        Args:
+            content_map (dict): the new content map indexed by port number
+            counted (dict): {port_number: (stock in the content map when counting started, counted stock)}
+
+        Returns:
+            dict: the changes as {port_number: {key: new value}}
+        """
+        content_map = content_map or {}
+        with self._lock:
+            self._stock_loaded = {}
+            for port_number, content in content_map.items():
+                stock = (content or {}).get('stock', None)
+                if stock is None:
+                    continue
+                self._stock_loaded[port_number] = stock
+                loaded, count = counted.get(port_number, (None, None))
+                if loaded == stock and count is not None and count != stock:
+                    content_map[port_number] = dict(content, stock=count)
+
+            old_map = self._content_map
+            diff = {}
+            for port_number in list(old_map) + [p for p in content_map if p not in old_map]:
+                changed = self._content_diff(old_map.get(port_number) or {}, content_map.get(port_number) or {})
+                if changed:
+                    diff[port_number] = changed
+
+            self._content_map = content_map
+            for port_number, changed in diff.items():
+                if 'name' in changed:
+                    self._reindex_content(port_number, (old_map.get(port_number) or {}).get('name', None))
+                self._events.publish(event_bus.CONTENT_CHANGED, port_number, changed)
+        return diff
+
+    def get_content_map_path(self):
+        """Get the path of the content map file that was loaded last
+
+        Returns:
+            str: absolute path or None if no content map was loaded from file
+        """
+        return self._content_map_path
 
     def load_content_map(self,yaml_path):
         """Load a content map from file
@@ -315,9 +633,12 @@ class PickByLight:
            
         with open(_yaml_path, 'r') as content_file:
             content_map = yaml.safe_load(content_file)
-            logger.debug('content_map ----> {0}'.format(content_map))
-            self._content_map = content_map
-            return content_map
+        logger.debug('content_map ----> {0}'.format(content_map))
+        counted = self._load_stock(stock_path(_yaml_path))
+        with self._lock:
+            self._content_map_path = os.path.abspath(_yaml_path)
+            self._apply_content_map(content_map, counted)
+        return self._content_map
     
     def save_content_map(self, yaml_path):
         """Save the current content map as a file
@@ -328,92 +649,176 @@ class PickByLight:
         yaml_name = os.path.basename(yaml_path)
         if not yaml_name.endswith('.yaml'):
             yaml_path += '.yaml'        
-        with open(yaml_path, 'w') as outfile:
-            yaml.dump(self._content_map, outfile, default_flow_style=False)
+        with self._lock:
+            content_map = {port_number: dict(content) if content else content for port_number, content in self._content_map.items()}
+        _write_yaml(yaml_path, content_map)
 
-    def _activity_callback(self,port_number):
-        """Callback for the ports to call when there is activity
+    def get_stock(self, port_number):
+        """Get the number of items left in a port. The stock is the 'stock' key of the content.
 
         Args:
-            port_number (int): port that had activity
+            port_number (int): port number
+
+        Returns:
+            int: items left or None if the port does not count its stock
         """
-        if self._ports_state[port_number].selected:
-            logger.info('activity on port: {} caused it do be deselected'.format(port_number))
-            self.deselect_port(port_number)
-        else:
-            logger.info('activity on port: {} cased a warning light to be triggered because the port was not selected')
-            Thread(target=self._warning_signal_thread, daemon=True, args=(port_number,)).start()   
-    
-    def _set_callbacks(self):
-        """Sets the callback on all the ports for when an activity occurs"""
-        for port_number, port in self._ports.items():
-            port.set_activity_callback(self._activity_callback)
+        return (self._content_map.get(port_number) or {}).get('stock', None)
 
-    def _warning_signal_thread(self, port_number):
-        """A thread function that blinks a port led sharply where there is activity on 
-        a nonselected port to warn the user that this was not correct. 
-        
-        This function is threadsafe meaning it is okay to call this function multiple times. Only
-        one thread will be running at any one time.
+    def is_low_stock(self, port_number):
+        """Check if a port is running low. The threshold is the 'low_stock' key of the content 
+        or else the low_stock given to the constructor.
 
         Args:
-            port_number (int): port number to signal
+            port_number (int): port number
+
+        Returns:
+            bool: True if the stock is at or below the threshold. False if the port does not count its stock.
         """
-        if port_number in self._warning_signalers:
-            logger.debug('tried to spawn _warning_signal_thread but port number {} was already running'.format(port_number))
+        content = self._content_map.get(port_number) or {}
+        stock = content.get('stock', None)
+        if stock is None:
+            return False
+        return stock <= content.get('low_stock', self._low_stock)
+
+    def _take_stock(self, port_number):
+        """Count one item less in a port that counts its stock. Must be called with the lock held."""
+        content = self._content_map.get(port_number) or {}
+        stock = content.get('stock', None)
+        if stock is None:
             return
-        self._warning_signalers.append(port_number)
-        for i in range(5):
-            if self._ports_state[port_number].selected: 
-                break
-            self._ports[port_number].set_light(100)
-            sleep(0.1)  
-            self._ports[port_number].set_light(0)
-            sleep(0.25)
-
-        self._ports[port_number].set_light(0)
-        self._warning_signalers.remove(port_number)
-    
-    def _signal_thread(self,port_number):
-        """Signals calmly to the user that the port is selected. 
+        if stock <= 0:
+            logger.warning('port {} was picked but its stock was already {}'.format(port_number, stock))
+            return
+        content['stock'] = stock - 1
+        self._events.publish(event_bus.CONTENT_CHANGED, port_number, {'stock': stock - 1})
+        if self.is_low_stock(port_number):
+            logger.warning('port {} is low on stock. {} left'.format(port_number, stock - 1))
+        self._stock_saver.request()
+
+    def flush_stock(self):
+        """Save the stock changes that wait for the save delay now. Call before the program exits."""
+        self._stock_saver.flush()
+
+    def _save_stock(self):
+        """Background save of the stock counts to the stock file of the loaded content map.
+        The counts are kept out of the content map itself so the hand edited file, its comments and
+        the content map watcher are left alone."""
+        with self._lock:
+            path = self._content_map_path
+            counts = {port_number: {'stock': content['stock'], 'loaded': self._stock_loaded.get(port_number)}
+                      for port_number, content in self._content_map.items() if (content or {}).get('stock') is not None}
+        if path is None:
+            return
+        _write_yaml(stock_path(path), counts)
+
+    def _load_stock(self, path):
+        """Load the saved stock counts of a content map
 
-        This function is threadsafe meaning it is okay to call this function multiple times. Only
-        one thread will be running at any one time.
-        
         Args:
-            port_number (int): port number to signal 
+            path (str): path of the stock file
+
+        Returns:
+            dict: {port_number: (stock in the content map when counting started, counted stock)}
         """
-        if port_number in self._signalers:
-            logger.debug('tried to spawn _signal_thread but port number {} was already running'.format(port_number))
-            return
-        self._signalers.append(port_number)
-
-        port = self._ports[port_number]
-        port_state = self._ports_state[port_number]
-
-        # while selected
-        while port_state.selected == True:
-            for i in range(0, 100+1):
-                port.set_light(i)
-                sleep(0.005)
-                if port_state.selected == False: break
-
-            for i in range(30):
-                sleep(0.1)
-                if port_state.selected == False: break
-
-            l = port.get_light()
-            for i in range(l, -1, -1):
-                port.set_light(i)
-                sleep(0.005)
-                
-            for i in range(2):
-                sleep(0.1)
-                if port_state.selected == False: break
-        
-        # finally make sure the light is turned off
-        port.set_light(0)
+        if not os.path.isfile(path):
+            return {}
+        try:
+            with open(path, 'r') as stock_file:
+                counts = yaml.safe_load(stock_file) or {}
+            return {port_number: (count['loaded'], count['stock']) for port_number, count in counts.items()}
+        except (yaml.YAMLError, KeyError, TypeError, AttributeError) as e:
+            logger.error('could not load the stock counts {}. Counting from the content map. Error = {}'.format(path, e))
+            return {}
+
+    def _light_changed(self, port_number, level):
+        """Callback for the light animator when a light level is written"""
+        self._events.publish(event_bus.LIGHT_CHANGED, port_number, level)
+
+    def _write_states(self, changes):
+        """Replace the state of one or more ports as a single state update. Must be called with the lock held.
+
+        Args:
+            changes (dict): {port_number: {key: value}} with the changed state attributes
+        """
+        for port_number, values in changes.items():
+            self._ports_state[port_number] = self._ports_state[port_number]._replace(**values)
+        self._state_version += 1
+        self._state_snapshot = None
+
+    def _set_selected(self, selections):
+        """Write the state of the selected ports as a single state update. Must be called with the lock held.
+
+        Args:
+            selections (dict): {port_number: (amount, instructions)}
+        """
+        self._write_states({port_number: dict(selected=True, work_finished=False, amount_to_pick=amount, select_instructions=instructions) 
+                            for port_number, (amount, instructions) in selections.items()})
+        for port_number, (amount, instructions) in selections.items():
+            self._pick_stats.start(port_number, self.get_content(port_number).get('name', None))
+            self._events.publish(event_bus.PORT_SELECTED, port_number, {'amount': amount, 'instructions': instructions})
 
-        self._signalers.remove(port_number)
+    @staticmethod
+    def _content_diff(old, new):
+        """Find the changed fields between two contents
 
+        Args:
+            old (dict): content before
+            new (dict): content after
+
+        Returns:
+            dict: {key: new value} for every changed key. Removed keys have the value None.
+        """
+        return {key: new.get(key, None) for key in list(old) + [k for k in new if k not in old] if old.get(key, None) != new.get(key, None)}
 
+    def _reindex_content(self, port_number, old_name):
+        """Move a single port in the content index after its content name changed.
+        Ports of the content map without a hardware port are left out of the index so they are never chosen.
+
+        Args:
+            port_number (int): port number whose content changed
+            old_name (str): the content name before the change
+        """
+        if port_number not in self._ports:
+            return
+        new_name = (self._content_map.get(port_number) or {}).get('name', None)
+        if new_name == old_name:
+            return
+        if old_name in self._content_index:
+            self._content_index[old_name].remove(port_number)
+            if not self._content_index[old_name]:
+                del self._content_index[old_name]
+        if new_name is not None:
+            self._content_index.setdefault(new_name, []).append(port_number)
+
+    def _activity_callback(self,port_number):
+        """Callback for the ports to call when there is activity
+
+        Args:
+            port_number (int): port that had activity
+        """
+        with self._lock:
+            selected = self._ports_state[port_number].selected
+            self._pick_stats.activity(port_number, selected)
+            self._events.publish(event_bus.ACTIVITY, port_number, {'selected': selected})
+            if selected:
+                self._last_picked[port_number] = monotonic()
+                self._take_stock(port_number)
+                remaining = self._ports_state[port_number].amount_to_pick - 1
+                if remaining > 0:
+                    # keep the port lit until everything is picked
+                    logger.info('activity on port: {} leaves {} to pick'.format(port_number, remaining))
+                    self._write_states({port_number: {'amount_to_pick': remaining}})
+                    self._events.publish(event_bus.STATE_CHANGED, port_number, {'amount_to_pick': remaining})
+                else:
+                    logger.info('activity on port: {} caused it do be deselected'.format(port_number))
+                    self.deselect_port(port_number)
+            else:
+                logger.info('activity on port: {} caused a warning light to be triggered because the port was not selected'.format(port_number))
+                # Let a running warning finish instead of restarting it.
+                if self._animator.get_pattern(port_number) is None:
+                    self._animator.play(port_number, 'warning')
+    
+    def _set_callbacks(self):
+        """Sets the callback on all the ports for when an activity occurs"""
+        for port_number, port in self._ports.items():
+            port.set_activity_callback(self._activity_callback)
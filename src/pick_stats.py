@@ -0,0 +1,270 @@
+from bisect import insort
+from collections import deque
+from threading import Lock
+from time import monotonic
+
+import logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.WARNING)
+
+
+class P2Quantile:
+    """Streaming estimate of a single quantile with the P-square algorithm (Jain and Chlamtac).
+    Uses five markers no matter how many values are added, so memory use is constant.
+    """
+
+    def __init__(self, p):
+        """Constructor:
+
+        Args:
+            p (float): the quantile to estimate, between 0 and 1. 0.95 is the 95th percentile.
+        """
+        self.p = p
+        self.count = 0
+        self._heights = []
+        self._positions = [1, 2, 3, 4, 5]
+        self._desired = [1, 1 + 2 * p, 1 + 4 * p, 3 + 2 * p, 5]
+        self._increments = [0, p / 2, p, (1 + p) / 2, 1]
+
+    def add(self, x):
+        """Add a value to the estimate
+
+        Args:
+            x (float): the value
+        """
+        self.count += 1
+        h = self._heights
+        if len(h) < 5:
+            insort(h, x)
+            return
+
+        # find the cell the value falls in and adjust the extreme markers
+        if x < h[0]:
+            h[0] = x
+            k = 0
+        elif x >= h[4]:
+            h[4] = x
+            k = 3
+        else:
+            k = 0
+            while x >= h[k + 1]:
+                k += 1
+
+        n = self._positions
+        for i in range(k + 1, 5):
+            n[i] += 1
+        for i in range(5):
+            self._desired[i] += self._increments[i]
+
+        # move the middle markers towards their desired positions
+        for i in range(1, 4):
+            d = self._desired[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                height = self._parabolic(i, d)
+                if not h[i - 1] < height < h[i + 1]:
+                    height = h[i] + d * (h[i + d] - h[i]) / (n[i + d] - n[i])
+                h[i] = height
+                n[i] += d
+
+    def _parabolic(self, i, d):
+        h, n = self._heights, self._positions
+        return h[i] + d / (n[i + 1] - n[i - 1]) * (
+            (n[i] - n[i - 1] + d) * (h[i + 1] - h[i]) / (n[i + 1] - n[i]) +
+            (n[i + 1] - n[i] - d) * (h[i] - h[i - 1]) / (n[i] - n[i - 1]))
+
+    def value(self):
+        """Get the current estimate
+
+        Returns:
+            float: the estimated quantile or None if no values were added
+        """
+        h = self._heights
+        if not h:
+            return None
+        if self.count < 5:
+            # exact quantile of the few values seen so far
+            return h[int(round(self.p * (len(h) - 1)))]
+        return h[2]
+
+
+class LatencyTracker:
+    """Streaming p50, p95 and p99 of a latency together with count and max."""
+
+    QUANTILES = (('p50', 0.5), ('p95', 0.95), ('p99', 0.99))
+
+    def __init__(self):
+        self.count = 0
+        self.max = None
+        self._quantiles = [(name, P2Quantile(p)) for name, p in self.QUANTILES]
+
+    def add(self, seconds):
+        """Add a latency
+
+        Args:
+            seconds (float): the latency in seconds
+        """
+        self.count += 1
+        self.max = seconds if self.max is None else max(self.max, seconds)
+        for _, quantile in self._quantiles:
+            quantile.add(seconds)
+
+    def as_dict(self):
+        """Returns:
+            dict: {'count', 'max', 'p50', 'p95', 'p99'} latencies in seconds. None until there are values.
+        """
+        result = {'count': self.count, 'max': self.max}
+        result.update((name, quantile.value()) for name, quantile in self._quantiles)
+        return result
+
+
+class PickCycle:
+    """Timestamps of the phases of a single pick. All times are from time.monotonic."""
+    __slots__ = ('port_number', 'content_name', 'selected_at', 'picked_at', 'first_wrong_at', 'wrong_activity', 'finished_at')
+
+    def __init__(self, port_number, content_name, selected_at):
+        self.port_number = port_number
+        self.content_name = content_name
+        self.selected_at = selected_at
+        self.picked_at = None
+        self.first_wrong_at = None
+        self.wrong_activity = 0
+        self.finished_at = None
+
+    @property
+    def time_to_pick(self):
+        """Seconds from select to the first activity on the port. None if the port never saw activity"""
+        return None if self.picked_at is None else self.picked_at - self.selected_at
+
+    @property
+    def time_to_wrong_pick(self):
+        """Seconds from select to the first activity on a wrong port. None if there was none"""
+        return None if self.first_wrong_at is None else self.first_wrong_at - self.selected_at
+
+    @property
+    def cycle_time(self):
+        """Seconds from select to work finished. None while the cycle is open"""
+        return None if self.finished_at is None else self.finished_at - self.selected_at
+
+    def as_dict(self):
+        """Returns:
+            dict: the port, content name, wrong activity count and phase latencies in seconds
+        """
+        return {'port_number': self.port_number,
+                'content_name': self.content_name,
+                'wrong_activity': self.wrong_activity,
+                'time_to_pick': self.time_to_pick,
+                'time_to_wrong_pick': self.time_to_wrong_pick,
+                'cycle_time': self.cycle_time}
+
+
+class PickStats:
+    """Records how long picks take. A cycle starts when a port is selected, notes the first
+    activity on the port and on wrong ports and completes when the work is finished.
+    Completed cycles are kept in a bounded ring buffer and feed streaming percentiles per port
+    and per content name, so memory use does not grow over a shift.
+    """
+
+    METRICS = ('time_to_pick', 'cycle_time')
+
+    def __init__(self, history=1000):
+        """Constructor:
+
+        Args:
+            history (int, optional): Number of completed cycles to keep. Defaults to 1000.
+        """
+        self._lock = Lock()
+        self._open = {}
+        self._recent = deque(maxlen=history)
+        self._by_port = {}
+        self._by_content = {}
+
+    def start(self, port_number, content_name=None):
+        """A port was selected. Replaces any open cycle on the port.
+
+        Args:
+            port_number (int): port number
+            content_name (str, optional): name of the content in the port. Defaults to None.
+        """
+        with self._lock:
+            self._open[port_number] = PickCycle(port_number, content_name, monotonic())
+
+    def activity(self, port_number, selected):
+        """There was activity on a port
+
+        Args:
+            port_number (int): port number
+            selected (bool): was the port selected when the activity happened
+        """
+        now = monotonic()
+        with self._lock:
+            if selected:
+                cycle = self._open.get(port_number)
+                if cycle is not None and cycle.picked_at is None:
+                    cycle.picked_at = now
+                return
+            # a wrong pick counts against every cycle still waiting for its pick
+            for cycle in self._open.values():
+                if cycle.picked_at is None:
+                    cycle.wrong_activity += 1
+                    if cycle.first_wrong_at is None:
+                        cycle.first_wrong_at = now
+
+    def deselected(self, port_number, work_finished):
+        """A port was deselected. The cycle completes if the work is finished. A deselect before
+        the port saw any activity cancels the cycle. After activity the cycle stays open until
+        the work is finished.
+
+        Args:
+            port_number (int): port number
+            work_finished (bool): is the work done
+        """
+        with self._lock:
+            cycle = self._open.get(port_number)
+            if cycle is None:
+                return
+            if work_finished:
+                del self._open[port_number]
+                cycle.finished_at = monotonic()
+                self._record(cycle)
+            elif cycle.picked_at is None:
+                del self._open[port_number]
+
+    def _record(self, cycle):
+        """Add a completed cycle to the history and the percentiles. Must be called with the lock held."""
+        self._recent.append(cycle)
+        trackers = [self._by_port.setdefault(cycle.port_number, {m: LatencyTracker() for m in self.METRICS})]
+        if cycle.content_name:
+            trackers.append(self._by_content.setdefault(cycle.content_name, {m: LatencyTracker() for m in self.METRICS}))
+        for tracker in trackers:
+            for metric in self.METRICS:
+                seconds = getattr(cycle, metric)
+                if seconds is not None:
+                    tracker[metric].add(seconds)
+
+    def get_port_stats(self):
+        """Get the pick latencies per port
+
+        Returns:
+            dict: {port_number: {metric: {'count', 'max', 'p50', 'p95', 'p99'}}} for the metrics time_to_pick and cycle_time
+        """
+        with self._lock:
+            return {key: {m: t.as_dict() for m, t in trackers.items()} for key, trackers in self._by_port.items()}
+
+    def get_content_stats(self):
+        """Get the pick latencies per content name
+
+        Returns:
+            dict: {content_name: {metric: {'count', 'max', 'p50', 'p95', 'p99'}}} for the metrics time_to_pick and cycle_time
+        """
+        with self._lock:
+            return {key: {m: t.as_dict() for m, t in trackers.items()} for key, trackers in self._by_content.items()}
+
+    def get_recent_cycles(self):
+        """Get the most recent completed cycles, oldest first
+
+        Returns:
+            list: list of dicts, see PickCycle.as_dict
+        """
+        with self._lock:
+            return [cycle.as_dict() for cycle in self._recent]
@@ -0,0 +1,217 @@
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta
+import importlib
+
+import racks
+
+import logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.WARNING)
+
+# backend name -> (module, class). The module is imported when the backend is used, so the
+# hardware packages of a backend are only needed on stations that use it.
+BACKENDS = {'pi': ('pi_port', 'PiBackend'),
+            'dummy': ('dummy_port', 'DummyBackend'),
+            'pca9685': ('pca9685_port', 'PCA9685Backend')}
+
+
+def register_backend(name, module, class_name):
+    """Register a port backend so racks can use it by name
+
+    Args:
+        name (str): name of the backend in rack configurations
+        module (str): module of the backend class
+        class_name (str): name of a PortBackend subclass in the module
+    """
+    BACKENDS[name] = (module, class_name)
+
+
+def get_backend(name):
+    """Get a port backend class by name
+
+    Args:
+        name (str): name of the backend
+
+    Raises:
+        KeyError: If the backend is unknown
+
+    Returns:
+        type: the PortBackend subclass
+    """
+    if name not in BACKENDS:
+        raise KeyError('unknown port backend {}. Use one of {}'.format(name, ', '.join(BACKENDS)))
+    module, class_name = BACKENDS[name]
+    return getattr(importlib.import_module(module), class_name)
+
+
+class Port(ABC):
+    """A port of the pick by light. Each port has a number and a sensor to detect activity.
+    The port can signal with an LED to attract attention to the port.
+
+    Subclasses write the light to their hardware in _write_light and call _activity_detected when
+    their sensor goes high.
+    """
+
+    def __init__(self, port_number, backend=None):
+        """Constructor:
+
+        Args:
+            port_number (int): the port number
+            backend (PortBackend, optional): the backend that made the port. Defaults to None.
+        """
+        self.port_number = port_number
+        self.backend = backend
+        self.activity_timestamp = datetime.now() - timedelta(minutes=10) # arbitrary time in the past.
+        self.cooldown_time = timedelta(seconds=5)
+        self.activity_callback = None
+        self._light_duty_cycle = 0
+
+    @property
+    def activity(self) -> bool:
+        """Property: True if there is activity on the port
+
+        Returns:
+            bool: True if there is activity on the port
+        """
+        return datetime.now() <= self.activity_timestamp + self.cooldown_time
+
+    @property
+    def time_since_activity(self):
+        return datetime.now() - self.activity_timestamp
+
+    def set_light(self, duty_cycle):
+        """Set the light level of the led on the port. The lightlevel is in percent and should
+        between 0 and 100. Values outside this range is capped to either 0 or 100.
+
+        Args:
+            duty_cycle (float): brightness in percent.
+
+        Returns:
+            bool: success
+        """
+        return self._write_light(self.keep_light(duty_cycle))
+
+    def keep_light(self, duty_cycle):
+        """Remember the light level of the port without writing it. For backends that write the lights of many ports at once.
+
+        Args:
+            duty_cycle (float): brightness in percent.
+
+        Returns:
+            float: the brightness capped between 0 and 100
+        """
+        self._light_duty_cycle = max(min(duty_cycle, 100), 0)
+        return self._light_duty_cycle
+
+    def get_light(self) -> int:
+        """Get the current light level
+
+        Returns:
+            int: lightlevel in percent
+        """
+        return self._light_duty_cycle
+
+    def make_activity(self):
+        """Simulate activity on the sensor"""
+        self._activity()
+
+    def set_activity_callback(self, activity_callback):
+        """Set a callback for when there is activity on the port
+
+        Args:
+            activity_callback (function(int: port_number)): The function to call when there is activity on the port.
+            The callback will receive the port number.
+
+        Raises:
+            TypeError: callback is not a callable function
+        """
+        if not callable(activity_callback):
+            raise TypeError('activity_callback must be callable. You gave it type: {}'.format(type(activity_callback)))
+        self.activity_callback = activity_callback
+
+    @abstractmethod
+    def _write_light(self, duty_cycle):
+        """Write a light level to the hardware
+
+        Returns:
+            bool: success
+        """
+
+    def _activity_detected(self, pin=None):
+        """Callback for when the sensor goes high. Acts like a filter to bouncy signals.
+
+        Args:
+            pin (int): NOT USED: sensor pin that went high
+        """
+        # if the cooldown passed since the last activity
+        if datetime.now() > self.activity_timestamp + self.cooldown_time:
+            logger.info('activity detected at port {}'.format(self.port_number))
+            self._activity()
+
+    def _activity(self):
+        """Register activity on the port and call the activity callback"""
+        # set the timestamp first so the activity property is true while the callback runs
+        self.activity_timestamp = datetime.now()
+        if self.activity_callback is not None:
+            self.activity_callback(self.port_number)
+
+
+class PortBackend(ABC):
+    """The hardware a rack of ports is built on. Makes the ports and writes their lights.
+
+    Racks name their backend in the rack configuration and the rest of their configuration is
+    given to the backend. set_lights writes the lights of many ports at once so backends that
+    can update several channels in one go, like an I2C PWM driver, only do it once per animation tick.
+    """
+
+    # True if only one rack of the station can use the backend, like when it owns the gpio pins
+    exclusive = False
+
+    def __init__(self, conf=None):
+        """Constructor:
+
+        Args:
+            conf (dict, optional): the configuration of the rack. Defaults to None.
+        """
+        self.conf = conf or {}
+
+    def port_numbers(self, content_map=None):
+        """Find the port numbers of the rack. By default from the pin configuration of the rack,
+        or from the content map if there is none.
+
+        Args:
+            content_map (dict, optional): the content map of the rack indexed by port number. Defaults to None.
+
+        Returns:
+            list: sorted port numbers
+        """
+        pin_config = racks.load_yaml(self.conf['pin_config']) if self.conf.get('pin_config') else None
+        return racks.discover_port_numbers(pin_config, content_map)
+
+    def make_ports(self, port_numbers):
+        """Make the ports of the rack
+
+        Args:
+            port_numbers (list): port numbers
+
+        Returns:
+            list: Port objects
+        """
+        return [self.make_port(port_number) for port_number in port_numbers]
+
+    @abstractmethod
+    def make_port(self, port_number):
+        """Make one port
+
+        Returns:
+            Port: the port
+        """
+
+    def set_lights(self, levels):
+        """Set the light levels of several ports of the backend
+
+        Args:
+            levels (dict): {Port: brightness in percent}
+        """
+        for port, duty_cycle in levels.items():
+            port.set_light(duty_cycle)
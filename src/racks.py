@@ -0,0 +1,163 @@
+import os
+import yaml
+
+import logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.WARNING)
+
+# Separator between the rack name and the port number in rack qualified port numbers.
+# Port 3 on rack B gets the port number 'B-3'.
+RACK_SEPARATOR = '-'
+
+
+def load_yaml(yaml_name):
+    """Load a yaml file. Relative paths are tried from the working directory and then from this directory.
+
+    Args:
+        yaml_name (str): relative or absolute path to the yaml file
+
+    Raises:
+        FileNotFoundError: If the yaml file cannot be found
+
+    Returns:
+        dict: the loaded yaml. Empty dict if the file is empty.
+    """
+    yaml_path = yaml_name
+    if not os.path.isfile(yaml_path):
+        root_dir = os.path.abspath(os.path.dirname(__file__))
+        yaml_path = os.path.join(root_dir, yaml_name)
+    if not os.path.isfile(yaml_path):
+        raise FileNotFoundError('The file: {}, could not be found'.format(yaml_name))
+    with open(yaml_path, 'r') as yaml_file:
+        return yaml.safe_load(yaml_file) or {}
+
+
+def qualify(rack_name, port_number):
+    """Make a rack qualified port number
+
+    Args:
+        rack_name (str): name of the rack
+        port_number (int): port number on the rack
+
+    Returns:
+        str: rack qualified port number
+    """
+    return '{}{}{}'.format(rack_name, RACK_SEPARATOR, port_number)
+
+
+def discover_port_numbers(pin_config=None, content_map=None):
+    """Find the port numbers of a rack from its pin configuration and content map.
+    Ports with pins are always included. Ports that only appear in the content map are included
+    when there is no pin configuration, as with simulated racks.
+
+    Args:
+        pin_config (dict, optional): pin configuration indexed by port number. Defaults to None.
+        content_map (dict, optional): content map indexed by port number. Defaults to None.
+
+    Returns:
+        list: sorted port numbers
+    """
+    port_numbers = list(pin_config or {})
+    for port_number in content_map or {}:
+        if port_number in port_numbers:
+            continue
+        if pin_config:
+            logger.warning('port {} is in the content map but has no pins. It is skipped'.format(port_number))
+        else:
+            port_numbers.append(port_number)
+    # numbers first, then any named ports
+    return sorted(port_numbers, key=lambda port_number: (isinstance(port_number, str), port_number))
+
+
+class RackPort:
+    """Wraps a port of a rack so it is known by its rack qualified port number.
+    Everything else is passed on to the wrapped port.
+    """
+
+    def __init__(self, rack_name, port):
+        self._port = port
+        self.rack_name = rack_name
+        self.port_number = qualify(rack_name, port.port_number)
+
+    def __getattr__(self, name):
+        return getattr(self._port, name)
+
+    def set_activity_callback(self, activity_callback):
+        """Set a callback for when there is activity on the port. The callback receives the
+        rack qualified port number.
+
+        Args:
+            activity_callback (function(str: port_number)): The function to call when there is activity on the port.
+        """
+        if not callable(activity_callback):
+            raise TypeError('activity_callback must be callable. You gave it type: {}'.format(type(activity_callback)))
+        self._port.set_activity_callback(lambda port_number: activity_callback(self.port_number))
+
+
+def load_racks(rack_conf_name, dummy=False, content_map=None):
+    """Create the ports of all racks in a rack configuration file.
+    The file must be in Yaml format like this:
+
+        rack_name:
+            backend: name of a port backend in port_backend.BACKENDS, like pi, pca9685 or dummy
+            the rest is the configuration of the backend, see the backend classes.
+
+     ##### example #####
+        A:
+            backend : pi
+            pin_config : default_pin_config.yaml
+        B:
+            backend : dummy
+            ports : 24
+
+    The ports of the first rack keep their plain port numbers so existing content maps
+    and OPC UA clients keep working. Ports on the other racks get rack qualified port numbers like 'B-3'.
+    A dummy rack without ports takes its ports from the content map.
+
+    Args:
+        rack_conf_name (str): relative or absolute path to the yaml file.
+        dummy (bool, optional): Use dummy ports for all racks. Defaults to False.
+        content_map (dict, optional): content map used to discover ports. Defaults to None.
+
+    Raises:
+        KeyError: If a rack has an unknown backend or more than one rack uses a backend that only one rack can use
+
+    Returns:
+        list: port objects of all racks
+    """
+    from port_backend import get_backend
+
+    racks = load_yaml(rack_conf_name)
+    if not racks:
+        return []
+    rack_names = list(racks)
+
+    # split the content map per rack, indexed by the port number on the rack
+    rack_contents = {rack_name: {} for rack_name in rack_names}
+    for port_number, content in (content_map or {}).items():
+        rack_name, _, local = str(port_number).rpartition(RACK_SEPARATOR)
+        if rack_name in rack_contents and rack_name != rack_names[0] and local.isdigit():
+            rack_contents[rack_name][int(local)] = content
+        else:
+            rack_contents[rack_names[0]][port_number] = content
+
+    ports = []
+    # backend name -> the rack using it, for the backends only one rack can use
+    exclusive = {}
+    for rack_name in rack_names:
+        conf = racks[rack_name] or {}
+        backend_name = 'dummy' if dummy else conf.get('backend', 'dummy')
+        first = rack_name == rack_names[0]
+
+        Backend = get_backend(backend_name)
+        if Backend.exclusive:
+            if backend_name in exclusive:
+                raise KeyError('rack {} and {} both use the {} backend. Only one rack can use it'.format(exclusive[backend_name], rack_name, backend_name))
+            exclusive[backend_name] = rack_name
+        backend = Backend(conf)
+        port_numbers = backend.port_numbers(rack_contents[rack_name])
+
+        logger.info('rack {} uses the {} backend with ports {}'.format(rack_name, backend_name, port_numbers))
+        for port in backend.make_ports(port_numbers):
+            ports.append(port if first else RackPort(rack_name, port))
+    return ports
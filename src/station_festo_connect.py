@@ -1,114 +1,436 @@
-from time import sleep
-from threading import Thread, Event
+from threading import Thread, Event, Condition
+from datetime import datetime
 from opcua import ua, Client
-import socket
+import random
+import concurrent.futures
 from pick_by_light import PickByLight
+from festo_operations import OperationTable
+import event_bus
 
 import logging  
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+# Nodes on the festo PLC
+FLAG_NODE = "ns=2;s=|var|CECC-LK.Application.Flexstation_globalVariables.FlexStationStatus"
+OPERATION_NUMBER_NODE = "ns=2;s=|var|CECC-LK.Application.FBs.stpStopper1.stAppControl.uiOpNo"
+ORDER_DESCRIPTION_NODE = "ns=2;s=|var|CECC-LK.Application.AppModul.stRcvData.sOderDes"
+OPERATION_PARAMETER_NODE = "ns=2;s=|var|CECC-LK.Application.AppModul.stAppControl.auiPar"
+
+# The nodes of a stopper of the festo PLC that its orders are handed over with
+STOPPER_NODES = ('flag', 'operation_number', 'order_description', 'operation_parameter')
+DEFAULT_STOPPER = {'name': 'stpStopper1', 'flag': FLAG_NODE, 'operation_number': OPERATION_NUMBER_NODE,
+                   'order_description': ORDER_DESCRIPTION_NODE, 'operation_parameter': OPERATION_PARAMETER_NODE}
+
+# Values of the flag in the handshake with the PLC
+FLAG_ORDER = 1      # set by the PLC when an order is waiting
+FLAG_WORKING = 2    # set by us when we have taken the order
+FLAG_DONE = 3       # set by us when the order is done
+
+# errors of a request to the PLC. Any other error while handling an order is an error in the order.
+# The opcua client times out with concurrent.futures.TimeoutError, which is not TimeoutError before python 3.11,
+# and cancels the requests that are waiting when its socket is closed.
+COMMUNICATION_ERRORS = (ua.UaError, OSError, TimeoutError, concurrent.futures.TimeoutError, concurrent.futures.CancelledError,
+                        ConnectionError)
+
 
 class FestoServer():
-    def __init__(self, pick_by_light: PickByLight, festo_ip: str, ua_port = '4840'):
+    """Takes orders from the festo PLC and selects the content they need.
+
+    Orders come from one or more stoppers, each with its own flag and order nodes. Every stopper has an
+    OrderFlow that runs the handshake of its orders in its own thread, so the orders of several stoppers
+    are worked on at the same time. The PLC raises the flag of a stopper when an order is waiting. A
+    subscription on the flags wakes the order thread of the stopper right away. The order parameters are
+    read in a single request and translated into the content to select by the rules of an OperationTable.
+    The order is done when the pick by light publishes that the work on the port is finished or the PLC
+    takes the flag back.
+
+    A port is given to one order at a time. An order that needs content whose ports are all taken by the
+    orders of other stoppers waits until one of them is done, or until the PLC takes the order back or the
+    connection is lost.
+
+    The connection is managed by a connection thread. It checks the session with a keepalive read and
+    reconnects with jittered exponential backoff when the PLC is gone, then subscribes to the flag again.
+    An order that was taken but not handed back when the connection dropped is finished after reconnecting.
+    """
+
+    # connection states
+    CONNECTING = 'connecting'
+    CONNECTED = 'connected'
+    DISCONNECTED = 'disconnected'
+    STOPPED = 'stopped'
+
+    def __init__(self, pick_by_light: PickByLight, festo_ip: str, ua_port = '4840', publishing_interval = 20, 
+                 keepalive_interval = 2.0, request_timeout = 4, min_backoff = 0.5, max_backoff = 30.0, on_status = None,
+                 operations = 'festo_operations.yaml', stoppers = None):
+        """Constructor: Returns right away, the connection is made in the background.
+
+        Args:
+            pick_by_light (PickByLight): the pick by light to select the orders on
+            festo_ip (str): ip address of the festo PLC
+            ua_port (str, optional): ua port of the festo PLC. Defaults to '4840'.
+            publishing_interval (int, optional): ms between notifications of the flag subscription. Defaults to 20.
+            keepalive_interval (float, optional): Seconds between the reads that check the session is alive. Defaults to 2.0.
+            request_timeout (float, optional): Seconds before a request to the PLC times out. Defaults to 4.
+            min_backoff (float, optional): Seconds to wait before the first reconnect. Doubles with every failed attempt. Defaults to 0.5.
+            max_backoff (float, optional): Max seconds to wait between reconnects. Defaults to 30.0.
+            on_status (function(dict), optional): Called with status() when the connection state changes or an operation 
+                is unknown. Defaults to None.
+            operations (str or OperationTable, optional): the operation rules file or table. Defaults to 'festo_operations.yaml'.
+            stoppers (list, optional): the stoppers to take orders from as dicts with a name and the node ids in STOPPER_NODES.
+                Defaults to None meaning [DEFAULT_STOPPER].
+        """
         self._pbl = pick_by_light
+        self.url = "opc.tcp://{}:{}".format(festo_ip, ua_port)
+        self.publishing_interval = publishing_interval
+        self.keepalive_interval = keepalive_interval
+        self.request_timeout = request_timeout
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self._on_status = on_status
+        self.operations = operations if isinstance(operations, OperationTable) else OperationTable(operations)
+
+        self.state = self.DISCONNECTED
+        self.reconnects = 0
+        self.last_error = ''
+        self.connected_since = None
+        self.client = None
+        # set when an order thread finds that the connection is dead
+        self._lost = Event()
+        self._stop = Event()
+        # port number -> the OrderFlow whose order has it. Notified when a port is given back.
+        self._claims = {}
+        self._ports_free = Condition()
+        # NodeId of a flag -> its OrderFlow, made at every connect
+        self._flag_flows = {}
+
+        self.flows = []
+        for stopper in stoppers or [DEFAULT_STOPPER]:
+            if any(stopper['flag'] == flow.nodeids['flag'] for flow in self.flows):
+                logger.error('stopper {} has the same flag as another stopper and is left out'.format(stopper['name']))
+                continue
+            self.flows.append(OrderFlow(self, stopper))
+
+        self._pbl.subscribe(self._work_finished_callback, kinds=[event_bus.WORK_FINISHED])
+        Thread(target=self._connection_thread, daemon=True).start()
+        for flow in self.flows:
+            Thread(target=flow.run, daemon=True).start()
 
+    @property
+    def connected(self):
+        return self.state == self.CONNECTED
+
+    def status(self):
+        """Returns:
+            dict: state, reconnects, last_error, connected_since (datetime or None) and unknown_operations
+        """
+        return {'state': self.state, 'reconnects': self.reconnects, 'last_error': self.last_error, 
+                'connected_since': self.connected_since, 'unknown_operations': self.operations.unknown}
+
+    def stop(self):
+        """Stop handling orders and disconnect from the PLC"""
+        self._stop.set()
+        self._lost.set()
+        for flow in self.flows:
+            flow.flag_raised.set()
+        with self._ports_free:
+            self._ports_free.notify_all()
+
+    def _set_state(self, state, error=None):
+        """Change the connection state and tell the on_status callback"""
+        self.state = state
+        if error is not None:
+            self.last_error = repr(error)
+        if state == self.CONNECTED:
+            self.connected_since = datetime.now()
+        elif state != self.CONNECTING:
+            self.connected_since = None
+        self._publish_status()
+
+    def _publish_status(self):
+        """Tell the on_status callback the current status"""
+        if self._on_status is not None:
+            try:
+                self._on_status(self.status())
+            except Exception:
+                logger.exception('festo status callback failed')
+
+    def _backoff(self, attempt):
+        """Seconds to wait before reconnect attempt number attempt. The jitter keeps stations from reconnecting in lockstep."""
+        delay = min(self.max_backoff, self.min_backoff * 2 ** attempt)
+        return random.uniform(delay / 2, delay)
+
+    def _connection_thread(self):
+        """Thread function that connects, watches the session and reconnects"""
+        attempt = 0
+        connected_before = False
+        while not self._stop.is_set():
+            self._set_state(self.CONNECTING)
+            try:
+                self._connect()
+            except Exception as e:
+                self._disconnect()
+                delay = self._backoff(attempt)
+                attempt += 1
+                self._set_state(self.DISCONNECTED, e)
+                logger.warning("Failed to connect to OPC-UA on {}. Retrying in {:.1f}s. Error = {}".format(self.url, delay, e))
+                self._stop.wait(delay)
+                continue
+
+            if connected_before:
+                self.reconnects += 1
+            connected_before = True
+            attempt = 0
+            self._set_state(self.CONNECTED)
+            logger.info("connected to festo module on {}".format(self.url))
+            for flow in self.flows:
+                flow.resume()
+            error = self._watch()
+            # orders waiting for a port give up, see select_for
+            self._lost.set()
+            self._wake_waiting()
+            self._disconnect()
+            if self._stop.is_set():
+                break
+            self._set_state(self.DISCONNECTED, error)
+            logger.warning("lost the connection to the festo module. Error = {!r}".format(error))
+            # the first reconnect is tried right away
+        self._set_state(self.STOPPED)
+
+    def _connect(self):
+        """Connect, make the node handles and subscribe to the flags of all stoppers"""
+        self._lost.clear()
+        self.client = Client(self.url, timeout=self.request_timeout)
+        self.client.connect()
+        for flow in self.flows:
+            flow.make_nodes(self.client)
+        self._flag_flows = {flow.flag.nodeid: flow for flow in self.flows}
+        self._server_state = self.client.get_node(ua.ObjectIds.Server_ServerStatus_State)
+        self._subscription = self.client.create_subscription(self.publishing_interval, self)
+        self._subscription.subscribe_data_change([flow.flag for flow in self.flows])
+
+    def _disconnect(self):
+        """Close the connection. The PLC may already be gone, so errors are ignored."""
+        if self.client is None:
+            return
         try:
-            self.client = Client("opc.tcp://{}:{}".format(festo_ip, ua_port))
-            self.client.connect()
-            logger.info("Festo OPC-UA Client Connected")
-            self.connected = True
-        except socket.timeout:
-            logger.warning("Failed to connect to OPC-UA on {}:{}".format(festo_ip,ua_port))
-            self.connected = False
-
-        logger.info("connected to festo module on opc.tcp://{}:{}".format(festo_ip,ua_port))
-        self._select_event = Event()
-        Thread(target=self.run, daemon=True).start()
-        
-    def run(self):
-        while self.connected:
-            sleep(0.1)
-            
-            # Read the flag on the festo system
-            flag = self.client.get_node("ns=2;s=|var|CECC-LK.Application.Flexstation_globalVariables.FlexStationStatus") 
-            # If flag is high
-            if flag.get_value() == 1:
-                # Answer back by setting the flag = 2
-                flag.set_value(ua.Variant(2, ua.VariantType.Int16))
-                
-                # Get the operation number and order url.
-                Operation_number = self.client.get_node("ns=2;s=|var|CECC-LK.Application.FBs.stpStopper1.stAppControl.uiOpNo").get_value() # change to order id
-                Order_url = self.client.get_node("ns=2;s=|var|CECC-LK.Application.AppModul.stRcvData.sOderDes").get_value()
-                
-                # interpret the operation number nad order url
-                name, instructions = self.operation_number_translator(Operation_number,Order_url)
-                
-                # try to select the content with the returned name.
-                success, port_number = self._pbl.select_content(name=name, instructions=instructions)
-                
-                if success:
-                    # wait until work has finished or status tag changed.
-                    while self._pbl.get_port_state(port_number).work_finished == False:
-                        if flag.get_value() != 2:
-                            self._pbl.work_finished(port_number)
-                        sleep(0.25)
-
-                # finally set the flag to 3 to signal that we are done.    
-                flag.set_value(ua.Variant(3, ua.VariantType.Int16))
-        
-        logger.warning("disconnected from festo module")
-
-    def operation_number_translator(self, op_number,order_url):
-        
-        """There are multiple operations the festo system can request. some are redundant but we have to 
-           concider all possible options just to be safe.
+            self.client.disconnect()
+        except Exception:
+            pass
+
+    def _watch(self):
+        """Check the session with a keepalive read until it fails or an order thread finds it dead
+
+        Returns:
+            Exception: why the connection was given up, None if stopped
+        """
+        while not self._stop.is_set():
+            if self._lost.wait(self.keepalive_interval):
+                return ConnectionError('a request to the festo module failed')
+            try:
+                self._server_state.get_value()
+            except Exception as e:
+                return e
+        return None
+
+    def select_for(self, flow, name, instructions):
+        """Select a port with the content of an order. Ports the orders of other stoppers have are not chosen,
+        and while all the ports with the content are taken this waits until one is given back. The wait ends
+        without a port when the PLC takes the order back or the connection is lost.
+
+        Args:
+            flow (OrderFlow): the flow of the order
+            name (str): name of the content
+            instructions (str): instructions to display
+
+        Returns:
+            bool: success
+            int: port number selected. -1 if not successful
+        """
+        with self._ports_free:
+            while not self._stop.is_set():
+                if flow.withdrawn or self._lost.is_set():
+                    return False, -1
+                ports = self._pbl.get_content_ports(name)
+                if not ports:
+                    return False, -1
+                taken = set(port_number for port_number, other in self._claims.items() if other is not flow)
+                if any(port_number not in taken for port_number in ports):
+                    success, port_number = self._pbl.select_content(name=name, instructions=instructions, exclude=taken)
+                    if success:
+                        self._claims[port_number] = flow
+                    return success, port_number
+                logger.info('the order of {} waits for a port with {}. All of them are taken by other orders'.format(flow.name, name))
+                self._ports_free.wait()
+        return False, -1
+
+    def release(self, port_number):
+        """Give back the port of a done order so waiting orders can have it"""
+        with self._ports_free:
+            self._claims.pop(port_number, None)
+            self._ports_free.notify_all()
+
+    def _wake_waiting(self):
+        """Wake the orders waiting for a port so they check if they should still wait"""
+        with self._ports_free:
+            self._ports_free.notify_all()
+
+    def withdraw(self, flow):
+        """Mark the order of a flow as taken back by the PLC. Under the lock of the port wait, so an order
+        that is about to wait for a port can't miss it."""
+        with self._ports_free:
+            flow.withdrawn = True
+            self._ports_free.notify_all()
+
+    def datachange_notification(self, node, val, data):
+        """Flag subscription callback. Runs in the subscription thread so it must not call the PLC."""
+        flow = self._flag_flows.get(node.nodeid)
+        if flow is not None:
+            flow.flag_changed(val)
+
+    def _work_finished_callback(self, event):
+        """Pick by light event callback. Wakes the order thread whose order has the finished port"""
+        for flow in self.flows:
+            if event.port_number == flow.order_port:
+                flow.order_done.set()
+
+    def operation_number_translator(self, op_number, order_url, operation_par=None):
+        """Translate an operation the festo system requests into the content to select, by the operation rules.
+
+        Args:
+            op_number (int): operation number
+            order_url (str): order description
+            operation_par (int, optional): operation parameter, read with the other order nodes of the stopper. Defaults to None.
 
         Returns:
             [string]: name. Returns the name of the item to retreeve. Return empty string on failure to translate
             [string]: instructions. returns the instructions to display 
 
         """
+        result = self.operations.translate(op_number, order_url, operation_par)
+        if result is None:
+            # nothing matched the possible operations that we know of.
+            logger.warning("{} with parameter {} and order {} not a valid operation for this station".format(op_number, operation_par, order_url))
+            self._publish_status()
+            return "", ""
+        return result
+
+
+class OrderFlow:
+    """The order handshake with one stopper of the festo PLC.
+
+    Runs the orders of the stopper one at a time in its own thread over the connection of a FestoServer.
+    """
+
+    def __init__(self, festo: FestoServer, stopper):
+        """Constructor:
+
+        Args:
+            festo (FestoServer): the connection to the PLC
+            stopper (dict): name of the stopper and the node ids in STOPPER_NODES
+        """
+        self._festo = festo
+        self._pbl = festo._pbl
+        self.name = stopper['name']
+        self.nodeids = {key: stopper[key] for key in STOPPER_NODES}
+        self.flag = None
+        self.flag_raised = Event()
+        self.order_done = Event()
+        self.order_port = None
+        self.handling = False
+        # the PLC took the flag back while the order was handled. Set by FestoServer.withdraw.
+        self.withdrawn = False
+        # the order is done but the PLC has not been told yet
+        self.done_pending = False
+
+    def make_nodes(self, client):
+        """Make the node handles for a new connection. The order parameters are read together."""
+        self.flag = client.get_node(self.nodeids['flag'])
+        self._order_nodes = [client.get_node(self.nodeids[key]) for key in ['operation_number', 'order_description', 'operation_parameter']]
+
+    def resume(self):
+        """Finish what the connection loss interrupted: hand back a finished order or take a taken order again"""
+        try:
+            if self.done_pending:
+                self.flag.set_value(ua.Variant(FLAG_DONE, ua.VariantType.Int16))
+                self.done_pending = False
+            elif not self.handling and self.flag.get_value() == FLAG_WORKING:
+                logger.warning('{} is waiting for an order that was taken before the connection was lost. Taking it again'.format(self.name))
+                self.flag_raised.set()
+        except Exception:
+            logger.exception('could not resume the order of {} after reconnecting'.format(self.name))
+            self._festo._lost.set()
+
+    def run(self):
+        """Thread function that handles the orders when the PLC raises the flag"""
+        while not self._festo._stop.is_set():
+            self.flag_raised.wait()
+            self.flag_raised.clear()
+            if self._festo._stop.is_set() or not self._festo.connected:
+                continue
+            self.handling = True
+            try:
+                self._handle_order()
+            except COMMUNICATION_ERRORS:
+                logger.exception('lost the connection while handling the order from {}'.format(self.name))
+                # the connection thread reconnects
+                self._festo._lost.set()
+            except Exception:
+                # taking the order again after a reconnect would fail the same way, so it is handed back
+                logger.exception('failed to handle the order from {}. Handing it back'.format(self.name))
+                try:
+                    self._hand_back()
+                except COMMUNICATION_ERRORS:
+                    self._festo._lost.set()
+            finally:
+                if self.order_port is not None:
+                    self._festo.release(self.order_port)
+                self.order_port = None
+                self.handling = False
+
+    def _handle_order(self):
+        """Take the order, select its content and wait for the work to be finished"""
+        self.withdrawn = False
+        # Answer back by setting the flag = 2
+        self.flag.set_value(ua.Variant(FLAG_WORKING, ua.VariantType.Int16))
+
+        # Get the operation number, order url and operation parameter in one read
+        operation_number, order_url, operation_par = self._festo.client.get_values(self._order_nodes)
+
+        # interpret the operation number and order url
+        name, instructions = self._festo.operation_number_translator(operation_number, order_url, operation_par)
 
-        op_number = int(op_number)
-
-        # cover color send as a separate parameter
-        if op_number == 801:
-            Operation_par = self.client.get_node("ns=2;s=|var|CECC-LK.Application.AppModul.stAppControl.auiPar").get_value()
-            if Operation_par == 0: 
-                return "black_bottom_cover" , "Place a black bottom cover on the pallet"
-            elif Operation_par == 1:
-                return "white_bottom_cover" , "Place a white bottom cover on the pallet"
-            elif Operation_par == 2:
-                return "blue_bottom_cover" , "Place a blue bottom cover on the pallet"
-        
-        
-        elif op_number == 803:
-            return "black_bottom_cover", "Place a black bottom cover on the pallet"
-        elif op_number == 804:
-            return "white_bottom_cover" , "Place a white bottom cover on the pallet"
-        elif op_number == 802:
-            return "blue_bottom_cover" , "Place a blue bottom cover on the pallet"
-
-        # repare operations and generic manual operations
-        elif op_number == 510:
-            if "FuseLeft" in order_url:
-                return "fuse_1A", "make sure a fuse is placed left (to the right for you)"
-            elif "FuseRight" in order_url:
-                return "fuse_1A",  "make sure a fuse is placed right (to the left for you)"
-            elif "BothFuses" in order_url:
-                return "fuse_1A",  "make sure both fuse are placed in the phone"
-            elif "NoFuse" in order_url:
-                return "fuse_1A",  "make sure no fuses are placed"
-                
-            elif "Blue" in order_url and "Top" in order_url: 
-                return "blue_top_cover", "Press the blue top cover on the phone. Make sure it is oriented correctly"
-            elif "White" in order_url and "Top" in order_url: 
-                return "white_top_cover", "press the white top cover on the phone. Make sure it is oriented correctly"
-
-        # if we get here nothing matched the possible operations that we know of.
-        logger.warning("{} not a valid operation for this station".format(op_number))
-        return "", ""
+        # select a port with the content that no other order has
+        self.order_done.clear()
+        success, port_number = self._festo.select_for(self, name, instructions)
+        if not success and self._festo._lost.is_set() and not self._festo._stop.is_set():
+            # the order stays taken and is taken again after reconnecting
+            raise ConnectionError('the connection was lost while the order of {} waited for a port'.format(self.name))
 
+        if success:
+            self.order_port = port_number
+            # the work can be finished before the port of the order is known to the callback
+            if self._pbl.get_port_state(port_number).work_finished:
+                self.order_done.set()
+            # wait until work has finished or the PLC takes the flag back
+            self.order_done.wait()
+            if not self._pbl.get_port_state(port_number).work_finished:
+                self._pbl.work_finished(port_number)
+            self._festo.release(port_number)
+        self.order_port = None
+        self._hand_back()
 
+    def _hand_back(self):
+        """Set the flag to 3 to signal that the order is done. If the PLC is gone it is done after reconnecting."""
+        self.done_pending = True
+        self.flag.set_value(ua.Variant(FLAG_DONE, ua.VariantType.Int16))
+        self.done_pending = False
 
+    def flag_changed(self, val):
+        """Called with every new value of the flag. Runs in the subscription thread so it must not call the PLC."""
+        if val == FLAG_ORDER:
+            self.flag_raised.set()
+        elif val != FLAG_WORKING and self.handling and not self.done_pending:
+            # the PLC took the flag back while we were working
+            self._festo.withdraw(self)
+            self.order_done.set()
@@ -1,27 +1,699 @@
 from opcua import ua, Server, Node
-from time import sleep
+from functools import partial
+from time import sleep, monotonic
 from threading import Thread, Event
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+from queue import Queue, Empty
+import collections
+import event_bus
+import ua_startup
+from ua_history import RingBufferHistory
+from command_queue import CommandQueue
 
 import logging  
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.WARNING)
 
-class StationUAServer:
-    def __init__(self,pick_by_light):
+
+def array_argument(ua, name, variant_type, description=''):
+    """Make a one dimensional array argument for a ua method
+
+    Args:
+        ua: the ua module of the backend. The opcua and asyncua ua modules have the same types.
+        name (str): name of the argument
+        variant_type (ua.VariantType): type of the array elements
+        description (str, optional): description shown to clients. Defaults to ''.
+
+    Returns:
+        ua.Argument: the argument description
+    """
+    arg = ua.Argument()
+    arg.Name = name
+    arg.DataType = ua.NodeId(variant_type.value)
+    arg.ValueRank = 1
+    arg.ArrayDimensions = [0]
+    arg.Description = ua.LocalizedText(description)
+    return arg
+
+
+def _object_item(ua, nodeid, name, parent, reference_type, node_class=None, type_definition=None):
+    """Make the item that adds an object or object type with add_nodes
+
+    Args:
+        ua: the ua module of the backend. The opcua and asyncua ua modules have the same types.
+        nodeid (NodeId): NodeId of the new node
+        name (str): browse and display name
+        parent (NodeId): NodeId of the parent
+        reference_type (int): ua.ObjectIds of the reference from the parent
+        node_class (NodeClass, optional): ua.NodeClass.Object or ua.NodeClass.ObjectType. Defaults to None meaning Object.
+        type_definition (NodeId, optional): object type of an object. Defaults to None meaning BaseObjectType.
+
+    Returns:
+        AddNodesItem: the item
+    """
+    item = ua.AddNodesItem()
+    item.RequestedNewNodeId = nodeid
+    item.BrowseName = ua.QualifiedName(name, 0)
+    item.ParentNodeId = parent
+    item.ReferenceTypeId = ua.NodeId(reference_type)
+    if node_class == ua.NodeClass.ObjectType:
+        item.NodeClass = ua.NodeClass.ObjectType
+        attrs = ua.ObjectTypeAttributes()
+        attrs.IsAbstract = False
+    else:
+        item.NodeClass = ua.NodeClass.Object
+        item.TypeDefinition = type_definition or ua.NodeId(ua.ObjectIds.BaseObjectType)
+        attrs = ua.ObjectAttributes()
+        attrs.EventNotifier = 0
+    attrs.Description = ua.LocalizedText(name)
+    attrs.DisplayName = ua.LocalizedText(name)
+    attrs.WriteMask = 0
+    attrs.UserWriteMask = 0
+    item.NodeAttributes = attrs
+    return item
+
+
+def _variable_item(ua, nodeid, name, parent, value, writable=False, is_property=False):
+    """Make the item that adds a scalar variable with add_nodes. The data type is guessed from the value.
+
+    Args:
+        ua: the ua module of the backend
+        nodeid (NodeId): NodeId of the new variable
+        name (str): browse and display name
+        parent (NodeId): NodeId of the parent
+        value (any): initial value
+        writable (bool, optional): can clients write it. Defaults to False.
+        is_property (bool, optional): add it as a property of the parent instead of a component. Defaults to False.
+
+    Returns:
+        AddNodesItem: the item
+    """
+    item = ua.AddNodesItem()
+    item.RequestedNewNodeId = nodeid
+    item.BrowseName = ua.QualifiedName(name, 0)
+    item.NodeClass = ua.NodeClass.Variable
+    item.ParentNodeId = parent
+    if is_property:
+        item.ReferenceTypeId = ua.NodeId(ua.ObjectIds.HasProperty)
+        item.TypeDefinition = ua.NodeId(ua.ObjectIds.PropertyType)
+    else:
+        item.ReferenceTypeId = ua.NodeId(ua.ObjectIds.HasComponent)
+        item.TypeDefinition = ua.NodeId(ua.ObjectIds.BaseDataVariableType)
+    variant = ua.Variant(value)
+    attrs = ua.VariableAttributes()
+    attrs.Description = ua.LocalizedText(name)
+    attrs.DisplayName = ua.LocalizedText(name)
+    attrs.DataType = ua.NodeId(getattr(ua.ObjectIds, variant.VariantType.name))
+    attrs.Value = variant
+    attrs.ValueRank = ua.ValueRank.Scalar
+    attrs.WriteMask = 0
+    attrs.UserWriteMask = 0
+    attrs.Historizing = False
+    access = ua.AccessLevel.CurrentRead.mask
+    if writable:
+        access |= ua.AccessLevel.CurrentWrite.mask
+    attrs.AccessLevel = access
+    attrs.UserAccessLevel = access
+    item.NodeAttributes = attrs
+    return item
+
+
+class StationUABase:
+    """Address space layout and tag values shared by the UA server backends.
+    A backend creates the nodes, writes the values and handles the command tags with its own ua library.
+    """
+    # content key -> content tag name
+    CONTENT_TAGS = {'display_name': 'ContentDisplayName', 'name': 'ContentName', 
+                    'description': 'ContentDescription', 'image_path': 'ContentImagePath'}
+    # pick statistics metric -> status tag name prefix
+    STATS_TAGS = [('time_to_pick', 'TimeToPick'), ('cycle_time', 'CycleTime')]
+    # (tag name, initial value) of the ByContent command tags
+    BY_CONTENT_VARIABLES = [('Select', bool()), ('Deselect', bool()), ('Name', ""), ('Instructions', ""), ('Amount', 1), ('Result', -1)]
+    # status tags that clients most often need every transition of
+    HISTORY_TAGS = ['Selected', 'WorkFinished', 'Activity']
+    # (name, severity) of the UA event types raised by the station
+    EVENT_TYPES = [('WrongPortActivityEventType', 700), ('WorkFinishedEventType', 100), ('SelectionTimeoutEventType', 500)]
+    # (property name, initial value) of the station event types in addition to the BaseEventType properties
+    EVENT_PROPERTIES = [('PortNumber', 0), ('ContentName', "")]
+    # command queue statistic -> tag name in Status.Commands
+    COMMAND_STATS_TAGS = [('depth', 'QueueDepth'), ('submitted', 'Submitted'), ('coalesced', 'Coalesced'), ('dropped', 'Dropped'), 
+                          ('ignored', 'Ignored'), ('executed', 'Executed'), ('failed', 'Failed')]
+    # festo connection status -> (tag name in Status.Festo, initial value)
+    FESTO_TAGS = [('state', 'ConnectionState', 'disabled'), ('reconnects', 'Reconnects', 0), ('last_error', 'LastError', ""), 
+                  ('connected_since', 'ConnectedSince', datetime.fromtimestamp(0)), ('unknown_operations', 'UnknownOperations', 0)]
+
+    def __init__(self, pick_by_light, history_tags=None, history_count=1000, history_period=timedelta(hours=8), selection_timeout=None,
+                 max_pending_commands=100, command_window=0.02):
+        """Constructor:
+
+        Args:
+            pick_by_light (PickByLight): the pick by light to serve
+            history_tags (list, optional): names of the status tags of every port to keep a history of for HistoryRead. 
+                Defaults to None meaning no history.
+            history_count (int, optional): Max number of values kept per tag. Defaults to 1000.
+            history_period (timedelta, optional): How long values are kept. Defaults to 8 hours.
+            selection_timeout (float, optional): Seconds a port can stay selected before a SelectionTimeoutEventType 
+                event is raised. Defaults to None meaning never.
+            max_pending_commands (int, optional): Max number of command tag changes waiting to be handled. More are dropped. Defaults to 100.
+            command_window (float, optional): Seconds to collect a burst of command tag changes so they can coalesce. Defaults to 0.02.
+        """
         self._pbl = pick_by_light
-        self._setup_nodes()
-        self._generate_tags()
+        self.selection_timeout = selection_timeout
+        self.max_pending_commands = max_pending_commands
+        self.command_window = command_window
+        # NodeId of a command tag -> value the server wrote to it itself, so the data change it causes is not handled as a command
+        self._own_writes = {}
+        # NodeIds of the Select and Deselect command tags. Only writing True to them is a command.
+        self._pulse_nodes = set()
+        self.ignored_notifications = 0
+        self._history_tags = list(history_tags or [])
+        # bounded in memory history of the historized status tags
+        self.history = RingBufferHistory(history_count, history_period) if self._history_tags else None
+        # port number -> {tag name: Node} resolved once when the tags are generated
+        self._status_nodes = {}
+        self._command_nodes = {}
+        self._by_content_nodes = {}
+        # Node -> value last written by the updater
+        self._published = {}
+        # NodeId of a subscribed command tag -> (port number or None, handler(port_number, value), command queue key)
+        self._dispatch = {}
+
+    def _status_variables(self, port_number=None):
+        """Get the status tags of a port
+
+        Args:
+            port_number (int, optional): port number. Defaults to None meaning the tags of PortStatusType without content.
+
+        Returns:
+            list: [(tag name, initial value)]
+        """
+        content = self._pbl.get_content(port_number) if port_number is not None else {}
+        variables = [('Selected', bool()), ('WorkFinished', bool()), ('Instructions', ""), ('AmountToPick', 0), 
+                     ('Stock', -1), ('LowStock', bool()), ('Activity', bool()), ('ActivityTimestamp', datetime.fromtimestamp(0)), 
+                     ('LightState', 0)]
+        variables += [(tag, content.get(key, '')) for key, tag in self.CONTENT_TAGS.items()]
+
+        # pick latency statistics in seconds
+        variables.append(('PickCount', 0))
+        for metric, tag in self.STATS_TAGS:
+            for quantile in ['p50', 'p95', 'p99']:
+                variables.append(('{}{}'.format(tag, quantile.upper()), 0.0))
+        return variables
+
+    def _command_variables(self, port_number=None):
+        """Get the command tags of a port. They are for clients that does not support ua methods.
+
+        Args:
+            port_number (int, optional): port number. Defaults to None meaning the tags of PortCommandType without content.
+
+        Returns:
+            list: [(tag name, initial value)]
+        """
+        content = self._pbl.get_content(port_number) if port_number is not None else {}
+        variables = [('Select', bool()), ('Deselect', bool()), ('Instructions', ""), ('Amount', 1)]
+        variables += [(tag, content.get(key, '')) for key, tag in self.CONTENT_TAGS.items()]
+        return variables
+
+    def _port_node_items(self, ua):
+        """Make everything needed to add the port object types and the status and command objects of all ports
+        with a single add_nodes and a single add_references call.
+
+        PortStatusType and PortCommandType are defined once with the tags as mandatory variables. Every port gets 
+        a Status.Port_<n> object of PortStatusType and a Command.Port_<n> object of PortCommandType. Their variables 
+        have the NodeIds Status.Port_<n>.<tag> and Command.Port_<n>.<tag>, so clients can address them without browsing.
+
+        Args:
+            ua: the ua module of the backend. The opcua and asyncua ua modules have the same types.
+
+        Returns:
+            tuple: ([AddNodesItem], [AddReferencesItem])
+        """
+        items = []
+        references = []
+        templates = [('Status', 'PortStatusType', self._status_variables, False),
+                     ('Command', 'PortCommandType', self._command_variables, True)]
+
+        # the object types with their variables
+        for folder, type_name, variables, writable in templates:
+            type_id = ua.NodeId.from_string('ns=2;s=Types.{}'.format(type_name))
+            items.append(_object_item(ua, type_id, type_name, ua.NodeId(ua.ObjectIds.BaseObjectType), ua.ObjectIds.HasSubtype, ua.NodeClass.ObjectType))
+            for name, value in variables():
+                nodeid = ua.NodeId.from_string('ns=2;s=Types.{}.{}'.format(type_name, name))
+                items.append(_variable_item(ua, nodeid, name, type_id, value, writable))
+                reference = ua.AddReferencesItem()
+                reference.SourceNodeId = nodeid
+                reference.TargetNodeId = ua.NodeId(ua.ObjectIds.ModellingRule_Mandatory)
+                reference.ReferenceTypeId = ua.NodeId(ua.ObjectIds.HasModellingRule)
+                reference.IsForward = True
+                references.append(reference)
+
+        # an instance of each type per port
+        for port_number, port in self._pbl.get_ports():
+            for folder, type_name, variables, writable in templates:
+                object_id = ua.NodeId.from_string('ns=2;s={}.Port_{}'.format(folder, port_number))
+                items.append(_object_item(ua, object_id, 'Port_{}'.format(port_number), ua.NodeId.from_string('ns=2;s={}'.format(folder)), 
+                                          ua.ObjectIds.Organizes, type_definition=ua.NodeId.from_string('ns=2;s=Types.{}'.format(type_name))))
+                for name, value in variables(port_number):
+                    nodeid = ua.NodeId.from_string('ns=2;s={}.Port_{}.{}'.format(folder, port_number, name))
+                    items.append(_variable_item(ua, nodeid, name, object_id, value, writable))
+        return items, references
+
+    def _event_type_items(self, ua):
+        """Make the items that add the station event types with add_nodes. They are subtypes of BaseEventType 
+        with the PortNumber and ContentName properties and have the NodeIds Types.<event type>.
+
+        Args:
+            ua: the ua module of the backend
+
+        Returns:
+            list: [AddNodesItem]
+        """
+        items = []
+        for name, severity in self.EVENT_TYPES:
+            type_id = ua.NodeId.from_string('ns=2;s=Types.{}'.format(name))
+            items.append(_object_item(ua, type_id, name, ua.NodeId(ua.ObjectIds.BaseEventType), ua.ObjectIds.HasSubtype, ua.NodeClass.ObjectType))
+            for prop, value in self.EVENT_PROPERTIES:
+                nodeid = ua.NodeId.from_string('ns=2;s=Types.{}.{}'.format(name, prop))
+                items.append(_variable_item(ua, nodeid, prop, type_id, value, is_property=True))
+        return items
+
+    def _diagnostics_items(self, ua):
+        """Make the items that add the Status.Commands object with the command queue statistics and the 
+        Status.Festo object with the festo connection status with add_nodes
+
+        Args:
+            ua: the ua module of the backend
+
+        Returns:
+            list: [AddNodesItem]
+        """
+        items = []
+        for name, variables in [('Commands', [(tag, 0) for stat, tag in self.COMMAND_STATS_TAGS]),
+                                ('Festo', [(tag, value) for key, tag, value in self.FESTO_TAGS])]:
+            object_id = ua.NodeId.from_string('ns=2;s=Status.{}'.format(name))
+            items.append(_object_item(ua, object_id, name, ua.NodeId.from_string('ns=2;s=Status'), ua.ObjectIds.Organizes))
+            for tag, value in variables:
+                items.append(_variable_item(ua, ua.NodeId.from_string('ns=2;s=Status.{}.{}'.format(name, tag)), tag, object_id, value))
+        return items
+
+    def _method_callbacks(self):
+        """Returns:
+            dict: {NodeId string of a ua method: callback}
+        """
+        return {'ns=2;s=Command.SelectPort': self._select_method,
+                'ns=2;s=Command.DeselectPort': self._deselect_method,
+                'ns=2;s=Command.DeselectAllPorts': self._deselect_all_method,
+                'ns=2;s=Command.SelectBatch': self._select_batch_method}
+
+    def _address_space_layout(self):
+        """Everything our part of the address space is built from. Used as the key of the address space snapshot.
+
+        Returns:
+            tuple: the ports with their initial tag values, the ByContent tags, the methods, the event types and the diagnostics tags
+        """
+        ports = [(port_number, self._status_variables(port_number), self._command_variables(port_number)) 
+                 for port_number, port in self._pbl.get_ports()]
+        return (ports, self.BY_CONTENT_VARIABLES, sorted(self._method_callbacks()), self.EVENT_TYPES, self.EVENT_PROPERTIES, 
+                self.COMMAND_STATS_TAGS, self.FESTO_TAGS)
+
+    def _resolve_nodes(self):
+        """Get the handles of our nodes when the address space was loaded from a snapshot instead of being built"""
+        self.Status = self.ua_server.get_node('ns=2;s=Status')
+        self.Command = self.ua_server.get_node('ns=2;s=Command')
+        for port_number, port in self._pbl.get_ports():
+            self._status_nodes[port_number] = {name: self.ua_server.get_node("ns=2;s=Status.Port_{}.{}".format(port_number, name)) 
+                                               for name, value in self._status_variables(port_number)}
+            self._command_nodes[port_number] = {name: self.ua_server.get_node("ns=2;s=Command.Port_{}.{}".format(port_number, name)) 
+                                                for name, value in self._command_variables(port_number)}
+        self._by_content_nodes = {name: self.ua_server.get_node("ns=2;s=Command.ByContent.{}".format(name)) 
+                                  for name, value in self.BY_CONTENT_VARIABLES}
+        self._command_stats_nodes = {tag: self.ua_server.get_node("ns=2;s=Status.Commands.{}".format(tag)) 
+                                     for stat, tag in self.COMMAND_STATS_TAGS}
+        self._festo_nodes = {tag: self.ua_server.get_node("ns=2;s=Status.Festo.{}".format(tag)) for key, tag, value in self.FESTO_TAGS}
+        self._build_dispatch()
+
+    def _build_dispatch(self):
+        """Map the NodeId of every command tag that needs handling to its port number, handler and command queue key.
+        Select and Deselect of a port share a key so only the last of them waiting in the queue runs.
+        The tag of the one that does not run is reset by the command queue, see datachange_notification.
+        The ByContent commands never coalesce because each of them can select a different content.
+        """
+        for port_number, nodes in self._command_nodes.items():
+            self._pulse_nodes.update([nodes['Select'].nodeid, nodes['Deselect'].nodeid])
+            self._dispatch[nodes['Select'].nodeid] = (port_number, self._port_select_changed, ('Port', port_number))
+            self._dispatch[nodes['Deselect'].nodeid] = (port_number, self._port_deselect_changed, ('Port', port_number))
+            for key, tag in self.CONTENT_TAGS.items():
+                self._dispatch[nodes[tag].nodeid] = (port_number, partial(self._content_tag_changed, key), (tag, port_number))
+        self._dispatch[self._by_content_nodes['Select'].nodeid] = (None, self._content_select_changed, None)
+        self._dispatch[self._by_content_nodes['Deselect'].nodeid] = (None, self._content_deselect_changed, None)
+        self._pulse_nodes.update([self._by_content_nodes['Select'].nodeid, self._by_content_nodes['Deselect'].nodeid])
+
+    def _mark_own_write(self, node, value):
+        """Remember that the server writes a value to a subscribed command tag itself. Call it before writing."""
+        self._own_writes[node.nodeid] = value
+
+    def _ignore_notification(self, nodeid, value):
+        """Check if a data change of a command tag is not a command. It is not if the server caused it itself, 
+        like resetting Select to False, or if a client resets Select or Deselect. Letting a reset into the 
+        command queue would coalesce away the Select it resets.
+
+        Args:
+            nodeid (NodeId): the command tag that changed
+            value (any): the new value
+
+        Returns:
+            bool: True if the change must be ignored
+        """
+        own_write = nodeid in self._own_writes and self._own_writes.pop(nodeid) == value
+        if own_write or (nodeid in self._pulse_nodes and value is False):
+            self.ignored_notifications += 1
+            return True
+        return False
+
+    def _command_stats_values(self, stats):
+        """Get the Status.Commands tag values
+
+        Args:
+            stats (dict): CommandQueue.stats()
+
+        Returns:
+            list: [(Node, value)]
+        """
+        stats = dict(stats, ignored=self.ignored_notifications)
+        return [(self._command_stats_nodes[tag], stats[stat]) for stat, tag in self.COMMAND_STATS_TAGS]
+
+    def _festo_values(self, status):
+        """Get the Status.Festo tag values
+
+        Args:
+            status (dict): FestoServer.status()
+
+        Returns:
+            list: [(Node, value)]
+        """
+        # a missing value like connected_since of a disconnected server is written as the initial value
+        return [(self._festo_nodes[tag], status[key] if status.get(key) is not None else value) for key, tag, value in self.FESTO_TAGS]
+
+    def _batch_lines(self, targets, amounts, instructions):
+        """Turn the arguments of the SelectBatch method into lines for PickByLight.select_batch.
+        Targets are strings so a line can be either a port number, a rack qualified port number or a content name. 
+        Amounts and instructions may be shorter than targets, missing values get the defaults.
+
+        Returns:
+            list: [(port number or content name, amount, instructions)]
+        """
+        targets = targets or []
+        amounts = amounts or []
+        instructions = instructions or []
+        lines = []
+        for i, target in enumerate(targets):
+            port_number = self._pbl.find_port_number(target)
+            target = port_number if port_number is not None else target
+            amount = amounts[i] if i < len(amounts) else 1
+            instruction = instructions[i] if i < len(instructions) else ''
+            lines.append((target, amount, instruction))
+        return lines
+
+    def _collect_values(self, events, activity_deadlines):
+        """Find the status tag values to write for a group of state change events
+
+        Args:
+            events (list): the StateEvents to handle
+            activity_deadlines (dict): {port number: monotonic time when the activity flag turns off again}. 
+                Updated with the new activity and the ports whose deadline has passed are removed.
+
+        Returns:
+            tuple: ({port_number: {tag name: value}}, [(port_number, {key: new value}) of the content changes])
+        """
+        # port number -> {tag: value} to write
+        values = {}
+        content_changes = []
+        for event in events:
+            if event.kind == event_bus.LIGHT_CHANGED:
+                values.setdefault(event.port_number, {})['LightState'] = event.data
+            elif event.port_number is None:
+                for port_number, port in self._pbl.get_ports():
+                    values.setdefault(port_number, {}).update(self._port_values(port_number))
+            elif event.kind == event_bus.CONTENT_CHANGED:
+                values.setdefault(event.port_number, {}).update(self._content_values(event.port_number))
+                content_changes.append((event.port_number, event.data))
+            else:
+                values.setdefault(event.port_number, {}).update(self._port_values(event.port_number))
+                if event.kind == event_bus.WORK_FINISHED:
+                    values[event.port_number].update(self._stats_values(event.port_number))
+                if event.kind == event_bus.ACTIVITY:
+                    cooldown = self._pbl.get_port(event.port_number).cooldown_time.total_seconds()
+                    activity_deadlines[event.port_number] = monotonic() + cooldown
+
+        now = monotonic()
+        for port_number, deadline in list(activity_deadlines.items()):
+            if deadline <= now:
+                del activity_deadlines[port_number]
+                values.setdefault(port_number, {}).update(self._port_values(port_number))
+        return values, content_changes
+
+    def _station_events(self, events, selection_deadlines):
+        """Find the state changes that are raised as UA events. Activity on a port that is not selected, 
+        finished work and ports that stay selected longer than the selection timeout are raised.
+
+        Args:
+            events (list): [StateEvent] that happened since the last call
+            selection_deadlines (dict): {port_number: monotonic time when the selection times out}. Updated in place.
+
+        Returns:
+            list: [(event type name, port_number, utc datetime when it happened)]
+        """
+        raised = []
+        for event in events:
+            if event.kind == event_bus.ACTIVITY and not event.data['selected']:
+                raised.append(('WrongPortActivityEventType', event.port_number, event.timestamp.astimezone(timezone.utc)))
+            elif event.kind == event_bus.WORK_FINISHED:
+                raised.append(('WorkFinishedEventType', event.port_number, event.timestamp.astimezone(timezone.utc)))
+
+            if self.selection_timeout is None:
+                continue
+            if event.kind == event_bus.PORT_SELECTED:
+                selection_deadlines[event.port_number] = monotonic() + self.selection_timeout
+            elif event.kind == event_bus.PORT_DESELECTED:
+                selection_deadlines.pop(event.port_number, None)
+
+        now = monotonic()
+        for port_number, deadline in list(selection_deadlines.items()):
+            if deadline <= now:
+                del selection_deadlines[port_number]
+                raised.append(('SelectionTimeoutEventType', port_number, datetime.now(timezone.utc)))
+        return raised
+
+    def _fill_event(self, ua, event, name, port_number):
+        """Set the fields of a station event before it is triggered
 
-        self.ua_server.start()
+        Args:
+            ua: the ua module of the backend
+            event (BaseEvent): the event of the event generator of the event type
+            name (str): event type name, one of EVENT_TYPES
+            port_number (int): the port the event is about
+
+        Returns:
+            str: the message of the event
+        """
+        content_name = self._pbl.get_content(port_number).get('name', '')
+        event.PortNumber = port_number
+        event.ContentName = content_name
+        event.Severity = dict(self.EVENT_TYPES)[name]
+        event.SourceNode = ua.NodeId.from_string('ns=2;s=Status.Port_{}'.format(port_number))
+        event.SourceName = 'Port_{}'.format(port_number)
+        messages = {'WrongPortActivityEventType': 'activity on port {} ({}) which is not selected',
+                    'WorkFinishedEventType': 'work finished on port {} ({})',
+                    'SelectionTimeoutEventType': 'port {} ({}) has been selected for too long'}
+        return messages[name].format(port_number, content_name)
+
+    def _changed_values(self, values):
+        """Get the status tag values that differ from the last written values
+
+        Args:
+            values (dict): {port_number: {tag name: value}}
+
+        Returns:
+            list: [(Node, value)]
+        """
+        changed = []
+        for port_number, tags in values.items():
+            nodes = self._status_nodes.get(port_number)
+            if nodes is None:
+                continue
+            for tag, value in tags.items():
+                node = nodes[tag]
+                if node in self._published and self._published[node] == value:
+                    continue
+                changed.append((node, value))
+        return changed
+
+    def _history_write_params(self, ua):
+        """Start the history of the historized status tags and make the write that marks them as historized,
+        so clients know they can read their history. Must be done after the address space is built or loaded,
+        the snapshot is of the address space without history.
+
+        Args:
+            ua: the ua module of the backend
+
+        Returns:
+            WriteParameters: sets Historizing and the HistoryRead access level of the tags
+        """
+        params = ua.WriteParameters()
+        params.NodesToWrite = []
+        access = ua.AccessLevel.CurrentRead.mask | ua.AccessLevel.HistoryRead.mask
+        for port_number, nodes in self._status_nodes.items():
+            for tag in self._history_tags:
+                if tag not in nodes:
+                    logger.warning('can not keep a history of {}, there is no such status tag'.format(tag))
+                    continue
+                nodeid = nodes[tag].nodeid
+                self.history.new_historized_node(nodeid)
+                for attribute, variant in [(ua.AttributeIds.Historizing, ua.Variant(True, ua.VariantType.Boolean)),
+                                           (ua.AttributeIds.AccessLevel, ua.Variant(access, ua.VariantType.Byte)),
+                                           (ua.AttributeIds.UserAccessLevel, ua.Variant(access, ua.VariantType.Byte))]:
+                    write_value = ua.WriteValue()
+                    write_value.NodeId = nodeid
+                    write_value.AttributeId = attribute
+                    write_value.Value = ua.DataValue(variant)
+                    params.NodesToWrite.append(write_value)
+        return params
+
+    def _written(self, changed, datavalues, results):
+        """Remember the values that were written and add them to the history
+
+        Args:
+            changed (list): [(Node, value)] that were written
+            datavalues (list): the DataValue written for each of them
+            results (list): status code of each write
+        """
+        for (node, value), datavalue, result in zip(changed, datavalues, results):
+            if result.is_good():
+                self._published[node] = value
+                if self.history is not None:
+                    # the updater writes every transition, so no edge is missed like with sampling subscriptions
+                    self.history.save_node_value(node.nodeid, datavalue)
+            else:
+                # forget the value so it is written again next time
+                self._published.pop(node, None)
+                logger.error('could not write {} to {}. Status = {}'.format(value, node, result))
+
+    def _command_content_values(self, changed):
+        """Get the command content tag values for changed content fields
+
+        Args:
+            changed (dict): {key: new value} of the changed content fields
+
+        Returns:
+            dict: {tag name: value}
+        """
+        return {self.CONTENT_TAGS[key]: '' if value is None else str(value) 
+                for key, value in changed.items() if key in self.CONTENT_TAGS}
+
+    def _content_values(self, port_number):
+        """Get the content and stock status tag values of a port. The stock is -1 if the port does not count stock.
+
+        Args:
+            port_number (int): port number
+
+        Returns:
+            dict: {tag name: value}
+        """
+        content = self._pbl.get_content(port_number)
+        values = {tag: '' if content.get(key) is None else str(content[key]) for key, tag in self.CONTENT_TAGS.items()}
+        stock = self._pbl.get_stock(port_number)
+        values['Stock'] = -1 if stock is None else stock
+        values['LowStock'] = self._pbl.is_low_stock(port_number)
+        return values
+
+    def _stats_values(self, port_number):
+        """Get the pick latency statistics status tag values of a port
+
+        Args:
+            port_number (int): port number
+
+        Returns:
+            dict: {tag name: value}. Empty if the port has no completed picks.
+        """
+        stats = self._pbl.get_pick_stats()['ports'].get(port_number)
+        if stats is None:
+            return {}
+        values = {'PickCount': stats['cycle_time']['count']}
+        for metric, tag in self.STATS_TAGS:
+            for quantile in ['p50', 'p95', 'p99']:
+                values['{}{}'.format(tag, quantile.upper())] = float(stats[metric][quantile] or 0.0)
+        return values
+
+    def _port_values(self, port_number):
+        """Get the state, light, activity and content status tag values of a port
+
+        Args:
+            port_number (int): port number
+
+        Returns:
+            dict: {tag name: value}
+        """
+        port = self._pbl.get_port(port_number)
+        state = self._pbl.get_port_state(port_number)
+        values = {'Activity': port.activity,
+                  'ActivityTimestamp': port.activity_timestamp,
+                  'LightState': port.get_light(),
+                  'Selected': state.selected,
+                  'WorkFinished': state.work_finished,
+                  'Instructions': state.select_instructions,
+                  'AmountToPick': state.amount_to_pick}
+        values.update(self._content_values(port_number))
+        return values
+
+
+
+class StationUAServer(StationUABase):
+    """OPC UA server of the station on the thread based opcua package"""
+
+    def __init__(self, pick_by_light, **options):
+        """Constructor: Starts the server and returns when it is serving.
+
+        Args:
+            pick_by_light (PickByLight): the pick by light to serve
+            options: history, event and command queue options, see StationUABase
+        """
+        super().__init__(pick_by_light, **options)
+        # command tag changes are handled one at a time in the command queue thread instead of in the subscription thread
+        self.commands = CommandQueue(self.max_pending_commands, self.command_window, on_drained=self._write_command_stats)
+        # seconds spent in each phase of the startup
+        self.startup = ua_startup.StartupTimer()
+        with self.startup.phase('server'):
+            self._setup_server()
+        with self.startup.phase('certificate'):
+            self._load_certificate()
+        with self.startup.phase('address_space'):
+            self._setup_address_space()
+        if self.history is not None:
+            with self.startup.phase('history'):
+                self._setup_history()
+        with self.startup.phase('events'):
+            self._setup_events()
+
+        with self.startup.phase('start'):
+            self.ua_server.start()
         
-        self._generate_subscriptions()
+        with self.startup.phase('subscriptions'):
+            self._generate_subscriptions()
         Thread(target=self._var_updater, daemon=True).start()
+        logger.info('ua server ready in {:.3f}s: {}'.format(self.startup.total(), self.startup))
 
-    def _setup_nodes(self):        
-        
-        # Create server instance 
-        self.ua_server = Server('./opcua_cache')
+    def stop(self):
+        """Stop the server"""
+        self.ua_server.stop()
+
+    def _setup_server(self):
+        # Create server instance. The standard address space is cached in opcua_cache.
+        if hasattr(collections, 'MutableMapping'):
+            shelf = ua_startup.standard_address_space_shelf('./opcua_cache')
+        else:
+            # opcua can't load its shelf on python 3.10 and newer, so making it would only cost time
+            shelf = None
+        self.ua_server = Server(shelf)
         self.ua_server.set_endpoint('opc.tcp://0.0.0.0:4840/UA/PickByLight')
         self.ua_server.set_server_name("Pick By Light Server")
         # idx name will be used later for creating the xml used in data type dictionary
@@ -37,6 +709,43 @@ class StationUAServer:
             ua.SecurityPolicyType.Basic256_SignAndEncrypt,
             ua.SecurityPolicyType.Basic256_Sign])
 
+    def _load_certificate(self):
+        # The encrypted policies need a certificate. It is made at the first boot and reused after that.
+        try:
+            certificate_path, private_key_path = ua_startup.ensure_certificate(self.ua_server.get_application_uri())
+            self.ua_server.load_certificate(certificate_path)
+            self.ua_server.load_private_key(private_key_path)
+        except Exception:
+            logger.exception('could not load a certificate. Only the NoSecurity policy is available')
+
+    def _setup_address_space(self):
+        # Load our nodes in bulk from the snapshot of an earlier boot with the same ports and content, else build them
+        aspace = self.ua_server.iserver.aspace
+        path = ua_startup.snapshot_path(ua_startup.snapshot_key(self._address_space_layout()), 'opcua')
+        if ua_startup.load_address_space(aspace, path):
+            for nodeid, callback in self._method_callbacks().items():
+                self.ua_server.iserver.isession.add_method_callback(ua.NodeId.from_string(nodeid), callback)
+            self._resolve_nodes()
+            return
+        self._setup_nodes()
+        self._generate_tags()
+        try:
+            ua_startup.save_address_space(aspace, path, self.idx)
+        except OSError:
+            logger.exception('could not save the address space snapshot')
+
+    def _setup_history(self):
+        # HistoryRead of the historized status tags is served from our ring buffers
+        self.ua_server.iserver.history_manager.set_storage(self.history)
+        for result in self.ua_server.iserver.isession.write(self._history_write_params(ua)):
+            result.check()
+
+    def _setup_events(self):
+        # The station events are emitted by the Server object so clients get them with a single event subscription
+        self._event_generators = {name: self.ua_server.get_event_generator(ua.NodeId.from_string('ns=2;s=Types.{}'.format(name)))
+                                  for name, severity in self.EVENT_TYPES}
+
+    def _setup_nodes(self):
         # get Objects node, this is where we should put our custom stuff
         objects = self.ua_server.get_objects_node()
 
@@ -46,87 +755,42 @@ class StationUAServer:
         self.Command.add_method('ns=2;s=Command.SelectPort', "SelectPort", self._select_method, [ua.VariantType.Int32, ua.VariantType.String], [ua.VariantType.Boolean])
         self.Command.add_method('ns=2;s=Command.DeselectPort', "DeselectPort", self._deselect_method, [ua.VariantType.Int32], [ua.VariantType.Boolean])
         self.Command.add_method('ns=2;s=Command.DeselectAllPorts', "DeselectAllPorts", self._deselect_all_method, [], [ua.VariantType.Boolean])
-
-
-        root = self.ua_server.get_root_node()
-        DummyFestoObj = root.add_object("ns=2;s=|var|CECC-LK.Application.Flexstation_globalVariables", "DummyFesto")
-        DummyFestoObj.add_variable("ns=2;s=|var|CECC-LK.Application.Flexstation_globalVariables.FlexStationStatus", "FlexStationStatus", val=0).set_writable()
-        DummyFestoObj.add_variable("ns=2;s=|var|CECC-LK.Application.FBs.stpStopper1.stAppControl.uiOpNo","uiOpNo", val=0).set_writable()
-        DummyFestoObj.add_variable("ns=2;s=ns=2;s=|var|CECC-LK.Application.AppModul.stRcvData.sOderDes","sOderDes", val="").set_writable()
-        
+        self.Command.add_method('ns=2;s=Command.SelectBatch', "SelectBatch", self._select_batch_method, 
+                                [array_argument(ua, 'Targets', ua.VariantType.String, 'Port number or content name for each line'),
+                                 array_argument(ua, 'Amounts', ua.VariantType.Int32, 'Amount to pick for each line. Defaults to 1'),
+                                 array_argument(ua, 'Instructions', ua.VariantType.String, 'Instructions for each line. Defaults to empty')],
+                                [ua.VariantType.Boolean,
+                                 array_argument(ua, 'Ports', ua.VariantType.Int32, 'Selected port for each line. -1 if the line failed')])
 
     def _generate_tags(self):
-        # for all ports generate tags
-        for port_number, port in self._pbl.get_ports():
-            # Make a folder with the port_number as the name
-            b_obj = self.Status.add_object('ns=2;s=Status.Port_{}'.format(port_number), "Port_{}".format(port_number))
-            
-            content = self._pbl.get_content(port_number)
-
-            b_obj.add_variable("ns=2;s=Status.Port_{}.Selected".format(port_number)             ,"Selected"            , bool())
-            b_obj.add_variable("ns=2;s=Status.Port_{}.WorkFinished".format(port_number)         ,"WorkFinished"        , bool())
-            b_obj.add_variable("ns=2;s=Status.Port_{}.Instructions".format(port_number)         ,"Instructions"        , "")
-            b_obj.add_variable("ns=2;s=Status.Port_{}.Activity".format(port_number)             ,"Activity"            , bool())
-            b_obj.add_variable("ns=2;s=Status.Port_{}.ActivityTimestamp".format(port_number)    ,"ActivityTimestamp"   , datetime.fromtimestamp(0))
-            b_obj.add_variable("ns=2;s=Status.Port_{}.LightState".format(port_number)           ,"LightState"          , 0)
-            b_obj.add_variable("ns=2;s=Status.Port_{}.ContentDisplayName".format(port_number)   ,"ContentDisplayName"  , content['display_name'])
-            b_obj.add_variable("ns=2;s=Status.Port_{}.ContentName".format(port_number)          ,"ContentName"         , content['name'])
-            b_obj.add_variable("ns=2;s=Status.Port_{}.ContentDescription".format(port_number)   ,"ContentDescription"  , content['description'])
-            b_obj.add_variable("ns=2;s=Status.Port_{}.ContentImagePath".format(port_number)     ,"ContentImagePath"    , content['image_path'])
-
-            '''
-            create command tags for clients that does not support ua methods. 
-            '''
-            b_obj = self.Command.add_object('ns=2;s=Command.Port_{}'.format(port_number), "Port_{}".format(port_number))
-
-            b_obj.add_variable("ns=2;s=Command.Port_{}.Select".format(port_number)               ,"Select"              , bool()).set_writable()
-            b_obj.add_variable("ns=2;s=Command.Port_{}.Deselect".format(port_number)             ,"Deselect"            , bool()).set_writable()
-            b_obj.add_variable("ns=2;s=Command.Port_{}.Instructions".format(port_number)         ,"Instructions"        , "").set_writable()
-            b_obj.add_variable("ns=2;s=Command.Port_{}.ContentDisplayName".format(port_number)   ,"ContentDisplayName"  , content['display_name']).set_writable()
-            b_obj.add_variable("ns=2;s=Command.Port_{}.ContentName".format(port_number)          ,"ContentName"         , content['name']).set_writable()
-            b_obj.add_variable("ns=2;s=Command.Port_{}.ContentDescription".format(port_number)   ,"ContentDescription"  , content['description']).set_writable()
-            b_obj.add_variable("ns=2;s=Command.Port_{}.ContentImagePath".format(port_number)     ,"ContentImagePath"    , content['image_path']).set_writable()
+        # for all ports generate tags as instances of the port object types, and the station event types
+        items, references = self._port_node_items(ua)
+        items += self._event_type_items(ua) + self._diagnostics_items(ua)
+        for result in self.ua_server.iserver.isession.add_nodes(items):
+            result.StatusCode.check()
+        for result in self.ua_server.iserver.isession.add_references(references):
+            result.check()
         
         '''
         Generate some common commands 
         '''
         # Make a folder for the commons
         b_obj = self.Command.add_object('ns=2;s=Command.ByContent', 'ByContent')
+        for name, value in self.BY_CONTENT_VARIABLES:
+            b_obj.add_variable("ns=2;s=Command.ByContent.{}".format(name), name, value).set_writable()
 
-        b_obj.add_variable("ns=2;s=Command.ByContent.Select"         ,"Select"          , bool()).set_writable()
-        b_obj.add_variable("ns=2;s=Command.ByContent.Deselect"       ,"Deselect"        , bool()).set_writable()
-        b_obj.add_variable("ns=2;s=Command.ByContent.Name"           ,"Name"            , ""    ).set_writable()
-        b_obj.add_variable("ns=2;s=Command.ByContent.Instructions"   ,"Instructions"    , ""    ).set_writable()
-        b_obj.add_variable("ns=2;s=Command.ByContent.Result"         ,"Result"          , -1    ).set_writable()
-
-
+        self._resolve_nodes()
 
     def _generate_subscriptions(self):
         # Create UA subscriber node for the box. Set self as handler.
         sub = self.ua_server.create_subscription(100, self)
- 
-        # Subscribe to the Select tag and all the content tags
-        for port_number, port in self._pbl.get_ports():
-            ac = self.ua_server.get_node("ns=2;s=Command.Port_{}.Select".format(port_number))
-            sub.subscribe_data_change(ac)
-            ac = self.ua_server.get_node("ns=2;s=Command.Port_{}.Deselect".format(port_number))
-            sub.subscribe_data_change(ac)
-            b = self.ua_server.get_node("ns=2;s=Command.Port_{}.ContentDisplayName".format(port_number))
-            sub.subscribe_data_change(b)
-            c = self.ua_server.get_node("ns=2;s=Command.Port_{}.ContentName".format(port_number))
-            sub.subscribe_data_change(c)
-            d = self.ua_server.get_node("ns=2;s=Command.Port_{}.ContentDescription".format(port_number))
-            sub.subscribe_data_change(d)
-            e = self.ua_server.get_node("ns=2;s=Command.Port_{}.ContentImagePath".format(port_number))
-            sub.subscribe_data_change(e)
-            a = self.ua_server.get_node("ns=2;s=Command.ByContent.Select")  
-            sub.subscribe_data_change(a)
-            a = self.ua_server.get_node("ns=2;s=Command.ByContent.Deselect")  
-            sub.subscribe_data_change(a)
-            a = self.ua_server.get_node("ns=2;s=Command.ByContent.Name")  
-            sub.subscribe_data_change(a)
-            a = self.ua_server.get_node("ns=2;s=Command.ByContent.Instructions")
-            sub.subscribe_data_change(a)
+
+        # Subscribe once to every command tag in the dispatch table, in a single request.
+        # The subscription first reports the current values, they are not commands.
+        nodes = [self.ua_server.get_node(nodeid) for nodeid in self._dispatch]
+        for node in nodes:
+            self._mark_own_write(node, self._read_value(node))
+        sub.subscribe_data_change(nodes)
 
     def _event_notification(self, event):
         logger.warning("Python: New event. No function implemented. {}".format(event))
@@ -143,104 +807,183 @@ class StationUAServer:
         r = self._pbl.deselect_all()
         return [ua.Variant(value = r,varianttype=ua.VariantType.Boolean)]
 
+    def _select_batch_method(self, parrent, targets, amounts, instructions):
+        r, results = self._pbl.select_batch(self._batch_lines(targets.Value, amounts.Value, instructions.Value))
+        ports = [port_number for _, port_number in results]
+        return [ua.Variant(value = r, varianttype=ua.VariantType.Boolean),
+                ua.Variant(value = ports, varianttype=ua.VariantType.Int32)]
+
     def datachange_notification(self, node, val, data):
         """UA server callback on data change notifications        
         Arguments:
-            node {Node} -- [description]
-            val {[type]} -- [description]
+            node {Node} -- the command tag that changed
+            val {[type]} -- the new value
             data {[type]} -- [description]
         """
         
         logger.debug("New data change event. node:{}, value:{}".format(node, val))
-        
-        # Sorry about these lines of code, but I don't see any nicer way of determining the port number than from 
-        # the identifier string. Then splitting it up to isolate the port number.
-        # Example "Status.Port_2.Selected"  is split into ['Status', 'Port_2', 'Selected'] then 'Port_2' is split into 
-        # ['Port', '2'] and then the '2' is turned into an intiger.
-        path_list = str(node.nodeid.Identifier).split(".")
-
-        # We can safely assume that the last term is the tag that updated.
-        tag = path_list[-1] 
-        
-        # Figure out the port number
-        port_number = None
-        if 'Port' in path_list[1]:
-            port_number = int(path_list[1].split("_")[-1])        
-    
-        """ Switch for each possible tag"""
+
+        entry = self._dispatch.get(node.nodeid)
+        if entry is None:
+            logger.warning('data change on {} that has no handler'.format(node))
+            return
+        if self._ignore_notification(node.nodeid, val):
+            return
+        port_number, handler, key = entry
+        # a pulse tag whose command never runs is reset here, else it stays True and the next write of True is no change
+        on_discard = partial(self._reset_pulse, node.nodeid) if node.nodeid in self._pulse_nodes else None
+        self.commands.submit(key, handler, port_number, val, on_discard=on_discard)
+
+    def _reset_pulse(self, nodeid):
+        """Reset a Select or Deselect tag whose command was dropped or replaced"""
+        node = self.ua_server.get_node(nodeid)
+        self._mark_own_write(node, False)
+        node.set_value(False)
+
+    def _read_value(self, node):
+        """Read the current value of one of our own variables straight from the address space"""
+        return self.ua_server.iserver.aspace.get_attribute_value(node.nodeid, ua.AttributeIds.Value).Value.Value
+
+    def _port_select_changed(self, port_number, val):
         # If the command tag "Select" changes go select that port with the instructions saved in the command tag. 
-        if tag == 'Select' and port_number:
-            if val == True:
-                node = self.ua_server.get_node("ns=2;s=Command.Port_{}.Instructions".format(port_number))
-                instructions = node.get_value()
-                self._pbl.select_port(port_number, instructions=instructions)
-                # Reset the select flag
-                node = self.ua_server.get_node("ns=2;s=Command.Port_{}.Select".format(port_number))
-                node.set_value(False)
-        
-        elif tag == 'Deselect' and port_number:
-            if val == True:
-                self._pbl.deselect_port(port_number, work_finished=True)
-                # Reset the select flag
-                node = self.ua_server.get_node("ns=2;s=Command.Port_{}.Deselect".format(port_number))
-                node.set_value(False)
-
-        elif tag == 'ContentDisplayName' and port_number:
-                self._pbl.set_content_key(port_number,'display_name', str(val))
-        elif tag == 'ContentName' and port_number:
-                self._pbl.set_content_key(port_number,'name', str(val))
-        elif tag == 'ContentDescription' and port_number:
-                self._pbl.set_content_key(port_number,'description', str(val))
-        elif tag == 'ContentImagePath' and port_number:
-                self._pbl.set_content_key(port_number,'image_path', str(val))
-    
-        elif tag == 'Select' and 'ByContent' in path_list[1]:
-            if val == True:
-                instructions = self.ua_server.get_node("ns=2;s=Command.ByContent.Instructions").get_value()
-                name = self.ua_server.get_node("ns=2;s=Command.ByContent.Name").get_value()
-                _, selected_port = self._pbl.select_content(name = name, instructions=instructions)
-                # Reset the select flag
-                node = self.ua_server.get_node("ns=2;s=Command.ByContent.Select")
-                node.set_value(False)
-                node = self.ua_server.get_node("ns=2;s=Command.ByContent.Result")
-                node.set_value(selected_port)
-
-        elif tag == 'Deselect' and 'ByContent' in path_list[1]:
-            if val == True:
-                name = self.ua_server.get_node("ns=2;s=Command.ByContent.Name").get_value()
-                self._pbl.deselect_content(name = name, work_finished=True)
-                # Reset the select flag
-                node = self.ua_server.get_node("ns=2;s=Command.ByContent.Deselect")
-                node.set_value(False)
+        if val == True:
+            nodes = self._command_nodes[port_number]
+            instructions = self._read_value(nodes['Instructions'])
+            amount = self._read_value(nodes['Amount']) or 1
+            self._pbl.select_port(port_number, amount=amount, instructions=instructions)
+            # Reset the select flag
+            self._mark_own_write(nodes['Select'], False)
+            nodes['Select'].set_value(False)
 
+    def _port_deselect_changed(self, port_number, val):
+        if val == True:
+            self._pbl.deselect_port(port_number, work_finished=True)
+            # Reset the select flag
+            self._mark_own_write(self._command_nodes[port_number]['Deselect'], False)
+            self._command_nodes[port_number]['Deselect'].set_value(False)
+
+    def _content_tag_changed(self, key, port_number, val):
+        self._pbl.set_content_key(port_number, key, str(val))
+
+    def _content_select_changed(self, port_number, val):
+        if val == True:
+            nodes = self._by_content_nodes
+            instructions = self._read_value(nodes['Instructions'])
+            name = self._read_value(nodes['Name'])
+            amount = self._read_value(nodes['Amount']) or 1
+            _, selected_port = self._pbl.select_content(name = name, amount=amount, instructions=instructions)
+            # Reset the select flag
+            self._mark_own_write(nodes['Select'], False)
+            nodes['Select'].set_value(False)
+            nodes['Result'].set_value(selected_port)
+
+    def _content_deselect_changed(self, port_number, val):
+        if val == True:
+            nodes = self._by_content_nodes
+            self._pbl.deselect_content(name = self._read_value(nodes['Name']), work_finished=True)
+            # Reset the select flag
+            self._mark_own_write(nodes['Deselect'], False)
+            nodes['Deselect'].set_value(False)
 
     def _var_updater(self):
+        """Thread function that keeps the status tags up to date. It sleeps until the pick by light 
+        publishes a state change and then only looks at the ports that changed. 
+        The activity tags are refreshed once more when the activity cooldown of a port runs out. 
+        Events that arrive together are handled together and only tags whose value differs from 
+        the last written value are written, in a single batched write.
+        The station UA events are raised from here too, so the GPIO callbacks never wait for the UA server.
+        """
+        events = Queue()
+        self._pbl.subscribe(events.put)
+        self._write_changed({port_number: self._port_values(port_number) for port_number, port in self._pbl.get_ports()})
+
+        # port number -> monotonic time when the activity flag turns off again
+        activity_deadlines = {}
+        # port number -> monotonic time when the selection times out
+        selection_deadlines = {}
         while True:
-            sleep(0.1)
-            # for all boxes update tags
-            for port_number, port in self._pbl.get_ports():
-                # get the object in the packml status object using our unique idx
-                node = self.ua_server.get_node("ns=2;s=Status.Port_{}.Activity".format(port_number))
-                node.set_value(port.activity)          
-                node = self.ua_server.get_node("ns=2;s=Status.Port_{}.ActivityTimestamp".format(port_number))
-                node.set_value(port.activity_timestamp) 
-                node = self.ua_server.get_node("ns=2;s=Status.Port_{}.LightState".format(port_number))
-                node.set_value(port.get_light())            
-            
-                state = self._pbl.get_port_state(port_number)         
-                node = self.ua_server.get_node("ns=2;s=Status.Port_{}.Selected".format(port_number))
-                node.set_value(state.selected)
-                node = self.ua_server.get_node("ns=2;s=Status.Port_{}.WorkFinished".format(port_number))
-                node.set_value(state.work_finished)
-                node = self.ua_server.get_node("ns=2;s=Status.Port_{}.Instructions".format(port_number))
-                node.set_value(state.select_instructions)
-
-                content = self._pbl.get_content(port_number)
-                node = self.ua_server.get_node("ns=2;s=Status.Port_{}.ContentDisplayName".format(port_number))
-                node.set_value(content['display_name'])
-                node = self.ua_server.get_node("ns=2;s=Status.Port_{}.ContentName".format(port_number))
-                node.set_value(content['name'])
-                node = self.ua_server.get_node("ns=2;s=Status.Port_{}.ContentDescription".format(port_number))
-                node.set_value(content['description'])
-                node = self.ua_server.get_node("ns=2;s=Status.Port_{}.ContentImagePath".format(port_number))
-                node.set_value(content['image_path'])
+            timeout = None
+            deadlines = list(activity_deadlines.values()) + list(selection_deadlines.values())
+            if deadlines:
+                timeout = max(min(deadlines) - monotonic(), 0)
+            pending = []
+            try:
+                pending.append(events.get(timeout=timeout))
+                while True:
+                    pending.append(events.get_nowait())
+            except Empty:
+                pass
+
+            try:
+                values, content_changes = self._collect_values(pending, activity_deadlines)
+                for port_number, changed in content_changes:
+                    # a port of the content map without a hardware port has no command tags
+                    nodes = self._command_nodes.get(port_number)
+                    if nodes is None:
+                        continue
+                    # writing the same value to a command tag does not change the content, see set_content_key
+                    for tag, value in self._command_content_values(changed).items():
+                        self._mark_own_write(nodes[tag], value)
+                        nodes[tag].set_value(value)
+                self._write_changed(values)
+                self._trigger_events(self._station_events(pending, selection_deadlines))
+            except Exception:
+                # one bad event must not stop the updater
+                logger.exception('failed to update the status tags')
+
+    def _trigger_events(self, raised):
+        """Send station UA events to the subscribed clients
+
+        Args:
+            raised (list): [(event type name, port_number, utc datetime)] from _station_events
+        """
+        for name, port_number, time in raised:
+            generator = self._event_generators[name]
+            try:
+                message = self._fill_event(ua, generator.event, name, port_number)
+                # the opcua package uses naive utc times
+                generator.trigger(time.replace(tzinfo=None), message)
+            except Exception:
+                logger.exception('could not raise {} on port {}'.format(name, port_number))
+
+    def _write_changed(self, values):
+        """Write the status tag values that differ from the last written values in a single batched write
+
+        Args:
+            values (dict): {port_number: {tag name: value}}
+        """
+        self._write_nodes(self._changed_values(values))
+
+    def publish_festo_status(self, status):
+        """Show the festo connection status in Status.Festo. Can be called from any thread.
+
+        Args:
+            status (dict): FestoServer.status()
+        """
+        self._write_nodes(self._festo_values(status))
+
+    def _write_command_stats(self, stats):
+        """Command queue callback that writes the queue statistics to Status.Commands when the queue is drained"""
+        self._write_nodes(self._command_stats_values(stats))
+
+    def _write_nodes(self, changed):
+        """Write values to our variables in a single batched write
+
+        Args:
+            changed (list): [(Node, value)]
+        """
+        if not changed:
+            return
+        params = ua.WriteParameters()
+        datavalues = []
+        now = datetime.utcnow()
+        for node, value in changed:
+            write_value = ua.WriteValue()
+            write_value.NodeId = node.nodeid
+            write_value.AttributeId = ua.AttributeIds.Value
+            write_value.Value = ua.DataValue(ua.Variant(value))
+            write_value.Value.SourceTimestamp = now
+            write_value.Value.ServerTimestamp = now
+            params.NodesToWrite.append(write_value)
+            datavalues.append(write_value.Value)
+        self._written(changed, datavalues, self.ua_server.iserver.isession.write(params))
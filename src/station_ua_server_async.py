@@ -0,0 +1,352 @@
+from asyncua import ua, Server
+from functools import partial
+from threading import Thread
+from time import monotonic
+from datetime import datetime, timezone
+from pathlib import Path
+import asyncio
+
+from station_ua_server import StationUABase, array_argument
+from ua_history import AsyncRingBufferHistory
+from command_queue import AsyncCommandQueue
+import ua_startup
+
+import logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.WARNING)
+
+
+class AsyncStationUAServer(StationUABase):
+    """OPC UA server of the station on the asyncio based asyncua package.
+
+    Serves the same Status and Command address space as StationUAServer. The server, the command
+    handlers and the status updater all run as tasks on one event loop, so serving the station
+    takes a single thread instead of the server, subscription and updater threads of the opcua package.
+
+    The loop is either a dedicated loop thread started by the server, or a running loop given by
+    the caller so it can be shared with other asyncio clients.
+    """
+
+    def __init__(self, pick_by_light, loop=None, **options):
+        """Constructor: Starts the server and returns when it is serving.
+
+        Args:
+            pick_by_light (PickByLight): the pick by light to serve
+            loop (asyncio.AbstractEventLoop, optional): Running event loop to serve from. It must run in another thread.
+                Defaults to None meaning a dedicated loop thread is started.
+            options: history, event and command queue options, see StationUABase
+        """
+        super().__init__(pick_by_light, **options)
+        # seconds spent in each phase of the startup
+        self.startup = ua_startup.StartupTimer()
+        if loop is None:
+            loop = asyncio.new_event_loop()
+            Thread(target=loop.run_forever, daemon=True).start()
+        self.loop = loop
+        asyncio.run_coroutine_threadsafe(self._start(), loop).result()
+
+    def stop(self):
+        """Stop the server. Blocks until it is stopped."""
+        asyncio.run_coroutine_threadsafe(self.ua_server.stop(), self.loop).result()
+
+    async def _start(self):
+        with self.startup.phase('server'):
+            await self._setup_server()
+        with self.startup.phase('certificate'):
+            await self._load_certificate()
+        with self.startup.phase('address_space'):
+            await self._setup_address_space()
+        if self.history is not None:
+            with self.startup.phase('history'):
+                await self._setup_history()
+        with self.startup.phase('events'):
+            await self._setup_events()
+
+        with self.startup.phase('start'):
+            await self.ua_server.start()
+
+        # command tag changes are handled one at a time by the command queue task instead of by the subscription
+        self.commands = AsyncCommandQueue(self.max_pending_commands, self.command_window, on_drained=self._write_command_stats)
+        with self.startup.phase('subscriptions'):
+            await self._generate_subscriptions()
+        logger.info('ua server ready in {:.3f}s: {}'.format(self.startup.total(), self.startup))
+        self._events = asyncio.Queue()
+        # events are published from the event bus thread
+        self._pbl.subscribe(lambda event: self.loop.call_soon_threadsafe(self._events.put_nowait, event))
+        self._updater = self.loop.create_task(self._var_updater())
+
+    async def _setup_server(self):
+        # Create server instance. The standard address space is cached in opcua_cache_async.
+        self.ua_server = Server()
+        await self.ua_server.init(Path(ua_startup.standard_address_space_shelf('./opcua_cache_async')))
+        self.ua_server.set_endpoint('opc.tcp://0.0.0.0:4840/UA/PickByLight')
+        self.ua_server.set_server_name("Pick By Light Server")
+        # setup our own namespace, not really necessary but should as spec
+        idx_name = 'http://examples.freeopcua.github.io'
+        self.idx = await self.ua_server.register_namespace(idx_name)
+
+        # Set all possible endpoint policies for clients to connect through
+        self.ua_server.set_security_policy([
+            ua.SecurityPolicyType.NoSecurity,
+            ua.SecurityPolicyType.Basic128Rsa15_SignAndEncrypt,
+            ua.SecurityPolicyType.Basic128Rsa15_Sign,
+            ua.SecurityPolicyType.Basic256_SignAndEncrypt,
+            ua.SecurityPolicyType.Basic256_Sign])
+
+    async def _load_certificate(self):
+        # The encrypted policies need a certificate. It is made at the first boot and reused after that.
+        try:
+            certificate_path, private_key_path = ua_startup.ensure_certificate(self.ua_server.get_application_uri())
+            await self.ua_server.load_certificate(certificate_path)
+            await self.ua_server.load_private_key(private_key_path)
+        except Exception:
+            logger.exception('could not load a certificate. Only the NoSecurity policy is available')
+
+    async def _setup_address_space(self):
+        # Load our nodes in bulk from the snapshot of an earlier boot with the same ports and content, else build them
+        aspace = self.ua_server.iserver.aspace
+        path = ua_startup.snapshot_path(ua_startup.snapshot_key(self._address_space_layout()), 'asyncua')
+        if ua_startup.load_address_space(aspace, path):
+            for nodeid, callback in self._method_callbacks().items():
+                self.ua_server.iserver.isession.add_method_callback(ua.NodeId.from_string(nodeid), callback)
+            self._resolve_nodes()
+            return
+        await self._setup_nodes()
+        await self._generate_tags()
+        try:
+            ua_startup.save_address_space(aspace, path, self.idx)
+        except OSError:
+            logger.exception('could not save the address space snapshot')
+
+    async def _setup_history(self):
+        # HistoryRead of the historized status tags is served from our ring buffers
+        self.ua_server.iserver.history_manager.set_storage(AsyncRingBufferHistory(self.history))
+        for result in await self.ua_server.iserver.isession.write(self._history_write_params(ua)):
+            result.check()
+
+    async def _setup_events(self):
+        # The station events are emitted by the Server object so clients get them with a single event subscription
+        self._event_generators = {}
+        for name, severity in self.EVENT_TYPES:
+            self._event_generators[name] = await self.ua_server.get_event_generator(ua.NodeId.from_string('ns=2;s=Types.{}'.format(name)))
+
+    async def _setup_nodes(self):
+        objects = self.ua_server.nodes.objects
+        self.Status = await objects.add_folder('ns=2;s=Status', "Status")
+        self.Command = await objects.add_folder('ns=2;s=Command', "Command")
+        await self.Command.add_method('ns=2;s=Command.SelectPort', "SelectPort", self._select_method, [ua.VariantType.Int32, ua.VariantType.String], [ua.VariantType.Boolean])
+        await self.Command.add_method('ns=2;s=Command.DeselectPort', "DeselectPort", self._deselect_method, [ua.VariantType.Int32], [ua.VariantType.Boolean])
+        await self.Command.add_method('ns=2;s=Command.DeselectAllPorts', "DeselectAllPorts", self._deselect_all_method, [], [ua.VariantType.Boolean])
+        await self.Command.add_method('ns=2;s=Command.SelectBatch', "SelectBatch", self._select_batch_method,
+                                      [array_argument(ua, 'Targets', ua.VariantType.String, 'Port number or content name for each line'),
+                                       array_argument(ua, 'Amounts', ua.VariantType.Int32, 'Amount to pick for each line. Defaults to 1'),
+                                       array_argument(ua, 'Instructions', ua.VariantType.String, 'Instructions for each line. Defaults to empty')],
+                                      [ua.VariantType.Boolean,
+                                       array_argument(ua, 'Ports', ua.VariantType.Int32, 'Selected port for each line. -1 if the line failed')])
+
+    async def _generate_tags(self):
+        # for all ports generate tags as instances of the port object types, and the station event types
+        items, references = self._port_node_items(ua)
+        items += self._event_type_items(ua) + self._diagnostics_items(ua)
+        for result in await self.ua_server.iserver.isession.add_nodes(items):
+            result.StatusCode.check()
+        for result in await self.ua_server.iserver.isession.add_references(references):
+            result.check()
+
+        # Make a folder for the commons
+        b_obj = await self.Command.add_object('ns=2;s=Command.ByContent', 'ByContent')
+        for name, value in self.BY_CONTENT_VARIABLES:
+            await (await b_obj.add_variable("ns=2;s=Command.ByContent.{}".format(name), name, value)).set_writable()
+
+        self._resolve_nodes()
+
+    async def _generate_subscriptions(self):
+        # Create UA subscriber node for the box. Set self as handler.
+        sub = await self.ua_server.create_subscription(100, self)
+
+        # Subscribe once to every command tag in the dispatch table, in a single request.
+        # The subscription first reports the current values, they are not commands.
+        nodes = [self.ua_server.get_node(nodeid) for nodeid in self._dispatch]
+        for node in nodes:
+            self._mark_own_write(node, self._read_value(node))
+        await sub.subscribe_data_change(nodes)
+
+    async def _select_method(self, parrent, port_number, instructions):
+        r = self._pbl.select_port(port_number.Value, instructions = instructions.Value)
+        return [ua.Variant(r, ua.VariantType.Boolean)]
+
+    async def _deselect_method(self, parrent, port_number):
+        r = self._pbl.deselect_port(port_number.Value)
+        return [ua.Variant(r, ua.VariantType.Boolean)]
+
+    async def _deselect_all_method(self, parrent):
+        r = self._pbl.deselect_all()
+        return [ua.Variant(r, ua.VariantType.Boolean)]
+
+    async def _select_batch_method(self, parrent, targets, amounts, instructions):
+        r, results = self._pbl.select_batch(self._batch_lines(targets.Value, amounts.Value, instructions.Value))
+        ports = [port_number for _, port_number in results]
+        return [ua.Variant(r, ua.VariantType.Boolean),
+                ua.Variant(ports, ua.VariantType.Int32)]
+
+    async def datachange_notification(self, node, val, data):
+        """UA server callback on data change notifications. Runs on the event loop.
+
+        Arguments:
+            node {Node} -- the command tag that changed
+            val {[type]} -- the new value
+            data {[type]} -- [description]
+        """
+        logger.debug("New data change event. node:{}, value:{}".format(node, val))
+
+        entry = self._dispatch.get(node.nodeid)
+        if entry is None:
+            logger.warning('data change on {} that has no handler'.format(node))
+            return
+        if self._ignore_notification(node.nodeid, val):
+            return
+        port_number, handler, key = entry
+        # a pulse tag whose command never runs is reset here, else it stays True and the next write of True is no change
+        on_discard = partial(self._reset_pulse, node.nodeid) if node.nodeid in self._pulse_nodes else None
+        self.commands.submit(key, handler, port_number, val, on_discard=on_discard)
+
+    async def _reset_pulse(self, nodeid):
+        """Reset a Select or Deselect tag whose command was dropped or replaced"""
+        node = self.ua_server.get_node(nodeid)
+        self._mark_own_write(node, False)
+        await node.write_value(False)
+
+    def _read_value(self, node):
+        """Read the current value of one of our own variables straight from the address space"""
+        return self.ua_server.iserver.aspace.read_attribute_value(node.nodeid, ua.AttributeIds.Value).Value.Value
+
+    async def _port_select_changed(self, port_number, val):
+        # If the command tag "Select" changes go select that port with the instructions saved in the command tag.
+        if val == True:
+            nodes = self._command_nodes[port_number]
+            instructions = self._read_value(nodes['Instructions'])
+            amount = self._read_value(nodes['Amount']) or 1
+            self._pbl.select_port(port_number, amount=amount, instructions=instructions)
+            # Reset the select flag
+            self._mark_own_write(nodes['Select'], False)
+            await nodes['Select'].write_value(False)
+
+    async def _port_deselect_changed(self, port_number, val):
+        if val == True:
+            self._pbl.deselect_port(port_number, work_finished=True)
+            # Reset the select flag
+            self._mark_own_write(self._command_nodes[port_number]['Deselect'], False)
+            await self._command_nodes[port_number]['Deselect'].write_value(False)
+
+    async def _content_tag_changed(self, key, port_number, val):
+        self._pbl.set_content_key(port_number, key, str(val))
+
+    async def _content_select_changed(self, port_number, val):
+        if val == True:
+            nodes = self._by_content_nodes
+            instructions = self._read_value(nodes['Instructions'])
+            name = self._read_value(nodes['Name'])
+            amount = self._read_value(nodes['Amount']) or 1
+            _, selected_port = self._pbl.select_content(name = name, amount=amount, instructions=instructions)
+            # Reset the select flag
+            self._mark_own_write(nodes['Select'], False)
+            await nodes['Select'].write_value(False)
+            await nodes['Result'].write_value(selected_port)
+
+    async def _content_deselect_changed(self, port_number, val):
+        if val == True:
+            nodes = self._by_content_nodes
+            self._pbl.deselect_content(name = self._read_value(nodes['Name']), work_finished=True)
+            # Reset the select flag
+            self._mark_own_write(nodes['Deselect'], False)
+            await nodes['Deselect'].write_value(False)
+
+    async def _var_updater(self):
+        """Task that keeps the status tags up to date. Works like StationUAServer._var_updater
+        but waits for events on the event loop instead of in a thread.
+        """
+        await self._write_changed({port_number: self._port_values(port_number) for port_number, port in self._pbl.get_ports()})
+
+        # port number -> monotonic time when the activity flag turns off again
+        activity_deadlines = {}
+        # port number -> monotonic time when the selection times out
+        selection_deadlines = {}
+        while True:
+            timeout = None
+            deadlines = list(activity_deadlines.values()) + list(selection_deadlines.values())
+            if deadlines:
+                timeout = max(min(deadlines) - monotonic(), 0)
+            pending = []
+            try:
+                pending.append(await asyncio.wait_for(self._events.get(), timeout))
+                while True:
+                    pending.append(self._events.get_nowait())
+            except (asyncio.TimeoutError, asyncio.QueueEmpty):
+                pass
+
+            try:
+                values, content_changes = self._collect_values(pending, activity_deadlines)
+                for port_number, changed in content_changes:
+                    # a port of the content map without a hardware port has no command tags
+                    nodes = self._command_nodes.get(port_number)
+                    if nodes is None:
+                        continue
+                    # writing the same value to a command tag does not change the content, see set_content_key
+                    for tag, value in self._command_content_values(changed).items():
+                        self._mark_own_write(nodes[tag], value)
+                        await nodes[tag].write_value(value)
+                await self._write_changed(values)
+            except Exception:
+                logger.exception('failed to update the status tags')
+            await self._trigger_events(self._station_events(pending, selection_deadlines))
+
+    async def _trigger_events(self, raised):
+        """Send station UA events to the subscribed clients. See StationUAServer._trigger_events"""
+        for name, port_number, time in raised:
+            generator = self._event_generators[name]
+            try:
+                message = self._fill_event(ua, generator.event, name, port_number)
+                await generator.trigger(time, message)
+            except Exception:
+                logger.exception('could not raise {} on port {}'.format(name, port_number))
+
+    async def _write_changed(self, values):
+        """Write the status tag values that differ from the last written values in a single batched write
+
+        Args:
+            values (dict): {port_number: {tag name: value}}
+        """
+        await self._write_nodes(self._changed_values(values))
+
+    def publish_festo_status(self, status):
+        """Show the festo connection status in Status.Festo. Can be called from any thread, returns without waiting for the write.
+
+        Args:
+            status (dict): FestoServer.status()
+        """
+        asyncio.run_coroutine_threadsafe(self._write_nodes(self._festo_values(status)), self.loop)
+
+    async def _write_command_stats(self, stats):
+        """Command queue callback that writes the queue statistics to Status.Commands when the queue is drained"""
+        await self._write_nodes(self._command_stats_values(stats))
+
+    async def _write_nodes(self, changed):
+        """Write values to our variables in a single batched write
+
+        Args:
+            changed (list): [(Node, value)]
+        """
+        if not changed:
+            return
+        params = ua.WriteParameters()
+        params.NodesToWrite = []
+        datavalues = []
+        now = datetime.now(timezone.utc)
+        for node, value in changed:
+            write_value = ua.WriteValue()
+            write_value.NodeId = node.nodeid
+            write_value.AttributeId = ua.AttributeIds.Value
+            write_value.Value = ua.DataValue(ua.Variant(value), SourceTimestamp=now, ServerTimestamp=now)
+            params.NodesToWrite.append(write_value)
+            datavalues.append(write_value.Value)
+        self._written(changed, datavalues, await self.ua_server.iserver.isession.write(params))
@@ -0,0 +1,71 @@
+import unittest
+
+import port_backend
+from pca9685_port import PCA9685Backend, FakeI2CBus, channel_registers, LED0_ON_L, FULL
+
+
+class PCA9685BackendTest(unittest.TestCase):
+    """Drives the PCA9685 backend through the fake I2C bus"""
+
+    def setUp(self):
+        self.bus = FakeI2CBus()
+        self.backend = PCA9685Backend({'ports': 4}, bus=self.bus)
+        self.ports = self.backend.make_ports(self.backend.port_numbers())
+        self.registers = self.bus.registers[self.backend.address]
+
+    def channel(self, channel):
+        """The ON_L, ON_H, OFF_L and OFF_H registers of a channel on the fake chip"""
+        start = LED0_ON_L + 4 * channel
+        return list(self.registers[start:start + 4])
+
+    def test_set_lights_is_one_transaction(self):
+        transactions = self.bus.transactions
+        self.backend.set_lights({self.ports[0]: 100, self.ports[2]: 25})
+        self.assertEqual(self.bus.transactions, transactions + 1)
+
+        transactions = self.bus.transactions
+        self.backend.set_lights({port: 50 for port in self.ports})
+        self.assertEqual(self.bus.transactions, transactions + 1)
+
+    def test_register_values(self):
+        self.backend.set_lights({self.ports[0]: 100, self.ports[2]: 25})
+        self.assertEqual(self.channel(0), [0, FULL, 0, 0])
+        # 25% of 4095 rounds to 1024, OFF_L 0x00 and OFF_H 0x04
+        self.assertEqual(self.channel(2), [0, 0, 0x00, 0x04])
+        # the channel between the changed ones is written again with its current level
+        self.assertEqual(self.channel(1), [0, 0, 0, FULL])
+        self.assertEqual(self.channel(3), [0, 0, 0, FULL])
+
+    def test_keep_light_levels(self):
+        self.backend.set_lights({self.ports[0]: 100, self.ports[2]: 25})
+        self.backend.set_lights({self.ports[1]: 150})
+        # the ports keep their capped levels and the earlier channels are not touched
+        self.assertEqual([port.get_light() for port in self.ports], [100, 100, 25, 0])
+        self.assertEqual(self.channel(0), [0, FULL, 0, 0])
+        self.assertEqual(self.channel(1), [0, FULL, 0, 0])
+        self.assertEqual(self.channel(2), channel_registers(25))
+
+    def test_set_light_of_one_port(self):
+        transactions = self.bus.transactions
+        self.ports[3].set_light(0)
+        self.assertEqual(self.bus.transactions, transactions + 1)
+        self.assertEqual(self.channel(3), [0, 0, 0, FULL])
+
+
+class PortBackendTest(unittest.TestCase):
+
+    def test_backend_without_make_port_fails_when_created(self):
+        class Incomplete(port_backend.PortBackend):
+            pass
+        with self.assertRaises(TypeError):
+            Incomplete()
+
+    def test_port_without_write_light_fails_when_created(self):
+        class Incomplete(port_backend.Port):
+            pass
+        with self.assertRaises(TypeError):
+            Incomplete(1)
+
+
+if __name__ == '__main__':
+    unittest.main()
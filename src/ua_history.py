@@ -0,0 +1,163 @@
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from threading import Lock
+
+import logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.WARNING)
+
+# UA clients leave the start or end time of a history read unspecified by sending this time
+WIN_EPOCH = datetime(1601, 1, 1)
+
+
+def _naive_utc(time):
+    """Make opcua (naive utc) and asyncua (aware utc) timestamps comparable"""
+    if time is not None and time.tzinfo is not None:
+        time = time.astimezone(timezone.utc).replace(tzinfo=None)
+    return time
+
+
+def _timestamp(datavalue):
+    return _naive_utc(datavalue.SourceTimestamp or datavalue.ServerTimestamp)
+
+
+class RingBufferHistory:
+    """Bounded in-memory history of variable values.
+
+    Every historized node keeps its values in a ring buffer of a fixed size, and values older than
+    the retention period are dropped when new values arrive, so memory use is bounded no matter
+    how long the station runs. The history is lost at restart.
+
+    Implements the history storage interface of the opcua package so it can be given to
+    HistoryManager.set_storage to serve HistoryRead. Events are not historized.
+    """
+
+    def __init__(self, count=1000, period=timedelta(hours=8)):
+        """Constructor:
+
+        Args:
+            count (int, optional): Default max number of values kept per node. Defaults to 1000.
+            period (timedelta, optional): Default retention. Defaults to 8 hours.
+        """
+        self.count = count
+        self.period = period
+        self._lock = Lock()
+        # NodeId -> (deque of DataValues oldest first, retention period)
+        self._buffers = {}
+
+    def is_historized(self, node_id):
+        return node_id in self._buffers
+
+    def new_historized_node(self, node_id, period=None, count=0):
+        """Start keeping the history of a node
+
+        Args:
+            node_id (NodeId): the node
+            period (timedelta, optional): retention. Defaults to None meaning the default retention.
+            count (int, optional): max number of values. Defaults to 0 meaning the default count.
+        """
+        with self._lock:
+            self._buffers[node_id] = (deque(maxlen=count or self.count), period or self.period)
+
+    def save_node_value(self, node_id, datavalue):
+        """Add a value to the history of a node. Values of nodes that are not historized are ignored.
+
+        Args:
+            node_id (NodeId): the node
+            datavalue (DataValue): the value with its timestamps
+        """
+        with self._lock:
+            entry = self._buffers.get(node_id)
+            if entry is None:
+                return
+            buffer, period = entry
+            buffer.append(datavalue)
+            oldest = _timestamp(datavalue) - period
+            while buffer and _timestamp(buffer[0]) < oldest:
+                buffer.popleft()
+
+    def read_node_history(self, node_id, start, end, nb_values):
+        """Read the history of a node. Follows HistoryDict of the opcua package: an unspecified start
+        reads backwards from the end, a start after the end reads backwards.
+
+        Args:
+            node_id (NodeId): the node
+            start (datetime): start time or WIN_EPOCH
+            end (datetime): end time or WIN_EPOCH
+            nb_values (int): max number of values to return. 0 means all.
+
+        Returns:
+            tuple: ([DataValue], timestamp to continue from or None)
+        """
+        with self._lock:
+            entry = self._buffers.get(node_id)
+            values = list(entry[0]) if entry is not None else None
+        if values is None:
+            logger.warning('history read of {} which is not historized'.format(node_id))
+            return [], None
+
+        start = _naive_utc(start) if start is not None else WIN_EPOCH
+        end = _naive_utc(end) if end is not None else WIN_EPOCH
+        if start == WIN_EPOCH:
+            results = [dv for dv in reversed(values) if end == WIN_EPOCH or _timestamp(dv) <= end]
+        elif end == WIN_EPOCH:
+            results = [dv for dv in values if start <= _timestamp(dv)]
+        elif start > end:
+            results = [dv for dv in reversed(values) if end <= _timestamp(dv) <= start]
+        else:
+            results = [dv for dv in values if start <= _timestamp(dv) <= end]
+
+        cont = None
+        if nb_values and len(results) > nb_values:
+            # the next read starts at the first value that did not fit
+            cont = results[nb_values].SourceTimestamp or results[nb_values].ServerTimestamp
+            results = results[:nb_values]
+        return results, cont
+
+    def new_historized_event(self, source_id, evtypes, period, count=0):
+        pass
+
+    def save_event(self, event):
+        pass
+
+    def read_event_history(self, source_id, start, end, nb_values, evfilter):
+        return [], None
+
+    def stop(self):
+        pass
+
+
+class AsyncRingBufferHistory:
+    """Gives a RingBufferHistory the coroutine storage interface of the asyncua package"""
+
+    def __init__(self, history):
+        """Constructor:
+
+        Args:
+            history (RingBufferHistory): the history to serve
+        """
+        self.history = history
+
+    async def init(self):
+        pass
+
+    async def new_historized_node(self, node_id, period=None, count=0):
+        self.history.new_historized_node(node_id, period, count)
+
+    async def save_node_value(self, node_id, datavalue):
+        self.history.save_node_value(node_id, datavalue)
+
+    async def read_node_history(self, node_id, start, end, nb_values):
+        return self.history.read_node_history(node_id, start, end, nb_values)
+
+    async def new_historized_event(self, source_id, evtypes, period, count=0):
+        pass
+
+    async def save_event(self, event):
+        pass
+
+    async def read_event_history(self, source_id, start, end, nb_values, evfilter):
+        return [], None
+
+    async def stop(self):
+        pass
@@ -0,0 +1,333 @@
+#!/usr/bin/python3
+"""Load test of the station OPC UA server.
+
+Starts the server with dummy ports in this process and runs concurrent UA clients in child processes.
+The clients call the SelectPort and DeselectPort methods and use the ByContent command tags at a fixed
+rate, and every client subscribes to the Selected tag of all ports. The throughput, the command and
+notification latencies and the CPU used by the server are written as JSON so runs can be compared.
+
+The ByContent tags are shared by all clients, so the commands of several clients can merge into one and a
+client can see the command of another client finish as its own. The ByContent commands are therefore counted
+by the command queue of the server, the only commands the clients send through it, and the commands the
+clients saw finish without the server running them are reported as lost.
+
+Example:
+    python3 ua_load_test.py --ports 60 --clients 4 --rate 20 --duration 30 -o results.json
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import random
+import resource
+import subprocess
+import sys
+from threading import Thread, Event
+from time import monotonic, sleep
+
+from opcua import Client, ua
+
+import pick_by_light
+from dummy_port import DummyPort
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+ENDPOINT = 'opc.tcp://127.0.0.1:4840/UA/PickByLight'
+OPERATIONS = ('select', 'deselect', 'by_content')
+
+
+def percentile(sorted_values, p):
+    """Get a percentile of sorted values by linear interpolation
+
+    Args:
+        sorted_values (list): the values in ascending order
+        p (float): the percentile between 0 and 100
+
+    Returns:
+        float: the percentile or None if there are no values
+    """
+    if not sorted_values:
+        return None
+    position = (len(sorted_values) - 1) * p / 100
+    low = int(position)
+    high = min(low + 1, len(sorted_values) - 1)
+    return sorted_values[low] + (sorted_values[high] - sorted_values[low]) * (position - low)
+
+
+def summary(latencies, errors, duration):
+    """Summarize the latencies of one kind of operation
+
+    Args:
+        latencies (list): seconds each successful operation took
+        errors (int): number of failed operations
+        duration (float): seconds the load ran
+
+    Returns:
+        dict: count, errors, throughput in operations per second and p50, p99 and max latency in milliseconds
+    """
+    latencies = sorted(latencies)
+    ms = lambda seconds: round(seconds * 1000, 3) if seconds is not None else None
+    return {'count': len(latencies),
+            'errors': errors,
+            'throughput': round(len(latencies) / duration, 2) if duration else None,
+            'p50_ms': ms(percentile(latencies, 50)),
+            'p99_ms': ms(percentile(latencies, 99)),
+            'max_ms': ms(latencies[-1] if latencies else None)}
+
+
+def parse_mix(text):
+    """Parse an operation mix like 'select=2,deselect=2,by_content=1'
+
+    Returns:
+        dict: {operation: weight}
+
+    Raises:
+        argparse.ArgumentTypeError: unknown operation or bad weight
+    """
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name not in OPERATIONS:
+            raise argparse.ArgumentTypeError('unknown operation {}. Use {}'.format(name, ', '.join(OPERATIONS)))
+        try:
+            mix[name] = float(weight or 1)
+        except ValueError:
+            raise argparse.ArgumentTypeError('bad weight {} of {}'.format(weight, name))
+    return mix
+
+
+class NotificationTimer:
+    """Subscription handler that measures how long it takes from a select until the Selected tag notification"""
+
+    def __init__(self, nodeid_ports):
+        """Constructor:
+
+        Args:
+            nodeid_ports (dict): {NodeId of a Selected tag: port number}
+        """
+        self._nodeid_ports = nodeid_ports
+        # port number -> monotonic time of the select that was not notified yet
+        self._expected = {}
+        self.count = 0
+        self.latencies = []
+
+    def expect(self, port_number):
+        self._expected[port_number] = monotonic()
+
+    def datachange_notification(self, node, val, data):
+        self.count += 1
+        port_number = self._nodeid_ports.get(node.nodeid)
+        if port_number not in self._expected:
+            return
+        started = self._expected.pop(port_number)
+        # a select of a port that was already selected is not notified, the deselect ends the wait
+        if val:
+            self.latencies.append(monotonic() - started)
+
+
+def client_process(index, options, port_numbers, ready, go, results):
+    """Process function of one load test client
+
+    Args:
+        index (int): client number, seeds the random choices so runs are repeatable
+        options (dict): the command line options
+        port_numbers (list): the ports of the server
+        ready (multiprocessing.Queue): the client puts its index here when it is connected
+        go (multiprocessing.Event): set when all clients are connected
+        results (multiprocessing.Queue): the client puts its measurements here
+    """
+    client = Client(ENDPOINT, timeout=10)
+    client.connect()
+    try:
+        command = client.get_node('ns=2;s=Command')
+        select_port = client.get_node('ns=2;s=Command.SelectPort')
+        deselect_port = client.get_node('ns=2;s=Command.DeselectPort')
+        by_content = {name: client.get_node('ns=2;s=Command.ByContent.{}'.format(name)) for name in ['Name', 'Select']}
+        selected = {client.get_node('ns=2;s=Status.Port_{}.Selected'.format(p)): p for p in port_numbers}
+        timer = NotificationTimer({node.nodeid: p for node, p in selected.items()})
+        subscription = client.create_subscription(options['publishing_interval'], timer)
+        subscription.subscribe_data_change(list(selected))
+
+        rng = random.Random(index)
+        operations = list(options['mix'])
+        weights = [options['mix'][operation] for operation in operations]
+        latencies = {operation: [] for operation in OPERATIONS}
+        errors = {operation: 0 for operation in OPERATIONS}
+
+        ready.put(index)
+        go.wait()
+        start = monotonic()
+        end = start + options['duration']
+        next_at = start
+        while True:
+            if options['rate']:
+                next_at += 1 / options['rate']
+                sleep(max(next_at - monotonic(), 0))
+            if monotonic() >= end:
+                break
+            operation = rng.choices(operations, weights)[0]
+            port_number = rng.choice(port_numbers)
+            began = monotonic()
+            try:
+                if operation == 'select':
+                    timer.expect(port_number)
+                    command.call_method(select_port, ua.Variant(port_number, ua.VariantType.Int32), 'load test')
+                elif operation == 'deselect':
+                    command.call_method(deselect_port, ua.Variant(port_number, ua.VariantType.Int32))
+                else:
+                    # the command is done when the server resets Select
+                    by_content['Name'].set_value('load_test_{}'.format(port_number))
+                    by_content['Select'].set_value(True)
+                    while by_content['Select'].get_value():
+                        if monotonic() - began > options['command_timeout']:
+                            raise TimeoutError('ByContent.Select was not reset')
+                        sleep(0.001)
+                latencies[operation].append(monotonic() - began)
+            except Exception:
+                errors[operation] += 1
+        # let the last notifications arrive
+        sleep(options['publishing_interval'] / 1000 * 2)
+        results.put({'index': index, 'duration': monotonic() - start, 'latencies': latencies, 'errors': errors,
+                     'notification_latencies': timer.latencies, 'notifications': timer.count})
+    except Exception as e:
+        results.put({'index': index, 'failed': repr(e)})
+    finally:
+        client.disconnect()
+
+
+def activity_thread(ports, rate, stop):
+    """Thread function that makes activity on random dummy ports, like a worker picking"""
+    rng = random.Random(0)
+    while not stop.wait(1 / rate):
+        rng.choice(ports).make_activity()
+
+
+def cpu_seconds():
+    """Returns:
+        float: user and system cpu seconds used by this process, which runs the server
+    """
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def version():
+    """Returns:
+        str: git describe of the tree, or None outside a git checkout
+    """
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(options):
+    """Run a load test
+
+    Args:
+        options (dict): the command line options
+
+    Returns:
+        dict: the results
+    """
+    ports = [DummyPort(port_number) for port_number in range(1, options['ports'] + 1)]
+    pbl = pick_by_light.PickByLight(ports)
+    for port in ports:
+        pbl.set_content(port.port_number, {'name': 'load_test_{}'.format(port.port_number),
+                                           'display_name': 'Load test {}'.format(port.port_number)})
+
+    if options['async_ua']:
+        from station_ua_server_async import AsyncStationUAServer
+        server = AsyncStationUAServer(pbl)
+    else:
+        from station_ua_server import StationUAServer
+        server = StationUAServer(pbl)
+
+    # spawn instead of fork, the server threads must not be copied into the clients
+    context = multiprocessing.get_context('spawn')
+    ready, results, go = context.Queue(), context.Queue(), context.Event()
+    port_numbers = [port.port_number for port in ports]
+    clients = [context.Process(target=client_process, args=(i, options, port_numbers, ready, go, results), daemon=True)
+               for i in range(options['clients'])]
+    try:
+        for process in clients:
+            process.start()
+        for process in clients:
+            ready.get(timeout=60)
+
+        stop = Event()
+        if options['activity_rate']:
+            Thread(target=activity_thread, args=(ports, options['activity_rate'], stop), daemon=True).start()
+        logger.info('running {} clients against {} ports for {}s'.format(options['clients'], options['ports'], options['duration']))
+        cpu_start, wall_start = cpu_seconds(), monotonic()
+        go.set()
+        client_results = [results.get(timeout=options['duration'] + 60) for process in clients]
+        cpu, wall = cpu_seconds() - cpu_start, monotonic() - wall_start
+        stop.set()
+        for process in clients:
+            process.join(timeout=10)
+        commands = dict(server.commands.stats(), ignored=server.ignored_notifications)
+    finally:
+        server.stop()
+
+    failed = [r for r in client_results if 'failed' in r]
+    client_results = [r for r in client_results if 'failed' not in r]
+    duration = max([r['duration'] for r in client_results], default=wall)
+    operations = {}
+    for operation in OPERATIONS:
+        latencies = [l for r in client_results for l in r['latencies'][operation]]
+        operations[operation] = summary(latencies, sum(r['errors'][operation] for r in client_results), duration)
+    # the clients count merged ByContent commands as their own, the server knows how many ran
+    by_content = operations['by_content']
+    executed = commands['executed'] + commands['failed']
+    by_content['lost'] = max(by_content['count'] - executed, 0)
+    by_content['count'] = min(by_content['count'], executed)
+    by_content['throughput'] = round(by_content['count'] / duration, 2) if duration else None
+    all_latencies = [l for r in client_results for operation in OPERATIONS for l in r['latencies'][operation]]
+    total = summary(all_latencies, sum(o['errors'] for o in operations.values()), duration)
+    total['count'] -= by_content['lost']
+    total['throughput'] = round(total['count'] / duration, 2) if duration else None
+    notifications = summary([l for r in client_results for l in r['notification_latencies']], 0, duration)
+    notifications['received'] = sum(r['notifications'] for r in client_results)
+
+    return {'version': version(),
+            'backend': 'asyncua' if options['async_ua'] else 'opcua',
+            'options': options,
+            'startup': {phase: round(seconds, 4) for phase, seconds in server.startup.phases.items()},
+            'duration': round(duration, 3),
+            'total': total,
+            'operations': operations,
+            'notifications': notifications,
+            'server_cpu': {'seconds': round(cpu, 3), 'percent': round(cpu / wall * 100, 1)},
+            'commands': commands,
+            'failed_clients': [r['failed'] for r in failed]}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Load test of the station OPC UA server with dummy ports')
+    parser.add_argument("-p", "--ports", help="number of dummy ports. Default 60", type=int, default=60)
+    parser.add_argument("-c", "--clients", help="number of concurrent ua clients. Default 4", type=int, default=4)
+    parser.add_argument("-r", "--rate", help="operations per second of each client. 0 is as fast as possible. Default 10", type=float, default=10)
+    parser.add_argument("-d", "--duration", help="seconds to run the load. Default 10", type=float, default=10)
+    parser.add_argument("-m", "--mix", help="weights of the operations. Default select=2,deselect=2,by_content=1",
+                        type=parse_mix, default='select=2,deselect=2,by_content=1')
+    parser.add_argument("-i", "--publishing_interval", help="publishing interval of the client subscriptions in ms. Default 100", type=float, default=100)
+    parser.add_argument("-A", "--activity_rate", help="activity signals per second on random ports. Default 0", type=float, default=0)
+    parser.add_argument("-t", "--command_timeout", help="seconds to wait for a ByContent command. Default 5", type=float, default=5)
+    parser.add_argument("-a", "--async_ua", help="load test the asyncua server", action="store_true")
+    parser.add_argument("-o", "--output", help="write the results to this file instead of stdout", type=str)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    # the pick by light logs every selection, that would be measured as server load
+    pick_by_light.logger.setLevel(logging.WARNING)
+
+    results = run(vars(args))
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(text + '\n')
+    else:
+        print(text)
+    sys.exit(1 if results['failed_clients'] else 0)
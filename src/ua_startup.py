@@ -0,0 +1,208 @@
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from time import monotonic
+import copy
+import gc
+import hashlib
+import os
+import pickle
+import socket
+
+import logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.WARNING)
+
+# Everything the UA servers generate once and reuse at the next boot
+CACHE_DIR = './ua_cache'
+CERTIFICATE_PATH = os.path.join(CACHE_DIR, 'certificate.pem')
+PRIVATE_KEY_PATH = os.path.join(CACHE_DIR, 'private_key.pem')
+
+# Bump when the way the address space is built changes, so old snapshots are not used
+SNAPSHOT_FORMAT = 3
+
+
+class StartupTimer:
+    """Measures how long each phase of a startup takes
+
+    Usage:
+        timer = StartupTimer()
+        with timer.phase('certificate'):
+            ...
+        timer.phases  # {'certificate': seconds}
+    """
+
+    def __init__(self):
+        self.phases = {}
+
+    @contextmanager
+    def phase(self, name):
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.phases[name] = monotonic() - start
+
+    def total(self):
+        """Returns:
+            float: seconds spent in all phases
+        """
+        return sum(self.phases.values())
+
+    def __str__(self):
+        return ', '.join('{} {:.3f}s'.format(name, seconds) for name, seconds in self.phases.items())
+
+
+def standard_address_space_shelf(path):
+    """Get the path of the shelf the ua package caches the standard address space in.
+
+    The ua packages only reuse the shelf when a file with exactly this name exists. Without gdbm
+    python falls back to dbm.dumb which writes path.dat and path.dir instead, so the standard
+    address space was built again at every boot. An empty marker file makes the packages find it.
+
+    Args:
+        path (str): path of the shelf
+
+    Returns:
+        str: path of the shelf
+    """
+    if not os.path.exists(path) and os.path.exists(path + '.dat'):
+        open(path, 'a').close()
+    return path
+
+
+def ensure_certificate(application_uri, certificate_path=CERTIFICATE_PATH, private_key_path=PRIVATE_KEY_PATH):
+    """Make a self signed certificate and private key for the encrypted security policies,
+    unless they are already on disk from an earlier boot.
+
+    Args:
+        application_uri (str): application uri of the server. Clients check it against the certificate.
+        certificate_path (str, optional): where to keep the certificate. Defaults to CERTIFICATE_PATH.
+        private_key_path (str, optional): where to keep the private key. Defaults to PRIVATE_KEY_PATH.
+
+    Returns:
+        tuple: (certificate path, private key path) both in PEM format
+    """
+    if os.path.exists(certificate_path) and os.path.exists(private_key_path):
+        return certificate_path, private_key_path
+
+    from cryptography import x509
+    from cryptography.x509.oid import NameOID
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    logger.warning('generating a certificate for the ua server in {}'.format(certificate_path))
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'Pick By Light Server')])
+    now = datetime.utcnow()
+    certificate = (x509.CertificateBuilder()
+                   .subject_name(name)
+                   .issuer_name(name)
+                   .public_key(key.public_key())
+                   .serial_number(x509.random_serial_number())
+                   .not_valid_before(now - timedelta(days=1))
+                   .not_valid_after(now + timedelta(days=10 * 365))
+                   .add_extension(x509.SubjectAlternativeName([x509.UniformResourceIdentifier(application_uri),
+                                                                x509.DNSName(socket.gethostname())]), critical=False)
+                   .add_extension(x509.BasicConstraints(ca=False, path_length=None), critical=True)
+                   .add_extension(x509.KeyUsage(digital_signature=True, content_commitment=True, key_encipherment=True,
+                                                data_encipherment=True, key_agreement=False, key_cert_sign=False,
+                                                crl_sign=False, encipher_only=False, decipher_only=False), critical=True)
+                   .sign(key, hashes.SHA256()))
+
+    os.makedirs(os.path.dirname(certificate_path) or '.', exist_ok=True)
+    os.makedirs(os.path.dirname(private_key_path) or '.', exist_ok=True)
+    # write the key first, a certificate without its key is useless
+    with open(private_key_path, 'wb') as key_file:
+        key_file.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL,
+                                         serialization.NoEncryption()))
+    os.chmod(private_key_path, 0o600)
+    with open(certificate_path, 'wb') as certificate_file:
+        certificate_file.write(certificate.public_bytes(serialization.Encoding.PEM))
+    return certificate_path, private_key_path
+
+
+def snapshot_key(layout):
+    """Make the key of an address space snapshot
+
+    Args:
+        layout (any): everything the address space is built from, like the ports and their initial tag values. Must have a stable repr.
+
+    Returns:
+        str: the key
+    """
+    return hashlib.sha1(repr((SNAPSHOT_FORMAT, layout)).encode()).hexdigest()
+
+
+def snapshot_path(key, backend):
+    """Path of the address space snapshot of a ua backend"""
+    return os.path.join(CACHE_DIR, 'address_space-{}-{}.pickle'.format(backend, key))
+
+
+def save_address_space(aspace, path, namespace_index):
+    """Save the nodes of one namespace so they can be loaded in bulk at the next boot.
+    Must be called before anything subscribes to the nodes.
+
+    Args:
+        aspace (AddressSpace): the address space of the server. opcua and asyncua are both supported.
+        path (str): file to save to. Other snapshots in the same directory are deleted.
+        namespace_index (int): the namespace of our nodes
+    """
+    nodes = {}
+    for nodeid in list(aspace.keys()):
+        if nodeid.NamespaceIndex != namespace_index:
+            continue
+        node = copy.copy(aspace[nodeid])
+        # method callbacks can't be saved, they are added again after loading
+        node.call = None
+        nodes[nodeid] = node
+
+    # references from standard nodes like the Objects folder to our nodes
+    parent_references = []
+    for node in nodes.values():
+        for ref in node.references:
+            if ref.IsForward or ref.NodeId in nodes:
+                continue
+            parent_references += [(ref.NodeId, parent_ref) for parent_ref in aspace[ref.NodeId].references if parent_ref.NodeId == node.nodeid]
+
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    prefix = os.path.basename(path).rsplit('-', 1)[0]
+    for name in os.listdir(directory):
+        if name.startswith(prefix) and name != os.path.basename(path):
+            os.remove(os.path.join(directory, name))
+    # write to a temporary file so a power cut never leaves half a snapshot
+    with open(path + '.tmp', 'wb') as snapshot_file:
+        pickle.dump({'nodes': nodes, 'parent_references': parent_references}, snapshot_file, pickle.HIGHEST_PROTOCOL)
+    os.replace(path + '.tmp', path)
+
+
+def load_address_space(aspace, path):
+    """Load the nodes saved by save_address_space into the address space of a server
+
+    Args:
+        aspace (AddressSpace): the address space of the server
+        path (str): file to load from
+
+    Returns:
+        bool: False if there is no usable snapshot
+    """
+    # the garbage collector would run many times while unpickling all the node objects
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        with open(path, 'rb') as snapshot_file:
+            snapshot = pickle.load(snapshot_file)
+    except FileNotFoundError:
+        return False
+    except Exception as e:
+        logger.warning('could not load the address space snapshot {}. Building it instead. Error = {}'.format(path, e))
+        return False
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+    for nodeid, node in snapshot['nodes'].items():
+        aspace[nodeid] = node
+    for parent_nodeid, ref in snapshot['parent_references']:
+        aspace[parent_nodeid].references.append(ref)
+    return True